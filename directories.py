@@ -7,7 +7,10 @@ directories -- a module for mangling directories, files, and trees of them
 
 import inspect
 
-import stat, os, time, sys, select, array, heapq, random
+import stat, os, time, sys, select, array, heapq, random, hashlib, errno
+import concurrent.futures, dbm, threading, queue, shutil, json, asyncio
+import zlib
+from collections import defaultdict, deque
 import termios, fcntl, struct  # for get_window_size()
 
 CHUNK_SIZE = (1 << 16)  # used for reading/copying
@@ -21,6 +24,30 @@ TIMES_CACHE_CHUNK = int(os.getenv('DIRECTORIES_TIME_CACHE_CHUNK', '50'))
 TIMES_MIN_DISTANCE = float(os.getenv('DIRECTORIES_TIMES_MIN_DISTANCE', '1.0'))
 # ^^^ number of seconds at least between entries
 
+# for checksums and duplicate finding:
+SAMPLE_SIZE = int(os.getenv('DIRECTORIES_SAMPLE_SIZE', str(1 << 14)))
+# ^^^ number of bytes read from head and tail for a partial checksum
+DIGEST_THREADS = int(os.getenv('DIRECTORIES_DIGEST_THREADS', '8'))
+# ^^^ number of threads reading and hashing files in parallel
+CHECKSUM_CACHE = os.getenv('DIRECTORIES_CHECKSUM_CACHE',
+                           os.path.expanduser('~/.cache/directories/checksums'))
+# ^^^ persistent cache of file digests (empty string disables it)
+
+# for chunk stores:
+STORE_CHUNK_BITS = int(os.getenv('DIRECTORIES_STORE_CHUNK_BITS', '16'))
+# ^^^ content-defined chunks are 2**bits bytes large on average
+STORE_CHUNKING = os.getenv('DIRECTORIES_STORE_CHUNKING', 'content')
+# ^^^ 'content' for content-defined chunks, 'fixed' for chunks of 2**bits
+#     bytes (a bit faster, but data inserted into a file changes all later
+#     chunks of its segment)
+STORE_SEGMENT_SIZE = int(os.getenv('DIRECTORIES_STORE_SEGMENT_SIZE',
+                                   str(1 << 24)))
+# ^^^ files are split into segments of this size which are chunked in
+#     parallel (the only chunk boundaries not defined by the content)
+STORE_PROCESSES = int(os.getenv('DIRECTORIES_STORE_PROCESSES',
+                                str(os.cpu_count() or 1)))
+# ^^^ number of processes chunking and hashing segments
+
 class kmg:
   """
   class kilo-mega-giga (a kind of int with more semantics) supported
@@ -171,44 +198,49 @@ class Ancestry(list):
             TTY.breakon)
 
   def add_time(self, value):
-    if (len(self.times) < 1 or
-      time.time() > self.times[-1][0] + 1.0):
-      self.times.append((time.time(), value))
-      if len(self.times) > TIMES_CACHE_SIZE:  # tidy up times cache
-        ## # find the indices which are farthest away from the linear
-        ## # time distribution between the beginning of this Ancestry
-        ## # and the current time:
-        ## indices = heapq.nlargest(TIMES_CACHE_CHUNK,
-        ##              range(1, len(self.times)),
-        ##              key=(lambda index:
-        ##                 (self.times[0][0] +
-        ##                  float(self.times[-1][0]-
-        ##                    self.times[0][0]) *
-        ##                  index//len(self.times) -
-        ##                  self.times[index][0]) //
-        ##                 index))
-        # find the indices of the elements which are most linear in the
-        # curve (most nothing-saying and so prunable because linearly
-        # interpolatable anyway):
-        indices = heapq.nsmallest(
-          TIMES_CACHE_CHUNK, range(1, len(self.times)-1),
-          key=(lambda index:
-             abs(((self.times[index-1][1].bytes() -
-                 self.times[index  ][1].bytes()) /
-                (self.times[index-1][0] -
-                 self.times[index  ][0])) -
-               ((self.times[index  ][1].bytes() -
-                 self.times[index+1][1].bytes()) /
-                (self.times[index  ][0] -
-                 self.times[index+1][0])))))
-        # the following code removes the element of the found indices:
-        indices.sort()
-        indices.reverse()
-        for index in indices:
-          del self.times[index]
-    start, end, path, father = self
-    if father is not None:
-      father.add_time(value)
+    now = time.time()
+    element = self
+    while element is not None:  # walk up to the root (without recursion)
+      times = element.times
+      if len(times) >= 1 and now <= times[-1][0] + TIMES_MIN_DISTANCE:
+        break  # fathers have been updated recently enough as well
+      times.append((now, value))
+      if len(times) > TIMES_CACHE_SIZE:  # tidy up times cache
+        element.tidy_times()
+      element = element.get_father()
+
+  def tidy_times(self):
+    ## # find the indices which are farthest away from the linear
+    ## # time distribution between the beginning of this Ancestry
+    ## # and the current time:
+    ## indices = heapq.nlargest(TIMES_CACHE_CHUNK,
+    ##              range(1, len(self.times)),
+    ##              key=(lambda index:
+    ##                 (self.times[0][0] +
+    ##                  float(self.times[-1][0]-
+    ##                    self.times[0][0]) *
+    ##                  index//len(self.times) -
+    ##                  self.times[index][0]) //
+    ##                 index))
+    # find the indices of the elements which are most linear in the
+    # curve (most nothing-saying and so prunable because linearly
+    # interpolatable anyway):
+    indices = heapq.nsmallest(
+      TIMES_CACHE_CHUNK, range(1, len(self.times)-1),
+      key=(lambda index:
+         abs(((self.times[index-1][1].bytes() -
+             self.times[index  ][1].bytes()) /
+            (self.times[index-1][0] -
+             self.times[index  ][0])) -
+           ((self.times[index  ][1].bytes() -
+             self.times[index+1][1].bytes()) /
+            (self.times[index  ][0] -
+             self.times[index+1][0])))))
+    # the following code removes the element of the found indices:
+    indices.sort()
+    indices.reverse()
+    for index in indices:
+      del self.times[index]
 
   def get_times(self):  return self.times
 
@@ -246,31 +278,38 @@ class Ancestry(list):
   #  else:         return father.whole()
 
   def get_root(self):
-    father = self.get_father()
-    if father is None:  return self
-    else:  return father.get_root()
+    element = self
+    while element.get_father() is not None:
+      element = element.get_father()
+    return element
 
   def get_depth(self):
+    depth = 1
     father = self.get_father()
-    if father is None:  return 1
-    else:  return 1 + father.get_depth()
+    while father is not None:
+      depth += 1
+      father = father.get_father()
+    return depth
 
   def progress(self, value):
-    start, end, path, father = self
-    if father is None:
-      return []
-    start = start.bytes()
-    end   =   end.bytes()
-    father_start, father_end, father_path, grandfather = father
-    father_start   = father_start.bytes()
-    father_end     =   father_end.bytes()
-    size           = (father_end-father_start)
-    start_of_chunk = (     start-father_start)
-    position       = (     value-father_start)
-    end_of_chunk   = (       end-father_start)
-    return (father.progress(value) +
-        [ (path, start_of_chunk, position, end_of_chunk, size,
-            self.times) ])
+    result = []
+    element = self
+    while element.get_father() is not None:
+      start, end, path, father = element
+      start = start.bytes()
+      end   =   end.bytes()
+      father_start, father_end, father_path, grandfather = father
+      father_start   = father_start.bytes()
+      father_end     =   father_end.bytes()
+      size           = (father_end-father_start)
+      start_of_chunk = (     start-father_start)
+      position       = (     value-father_start)
+      end_of_chunk   = (       end-father_start)
+      result.append((path, start_of_chunk, position, end_of_chunk, size,
+                     element.times))
+      element = father
+    result.reverse()  # root first
+    return result
 
   def display(self, value=None, width=None, smooth_time={}, smoothness=30):
     if width is None:  height, width = get_window_size()
@@ -356,6 +395,13 @@ class Ancestry(list):
       gnuplot.write('e\n')
     gnuplot.close()
 
+def sorted_listing(path):
+  "returns the sorted names in a directory (or nothing if it is unreadable)"
+  try:
+    return sorted(os.listdir(path))
+  except OSError:  # permission denied?
+    return []
+
 def sizeof_path(path, report=None, follow_links=None, target=None,
                 add_report=None):
   """
@@ -367,66 +413,74 @@ def sizeof_path(path, report=None, follow_links=None, target=None,
   function for each entry in this directory
   """
   if follow_links is None:  follow_links = False
+  stat_fun = os.stat if follow_links else os.lstat
+  scanned = [ Counter((0, 0)) ]  # everything found so far, for reporting
+
+  def entries_of(path):
+    if isinstance(path, list):  # pseudo dir?
+      return path
+    return [ path + '/' + entry for entry in sorted_listing(path) ]
+
+  def sizeof_leaf(path, mode, current_stat):
+    if   stat.S_ISREG(mode):
+      counter = Counter((1, current_stat.st_size))
+      scanned[0] += counter
+      return Path_Size((counter, path, None))
+    elif stat.S_ISBLK(mode):   return Path_Size((Counter((0, 0)), path, None))
+    elif stat.S_ISCHR(mode):   return Path_Size((Counter((0, 0)), path, None))
+    elif stat.S_ISFIFO(mode):  return Path_Size((Counter((0, 0)), path, None))
+    elif stat.S_ISLNK(mode):   return Path_Size((Counter((0, 0)), path, None))
+    elif stat.S_ISSOCK(mode):  return Path_Size((Counter((0, 0)), path, None))
+    else:
+      raise Exception("internal error: %r" % (mode,))
+
+  def enter(path):
+    """
+    returns either a finished Path_Size (leaf) or a new stack frame (dir)
+    """
+    if callable(report):
+      report(path, scanned[0])  # report receives a counter
+    try:
+      current_stat = stat_fun(path)
+    except OSError:  # no such file or directory?
+      return Path_Size((Counter((0, 0)), path, None))
+    mode = current_stat.st_mode
+    if stat.S_ISDIR(mode):
+      return [ path, iter(entries_of(path)), [], Counter((0, 0)) ]
+    return sizeof_leaf(path, mode, current_stat)
+
+  # explicit stack instead of recursion; each frame is a list of
+  # [ path, iterator over entries, results so far, counter so far ]
   if isinstance(path, list):
-    results = []
-    counter = Counter((0, 0))
-    for entry in path:
-      if target is not None and os.path.isfile(os.path.join(target, entry)):
-        if add_report is not None:
-          add_report("Skipped existing: %s" % entry)
-        continue
-      if callable(report):
-        result = sizeof_path(
-            entry, lambda path, c: report(path, counter + c),
-            follow_links=follow_links, target=target, add_report=add_report)
-      else:
-        result = sizeof_path(
-            entry,
-            follow_links=follow_links, target=target, add_report=add_report)
-      results.append(result)
-      entry_counter, p, entries = result
-      counter += entry_counter
-    return Path_Size((counter, '', results))
-  if callable(report):
-    report(path, Counter((0, 0)))  # report receives a counter
-  try:
-    current_stat = (os.stat if follow_links else os.lstat)(path)
-  except OSError:  # no such file or directory?
-    return Path_Size((Counter((0, 0)), path, None))
-  mode = current_stat.st_mode
-  if   stat.S_ISDIR(mode):
-    try:
-      entries = [ path + '/' + entry for entry in sorted(os.listdir(path)) ]
-    except OSError:  # permission denied?
-      entries = []  # TODO: make this behaviour configurable
-    results = []
-    counter = Counter((0, 0))
-    for entry in entries:
-      if target is not None and os.path.isfile(os.path.join(target, entry)):
-        if add_report is not None:
-          add_report("Skipped existing: %s" % entry)
-        continue
-      if callable(report):
-        result = sizeof_path(
-            entry, lambda path, c: report(path, counter + c),
-            follow_links=follow_links, target=target, add_report=add_report)
-      else:
-        result = sizeof_path(
-            entry,
-            follow_links=follow_links, target=target, add_report=add_report)
-      results.append(result)
-      entry_counter, p, entries = result
-      counter += entry_counter
-    return Path_Size((counter, path, results))
-  elif stat.S_ISREG(mode):
-    return Path_Size((Counter((1, current_stat.st_size)), path, None))
-  elif stat.S_ISBLK(mode):   return Path_Size((Counter((0, 0)), path, None))
-  elif stat.S_ISCHR(mode):   return Path_Size((Counter((0, 0)), path, None))
-  elif stat.S_ISFIFO(mode):  return Path_Size((Counter((0, 0)), path, None))
-  elif stat.S_ISLNK(mode):   return Path_Size((Counter((0, 0)), path, None))
-  elif stat.S_ISSOCK(mode):  return Path_Size((Counter((0, 0)), path, None))
+    stack = [ [ '', iter(path), [], Counter((0, 0)) ] ]
   else:
-    raise Exception("internal error: %r" % (mode,))
+    result = enter(path)
+    if isinstance(result, Path_Size):
+      return result
+    stack = [ result ]
+  while True:  # until the root frame is finished
+    frame = stack[-1]
+    dir_path, entries, results, counter = frame
+    entry = next(entries, None)
+    if entry is None:  # directory finished?
+      stack.pop()
+      result = Path_Size((counter, dir_path, results))
+      if not stack:
+        return result
+      father = stack[-1]
+      father[2].append(result)
+      father[3] += counter
+      continue
+    if target is not None and os.path.isfile(os.path.join(target, entry)):
+      if add_report is not None:
+        add_report("Skipped existing: %s" % entry)
+      continue
+    result = enter(entry)
+    if isinstance(result, Path_Size):
+      results.append(result)
+      frame[3] += result.counter()
+    else:
+      stack.append(result)
 
 last_report_time = 0
 
@@ -465,55 +519,85 @@ class Leaf(Node): pass
 def tree_traverser(tree, depth=False, ancestry=None):
   """
   walks a tree as returned by sizeof_path() and yields positions in that tree
-  (with ancestry); if depth is True then children are handled before the nodes
+  (with ancestry); if depth is True then children are handled before the nodes;
+  an explicit stack is used instead of nested generators, so the overhead per
+  yielded position does not grow with the depth of the tree
   """
   counter, path, contents = tree
   if ancestry is None:
     ancestry = Ancestry((Counter((0, 0)), counter, path, None))
   if contents is None:  # this is just a leaf
     yield Leaf((path, ancestry))
-  else:  # this is a node
-    current_counter, end_counter, father_path, father_ancestry = ancestry
+    return
+  if not depth:
+    yield Node((path, ancestry))
+  current_counter, end_counter, father_path, father_ancestry = ancestry
+  # each frame is [ path, ancestry, ancestry of children, iterator over
+  # children, counter at the start of the next child ]
+  stack = [ [ path, ancestry,
+              Ancestry((current_counter, end_counter, "", ancestry)),
+              iter(contents), current_counter ] ]
+  while stack:
+    frame = stack[-1]
+    path, ancestry, ancestry2, children, current_counter = frame
+    child = next(children, None)
+    if child is None:  # all children handled?
+      stack.pop()
+      if depth:
+        yield Node((path, ancestry))
+      continue
+    end_counter = current_counter + child.counter()
+    ancestry2.set_current_counter(current_counter)
+    ancestry2.set_end_counter(end_counter)
+    ancestry2.set_path(child.path())
+    frame[4] = end_counter
+    if not child.has_contents():  # this is just a leaf
+      yield Leaf((child.path(), ancestry2))
+      continue
     if not depth:
-      yield Node((path, ancestry))
-    ancestry2 = Ancestry((current_counter, end_counter, "", ancestry))
-    for child in contents:
-      end_counter = current_counter + child.counter()
-      ancestry2.set_current_counter(current_counter)
-      ancestry2.set_end_counter(end_counter)
-      ancestry2.set_path(child.path())
-      traverser = tree_traverser(child, depth=depth, ancestry=ancestry2)
-      for node in traverser:
-        yield node
-      current_counter = end_counter
-    if depth:
-      yield Node((path, ancestry))
+      yield Node((child.path(), ancestry2))
+    stack.append([ child.path(), ancestry2,
+                   Ancestry((current_counter, end_counter, "", ancestry2)),
+                   iter(child.contents()), current_counter ])
 
 class Bad_Leaf(Node):  pass
 class Special( Node):  pass
 class File_Open(Leaf):  pass
 class EOF(      Leaf):  pass
 class Data(     Leaf):  pass
+class Unchanged(Leaf):  pass
 
 # the tree_reader_buffer is also used by the consumer of the Data()
 tree_reader_buffer = array.array('b')
 tree_reader_buffer.frombytes(b'-')
 
-def tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None):
+def tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None,
+                unchanged=None, buffer=None):
+  """
+  walks a tree as returned by sizeof_path() like tree_traverser() but reads
+  the files, yielding File_Open, Data, and EOF for each; if a callable
+  unchanged(path, stat) is given and returns True for a file, only an
+  Unchanged node is yielded for it and the file is not read at all; the
+  data is read into the global tree_reader_buffer unless a buffer is given
+  (which allows several readers in parallel)
+  """
   if follow_links is None:  follow_links = False
   stat_fun = os.stat if follow_links else os.lstat
   global tree_reader_buffer
-  tree_reader_buffer = array.array('b')
-  tree_reader_buffer.frombytes(b'-' * chunk_size)
+  if buffer is None:
+    tree_reader_buffer = array.array('b')
+    tree_reader_buffer.frombytes(b'-' * chunk_size)
+    buffer = tree_reader_buffer
   for node in tree_traverser(tree):
     if not isinstance(node, Leaf):
       yield node
       continue  # skip the rest
     path, ancestry = node
     try:
-      mode = stat_fun(path).st_mode
+      file_stat = stat_fun(path)
     except OSError:  # no such file or directory?
       continue
+    mode = file_stat.st_mode
     if (stat.S_ISBLK(mode)  or
         stat.S_ISCHR(mode)  or
         stat.S_ISFIFO(mode) or
@@ -523,6 +607,9 @@ def tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None):
       continue  # skip the rest
     elif stat.S_ISDIR(mode):
       raise Exception("Internal error (dir found as leaf): %r" % (node,))
+    if unchanged is not None and unchanged(path, file_stat):
+      yield Unchanged(node + (file_stat,))
+      continue  # skip the rest
     try:
       f = open(path, 'rb')
     except IOError as e:  # e. g. no read permissions
@@ -533,7 +620,7 @@ def tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None):
     ancestry2 = Ancestry((current_counter, end_counter, "", ancestry))
     while True:  # until EOF
       try:
-        byte_count = f.readinto(tree_reader_buffer)
+        byte_count = f.readinto(buffer)
       except IOError as e:
         yield Bad_Leaf(node + (e, f))
         break  # ingore for now
@@ -548,14 +635,20 @@ def tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None):
 
 class TTY_Input(str):  pass
 
-def interactive_tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None):
-  source = tree_reader(tree, chunk_size=chunk_size, follow_links=follow_links)
+def interactive_tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None,
+                            unchanged=None, buffer=None):
+  source = tree_reader(tree, chunk_size=chunk_size, follow_links=follow_links,
+                       unchanged=unchanged, buffer=buffer)
   current_file = None  # is the file while reading one
-  tty = open('/dev/tty', 'r')
+  try:
+    tty = open('/dev/tty', 'r')
+  except OSError:  # no controlling terminal (cron, ssh, ...), no keys then
+    tty = None
   while True:  # until the source is traversed
     if current_file is not None:
-      r, w, e = select.select([ current_file, tty ], [], [])
-      if tty in r:
+      r, w, e = select.select([ current_file ] +
+                              ([ tty ] if tty is not None else []), [], [])
+      if tty is not None and tty in r:
         key = tty.read(1)
         if key == TTY.esc:  # read esc-sequence
           while True:
@@ -586,7 +679,7 @@ def interactive_tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None):
       if   isinstance(node, File_Open):
         yield node
         path, ancestry, current_file = node
-      elif isinstance(node, Special):
+      elif isinstance(node, (Special, Unchanged)):
         yield node
       elif isinstance(node, Bad_Leaf):
         print('bad leaf: %r' % (node,))  # ignore bad leaves
@@ -596,94 +689,245 @@ def interactive_tree_reader(tree, chunk_size=CHUNK_SIZE, follow_links=None):
       else:
         raise Exception("unexpected node type: %r (%r)" %
                         (node.__class__, node))
-  tty.close()
+  if tty is not None:
+    tty.close()
 
-def copy_tree(tree, target, chunk_size=CHUNK_SIZE, follow_links=None,
-              add_report=None):
-  if follow_links is None:  follow_links = False
-  stat_fun = os.stat if follow_links else os.lstat
-  if add_report is None:  add_report = lambda report: None
+class Transfer_Metrics(object):
+  """
+  thread-safe counter of transferred files and bytes, of problems, and of
+  the seconds spent in operations ('read', 'write', 'metadata'); everything
+  added is also added to the parent (if given), so one Transfer_Metrics can
+  aggregate the metrics of several transfers running in parallel
+  """
+  def __init__(self, parent=None):
+    self.parent = parent
+    self.lock = threading.Lock()
+    self.counter = Counter((0, 0))
+    self.errors = 0
+    self.times = defaultdict(float)
+    self.start_time = time.monotonic()
+
+  def add(self, files=0, byte_count=0):
+    with self.lock:
+      self.counter += Counter((files, byte_count))
+    if self.parent is not None:
+      self.parent.add(files, byte_count)
+
+  def add_error(self):
+    with self.lock:
+      self.errors += 1
+    if self.parent is not None:
+      self.parent.add_error()
+
+  def add_time(self, operation, seconds):
+    with self.lock:
+      self.times[operation] += seconds
+    if self.parent is not None:
+      self.parent.add_time(operation, seconds)
+
+  def get_counter(self):
+    with self.lock:
+      return self.counter
+
+  def get_errors(self):
+    with self.lock:
+      return self.errors
+
+  def get_times(self):
+    with self.lock:
+      return dict(self.times)
+
+  def rate(self):
+    "returns the bytes per second since the creation"
+    elapsed = time.monotonic() - self.start_time
+    return self.get_counter().bytes() / elapsed if elapsed > 0 else 0.0
+
+class Tree_Job(object):
+  """
+  base of Tree_Copier and Tree_Reader; all state (including the read buffer)
+  is kept in the instance, so several jobs can run in parallel threads (or
+  asyncio tasks, see run_async()); progress(path, ancestry) is called for
+  each node, a cancel token (anything with is_set(), e. g. a
+  threading.Event) stops the job when it is set, and the transferred files
+  and bytes are counted in metrics (a Transfer_Metrics, whose parent can
+  aggregate several jobs)
+  """
+  def __init__(self, tree, chunk_size=CHUNK_SIZE, follow_links=None,
+               add_report=None, progress=None, cancel=None, metrics=None):
+    if follow_links is None:  follow_links = False
+    if add_report is None:  add_report = lambda report: None
+    if progress is None:  progress = lambda path, ancestry: None
+    if metrics is None:  metrics = Transfer_Metrics()
+    self.tree = tree
+    self.chunk_size = chunk_size
+    self.follow_links = follow_links
+    self.stat_fun = os.stat if follow_links else os.lstat
+    self.add_report = add_report
+    self.progress = progress
+    self.cancel = cancel
+    self.metrics = metrics
+    self.buffer = bytearray(chunk_size)
+    self.ancestry = None  # of the current node
+
+  def cancelled(self):
+    return self.cancel is not None and self.cancel.is_set()
+
+  def report_problem(self, text):
+    self.metrics.add_error()
+    self.add_report(text)
+
+  def timed_nodes(self, nodes):
+    "yields the given nodes, counting the time to get them as 'read' time"
+    nodes = iter(nodes)
+    while True:
+      start = time.perf_counter()
+      node = next(nodes, None)
+      self.metrics.add_time('read', time.perf_counter() - start)
+      if node is None:
+        break
+      yield node
+
+  async def run_async(self, executor=None):
+    "runs the job in a thread of the executor without blocking the loop"
+    return await asyncio.get_running_loop().run_in_executor(executor,
+                                                            self.run)
+
+class Tree_Reader(Tree_Job):
+  """
+  reads all files of a tree as returned by sizeof_path() (see Tree_Job);
+  consume(path, data) is called for each chunk read with a memoryview which
+  is valid only during the call
+  """
+  def __init__(self, tree, consume=None, **options):
+    Tree_Job.__init__(self, tree, **options)
+    self.consume = consume
+
+  def run(self):
+    "reads everything (unless cancelled); returns the metrics"
+    view = memoryview(self.buffer)
+    for node in self.timed_nodes(tree_reader(
+        self.tree, follow_links=self.follow_links, buffer=self.buffer)):
+      if self.cancelled():
+        break
+      if isinstance(node, Bad_Leaf):
+        self.report_problem("Bad leaf: %r" % (node,))
+        continue
+      path, self.ancestry = node[:2]
+      if   isinstance(node, Data):
+        path, ancestry, f, byte_count = node
+        if self.consume is not None:
+          self.consume(path, view[:byte_count])
+        self.metrics.add(0, byte_count)
+      elif isinstance(node, EOF):
+        self.metrics.add(1, 0)
+      self.progress(path, self.ancestry)
+    return self.metrics
+
+class Tree_Copier(Tree_Job):
+  """
+  copies a tree as returned by sizeof_path() into a target (see Tree_Job
+  and copy_tree() for the details); run() copies everything, handle() can
+  be used to feed the nodes of a tree_reader() (reading into the buffer of
+  this copier) one by one, then finish() must be called
+  """
+  def __init__(self, tree, target, remove_source=False, link_dest=None,
+               **options):
+    Tree_Job.__init__(self, tree, **options)
+    self.target = target
+    self.sink = None if isinstance(target, str) else target
+    if link_dest is not None and self.sink is not None:
+      raise Exception("link_dest needs a target directory, not %r" % target)
+    self.remove_source = remove_source
+    self.link_dest = link_dest
+    self.linked = Counter((0, 0))
+    self.copied = Counter((0, 0))
+    self.current_out_file = None  # None, 'skip', or the open file
+    self.stats_to_update_later = []
+    self.source_dirs = []
+
+  def nodes(self):
+    return tree_reader(self.tree, follow_links=self.follow_links,
+                       unchanged=self.unchanged_option(), buffer=self.buffer)
+
+  def unchanged_option(self):
+    return self.unchanged if self.link_dest is not None else None
+
+  def run(self):
+    "copies everything (unless cancelled); returns the metrics"
+    for node in self.timed_nodes(self.nodes()):
+      if self.cancelled():
+        self.stop()
+        break
+      self.handle(node)
+    self.finish()
+    return self.metrics
 
-  def preserve_stats(orig_stat, target):
+  def preserve_stats(self, orig_stat, target):
     try:
       os.lchown(target, orig_stat.st_uid, orig_stat.st_gid)
     except OSError:  # Operation not permitted
-      add_report("Could not chown %r to %d.%d" %
-                 (target, orig_stat.st_uid, orig_stat.st_gid))
+      self.report_problem("Could not chown %r to %d.%d" %
+                         (target, orig_stat.st_uid, orig_stat.st_gid))
     try:
       os.chmod(target, orig_stat.st_mode)
     except OSError:  # Operation not permitted
-      add_report("Could not chmod %r to %o" %
-                 (target, orig_stat.st_mode))
+      self.report_problem("Could not chmod %r to %o" %
+                         (target, orig_stat.st_mode))
     try:
-      os.utime(target, (orig_stat.st_atime, orig_stat.st_mtime))
+      os.utime(target, ns=(orig_stat.st_atime_ns, orig_stat.st_mtime_ns))
     except OSError:  # Operation not permitted
-      add_report("Could not utime %r to %d/%d" %
-                 (target, orig_stat.st_atime, orig_stat.st_mtime))
-
-  message = [ "" ]
-  time_of_last_message = [ 0.0 ]
-
-  def set_message(new_message):
-    message[0] = new_message
-    time_of_last_message[0] = time.time()
-
-  def get_message():
-    if time_of_last_message[0] < time.time() - 5.0:
-      return ""
-    else:
-      return message[0]
-
-  delay = 0.0
+      self.report_problem("Could not utime %r to %d/%d" %
+                         (target, orig_stat.st_atime, orig_stat.st_mtime))
 
-  def set_delay_message(direction):
-    if delay >= 1.0:
-      set_message("delay %s to %.2fs" % (direction, delay))
-    else:
-      set_message("delay %s to %dms" % (direction, int(delay * 1000)))
+  def remove_source_path(self, path):
+    try:
+      os.unlink(path)
+    except OSError as problem:
+      self.report_problem("Could not remove %r: %s" % (path, problem))
 
-  global tree_reader_buffer
-  current_out_file = None
-  ancestry = None
-  stats_to_update_later = []
-  for node in interactive_tree_reader(tree, chunk_size=chunk_size,
-      follow_links=follow_links):
-    if delay > 0.0:
-      time.sleep(delay)
-    if   isinstance(node, TTY_Input):  # input from user?
-      command = node
-      if   command == 'q':  # quit
-        if current_out_file is not None:
-          current_out_file.close()
-        break
-      elif command == ' ':  # pause
-        sys.stdout.write(
-          TTY.home + "Paused.  Press any key to continue ...\n")
-        sys.stdin.read(1)
-        set_message("continued")
-      elif command == 'p':  # plot
-        if ancestry is not None:
-          ancestry.plot()
-      elif command == 'd':  # increase delay
-        if delay == 0.0:
-          delay = 1.0 / 64
-        else:
-          delay *= 1.25
-        set_delay_message("increased")
-      elif command == 'D':  # decrease delay
-        if delay <= 1.0 / 64:
-          delay = 0.0
-          set_message("delay disabled")
-        else:
-          delay /= 1.25
-          set_delay_message("decreased")
-      else:
-        set_message("key not bound: %r" % command)
-    elif isinstance(node, File_Open):  # next file?
-      if current_out_file is not None:
+  def unchanged(self, path, file_stat):
+    "tells whether the file is found unchanged in the link_dest directory"
+    try:
+      previous_stat = os.lstat(self.link_dest + '/' + path)
+    except OSError:  # not in previous backup?
+      return False
+    return (stat.S_ISREG(previous_stat.st_mode) and
+            previous_stat.st_size == file_stat.st_size and
+            int(previous_stat.st_mtime) == int(file_stat.st_mtime) and
+            previous_stat.st_mode == file_stat.st_mode and
+            previous_stat.st_uid == file_stat.st_uid and
+            previous_stat.st_gid == file_stat.st_gid)
+
+  def stop(self):
+    "stops copying (the current file stays incomplete)"
+    if self.sink is not None:
+      self.sink.abort()
+      self.sink = None
+    elif self.current_out_file not in (None, 'skip'):
+      self.current_out_file.close()
+    self.current_out_file = None
+
+  def handle(self, node):
+    "handles a node, counting the time as 'write' or 'metadata' time"
+    start = time.perf_counter()
+    try:
+      self.handle_node(node)
+    finally:
+      self.metrics.add_time('write' if isinstance(node, Data) else 'metadata',
+                            time.perf_counter() - start)
+
+  def handle_node(self, node):
+    target = self.target
+    sink = self.sink
+    add_report = self.report_problem
+    if isinstance(node, File_Open):  # next file?
+      if self.current_out_file is not None:
         raise Exception("Internal error: File_Open while file is open")
-      path, ancestry, f = node
-      report(path, ancestry, get_message())
+      path, self.ancestry, f = node
+      self.progress(path, self.ancestry)
+      if sink is not None:
+        self.current_out_file = sink.open_file(path, os.fstat(f.fileno()))
+        return
       file_name = target + '/' + path
       try:
         os.makedirs('/'.join(file_name.split('/')[:-1]))
@@ -692,48 +936,94 @@ def copy_tree(tree, target, chunk_size=CHUNK_SIZE, follow_links=None,
       try:
         os.lstat(file_name)
       except:  # as expected:  No such File
-        temporary_file_name = file_name + '.part'
+        self.file_name = file_name
         try:
-          current_out_file = open(temporary_file_name, 'wb')
+          self.current_out_file = open(file_name + '.part', 'wb')
         except IOError:  # cannot create file?
-          add_report("Could not create file %r" % temporary_file_name)
-          current_out_file = 'skip'
+          add_report("Could not create file %r" % (file_name + '.part'))
+          self.current_out_file = 'skip'
       else:  # oops, file exists?
-        current_out_file = 'skip'
+        self.current_out_file = 'skip'
         # ^^^ we mark us to speed up things (do read, do not write)
     elif isinstance(node, Data):    # next chunk of data?
-      if current_out_file is None:
+      if self.current_out_file is None:
         raise Exception("Internal error: Data without out-file")
-      path, ancestry, f, byte_count = node
-      report(path, ancestry, get_message())
-      if current_out_file != 'skip':
-        if byte_count != chunk_size:
-          current_out_file.write(
-            tree_reader_buffer.tobytes()[:byte_count])
-        else:
-          tree_reader_buffer.tofile(current_out_file)
+      path, self.ancestry, f, byte_count = node
+      self.progress(path, self.ancestry)
+      if self.current_out_file != 'skip':  # no copy of the data needed:
+        self.current_out_file.write(memoryview(self.buffer)[:byte_count])
+        self.copied += Counter((0, byte_count))
+        self.metrics.add(0, byte_count)
     elif isinstance(node, EOF):     # end of current file?
-      if current_out_file is None:
+      if self.current_out_file is None:
         raise Exception("Internal error: Data without out-file")
-      path, ancestry, f = node
-      report(path, ancestry, get_message())
-      if current_out_file != 'skip':
-        current_out_file.close()
-        os.rename(temporary_file_name, file_name)
-        preserve_stats(stat_fun(path), file_name)
-      current_out_file = None
+      path, self.ancestry, f = node
+      self.progress(path, self.ancestry)
+      if sink is not None:
+        self.current_out_file.close()
+        self.metrics.add(1, 0)
+      elif self.current_out_file != 'skip':
+        if self.remove_source:  # make sure the copy is on disk before
+          self.current_out_file.flush()
+          os.fsync(self.current_out_file.fileno())
+        self.current_out_file.close()
+        os.rename(self.file_name + '.part', self.file_name)
+        self.preserve_stats(self.stat_fun(path), self.file_name)
+        self.copied += Counter((1, 0))
+        self.metrics.add(1, 0)
+        if self.remove_source:
+          self.remove_source_path(path)
+      self.current_out_file = None
+    elif isinstance(node, Unchanged):  # found in link_dest?
+      path, self.ancestry, file_stat = node
+      self.progress(path, self.ancestry)
+      file_name = target + '/' + path
+      try:
+        os.makedirs('/'.join(file_name.split('/')[:-1]))
+      except OSError:  # File exists
+        pass  # ignore
+      if os.path.lexists(file_name):
+        return  # do not overwrite existing files
+      try:
+        os.link(self.link_dest + '/' + path, file_name)
+      except OSError as problem:  # e. g. too many links, other device
+        add_report("Could not link %r, copying it: %s" % (file_name, problem))
+        try:
+          shutil.copyfile(path, file_name + '.part')
+          os.rename(file_name + '.part', file_name)
+        except OSError as problem:  # unreadable source, disk full?
+          add_report("Could not copy %r: %s" % (file_name, problem))
+          try:
+            os.unlink(file_name + '.part')
+          except OSError:  # not created
+            pass  # ignore
+          return
+        self.preserve_stats(file_stat, file_name)
+        self.copied += Counter((1, file_stat.st_size))
+      else:
+        self.linked += Counter((1, file_stat.st_size))
+      self.metrics.add(1, file_stat.st_size)
+      if self.remove_source:
+        self.remove_source_path(path)
     elif isinstance(node, Special):   # device/link/fifo/socket?
-      if current_out_file is not None:
+      if self.current_out_file is not None:
         raise Exception("Internal error: Special encountered while writing"
                         " file: %r" % (node,))
-      path, ancestry = node
-      report(path, ancestry, get_message())
+      path, self.ancestry = node
+      self.progress(path, self.ancestry)
+      if sink is not None:
+        if stat.S_ISLNK(self.stat_fun(path).st_mode):
+          sink.add_symlink(path, self.stat_fun(path))
+        else:
+          add_report("UNIMPLEMENTED: Cannot store special file yet: %r" %
+                     (node,))
+        return
       file_name = target + '/' + path
       #try:
       #  os.makedirs('/'.join(file_name.split('/')[:-1]))
       #except OSError:  # File exists
       #  pass  # ignore
-      mode = stat_fun(path).st_mode
+      mode = self.stat_fun(path).st_mode
       if   stat.S_ISLNK(mode):
         link_source = target + '/' + path
         link_target = os.readlink(path)
@@ -742,31 +1032,397 @@ def copy_tree(tree, target, chunk_size=CHUNK_SIZE, follow_links=None,
         except OSError:  # File exists?
           add_report("Could not create symlink to %r at %r" %
                      (link_target, link_source))
+        else:
+          if self.remove_source:
+            self.remove_source_path(path)
       else:
         add_report("UNIMPLEMENTED: Cannot handle special file yet: %r" %
                    (node,))
     elif isinstance(node, Bad_Leaf):  # error?
       add_report("Bad leaf: %r (%s)" % (node, target))
-      if current_out_file is None:
+      if self.current_out_file is None:
         raise Exception("Internal error: Data without out-file")
-      if current_out_file != 'skip':
-        current_out_file.close()
-      current_out_file = None
+      if sink is not None:
+        self.current_out_file.abort()
+      elif self.current_out_file != 'skip':
+        self.current_out_file.close()
+      self.current_out_file = None
     elif not isinstance(node, Leaf):  # directory?
       path, ancestry = node
       if path != '':
-        report(path, ancestry, get_message())
+        self.ancestry = ancestry
+        self.progress(path, ancestry)
+      if path != '' and sink is not None:
+        sink.add_directory(path, self.stat_fun(path))
+      elif path != '':
         dir_path = target + '/' + path
         try:
           os.makedirs(dir_path)
         except OSError:  # file exists?
           add_report("Could not make dir: %r" % dir_path)
-        stats_to_update_later.append((stat_fun(path), dir_path))
+        self.stats_to_update_later.append((self.stat_fun(path), dir_path))
+        self.source_dirs.append(path)
     else:
       raise Exception("Internal error: unexpected node type: %r (%r)" %
                       (node.__class__, node))
-  for status, path in reversed(stats_to_update_later):
-    preserve_stats(status, path)
+
+  def finish(self):
+    "sets the stats of the directories, closes the sink, and reports"
+    for status, path in reversed(self.stats_to_update_later):
+      self.preserve_stats(status, path)
+    if self.sink is not None:
+      self.add_report(self.sink.close())
+      self.sink = None
+    if self.link_dest is not None:
+      self.add_report(
+        "Linked %d files (%d bytes), copied %d files (%d bytes)" %
+        (self.linked.files(), self.linked.bytes(),
+         self.copied.files(), self.copied.bytes()))
+    if self.remove_source:
+      for path in reversed(self.source_dirs):  # children before fathers
+        try:
+          os.rmdir(path)
+        except OSError as problem:  # not empty (skipped files)?
+          self.report_problem("Could not remove dir %r: %s" %
+                              (path, problem))
+
+class Metrics_Exporter(object):
+  """
+  writes the state of a Tree_Copier (or Tree_Reader) every interval seconds
+  into a file, either as a Prometheus textfile (replaced atomically) or, if
+  the path ends in '.jsonl', by appending one JSON line (a time series);
+  use start() and stop() (or a with statement)
+  """
+  def __init__(self, path, job, interval=15.0, name=None):
+    self.path = path
+    self.job = job
+    self.interval = interval
+    self.labels = '{copy="%s"}' % name if name else ''
+    self.stopping = threading.Event()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.last = (self.job.metrics.start_time, Counter((0, 0)))
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.stopping.set()
+    self.thread.join()
+
+  def run(self):
+    while not self.stopping.wait(self.interval):
+      self.export()
+    self.export()  # the final state
+
+  def values(self):
+    metrics = self.job.metrics
+    now = time.monotonic()
+    counter = metrics.get_counter()
+    last_time, last_counter = self.last
+    self.last = now, counter
+    total = self.job.tree.counter()
+    ancestry = self.job.ancestry
+    position = ancestry[0].bytes() if ancestry is not None else 0
+    elapsed = now - metrics.start_time
+    values = dict(
+      time=time.time(),
+      files=counter.files(), bytes=counter.bytes(),
+      files_expected=total.files(), bytes_expected=total.bytes(),
+      rate=((counter.bytes() - last_counter.bytes()) / (now - last_time)
+            if now > last_time else 0.0),
+      eta=(elapsed * (total.bytes() - position) / position
+           if position > 0 else None),
+      errors=metrics.get_errors(),
+      depth=ancestry.get_depth() if ancestry is not None else 0)
+    for operation, seconds in metrics.get_times().items():
+      values[operation + '_seconds'] = seconds
+    return values
+
+  def export(self):
+    values = self.values()
+    if self.path.endswith('.jsonl'):
+      fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+      try:
+        os.write(fd, (json.dumps(values) + '\n').encode('utf-8'))
+      finally:
+        os.close(fd)
+      return
+    lines = []
+    for key, kind, help_text in (
+        ('files', 'counter', "files copied"),
+        ('bytes', 'counter', "bytes copied"),
+        ('files_expected', 'gauge', "files to copy in total"),
+        ('bytes_expected', 'gauge', "bytes to copy in total"),
+        ('rate', 'gauge', "bytes per second since the last export"),
+        ('eta', 'gauge', "seconds until the copy is estimated to be done"),
+        ('errors', 'counter', "problems reported"),
+        ('depth', 'gauge', "depth of the current path in the tree")):
+      if values[key] is None:
+        continue
+      name = 'directories_copy_' + key
+      lines.append('# HELP %s %s' % (name, help_text))
+      lines.append('# TYPE %s %s' % (name, kind))
+      lines.append('%s%s %s' % (name, self.labels, values[key]))
+    name = 'directories_copy_seconds'
+    lines.append('# HELP %s seconds spent by operation' % name)
+    lines.append('# TYPE %s counter' % name)
+    for operation in ('read', 'write', 'metadata'):
+      labels = ('{operation="%s"%s' % (operation, self.labels[:-1] and
+                                       ',' + self.labels[1:-1]) + '}')
+      lines.append('%s%s %s' % (name, labels,
+                                values.get(operation + '_seconds', 0.0)))
+    temporary_path = self.path + '.part'
+    with open(temporary_path, 'w') as textfile:
+      textfile.write('\n'.join(lines) + '\n')
+    os.rename(temporary_path, self.path)
+
+def copy_tree(tree, target, chunk_size=CHUNK_SIZE, follow_links=None,
+              add_report=None, remove_source=False, link_dest=None,
+              metrics=None, export_metrics=None, export_interval=15.0):
+  """
+  copies a tree as returned by sizeof_path() into the target directory
+  while displaying the progress on the terminal and reacting on keys (see
+  Tree_Copier for copying without a terminal); existing files are skipped;
+  if remove_source is True, each source file is removed as soon as its copy
+  is complete (so space is freed during the transfer) and emptied source
+  directories are removed at the end; if a link_dest directory (e. g. a
+  previous backup) is given, files found there with the same size, mtime
+  (in seconds), mode, and owner are hardlinked from there instead of being
+  read and written again; instead of a directory, the target can also be a
+  sink like Chunk_Snapshot (to store the tree in a chunk store) or
+  Stream_Writer (to serialize it into a stream); if export_metrics is a
+  path, a Metrics_Exporter writes the state there while copying
+  """
+  message = [ "" ]
+  time_of_last_message = [ 0.0 ]
+
+  def set_message(new_message):
+    message[0] = new_message
+    time_of_last_message[0] = time.time()
+
+  def get_message():
+    if time_of_last_message[0] < time.time() - 5.0:
+      return ""
+    else:
+      return message[0]
+
+  delay = 0.0
+
+  def set_delay_message(direction):
+    if delay >= 1.0:
+      set_message("delay %s to %.2fs" % (direction, delay))
+    else:
+      set_message("delay %s to %dms" % (direction, int(delay * 1000)))
+
+  copier = Tree_Copier(
+    tree, target, remove_source=remove_source, link_dest=link_dest,
+    chunk_size=chunk_size, follow_links=follow_links, add_report=add_report,
+    progress=lambda path, ancestry: report(path, ancestry, get_message()),
+    metrics=metrics)
+  exporter = None
+  if export_metrics is not None:
+    exporter = Metrics_Exporter(export_metrics, copier, export_interval)
+    exporter.start()
+  try:
+    for node in copier.timed_nodes(interactive_tree_reader(
+        tree, chunk_size=chunk_size, follow_links=copier.follow_links,
+        unchanged=copier.unchanged_option(), buffer=copier.buffer)):
+      if delay > 0.0:
+        time.sleep(delay)
+      if   isinstance(node, TTY_Input):  # input from user?
+        command = node
+        if   command == 'q':  # quit
+          copier.stop()
+          break
+        elif command == ' ':  # pause
+          sys.stdout.write(
+            TTY.home + "Paused.  Press any key to continue ...\n")
+          sys.stdin.read(1)
+          set_message("continued")
+        elif command == 'p':  # plot
+          if copier.ancestry is not None:
+            copier.ancestry.plot()
+        elif command == 'd':  # increase delay
+          if delay == 0.0:
+            delay = 1.0 / 64
+          else:
+            delay *= 1.25
+          set_delay_message("increased")
+        elif command == 'D':  # decrease delay
+          if delay <= 1.0 / 64:
+            delay = 0.0
+            set_message("delay disabled")
+          else:
+            delay /= 1.25
+            set_delay_message("decreased")
+        else:
+          set_message("key not bound: %r" % command)
+      else:
+        copier.handle(node)
+    copier.finish()
+  finally:
+    if exporter is not None:
+      exporter.stop()
+  return copier.metrics
+
+SIZE_CLASSES = [ ('<4K', 1 << 12), ('4K-64K', 1 << 16), ('64K-1M', 1 << 20),
+                 ('1M-64M', 1 << 26), ('>64M', None) ]
+# ^^^ names and (exclusive) upper limits of the file size classes
+
+def percentiles(values, points=(50, 90, 99)):
+  "returns a dict of the given percentiles (nearest rank) and the maximum"
+  values = sorted(values)
+  if not values:
+    return {}
+  result = { 'p%d' % point: values[min(len(values) - 1,
+                                       len(values) * point // 100)]
+             for point in points }
+  result['max'] = values[-1]
+  return result
+
+def drop_caches(tree, cold):
+  """
+  makes sure the files in the tree are not cached: 'drop' drops all caches
+  of the system (needs root), 'fadvise' tells the kernel to forget the
+  cached pages of each file
+  """
+  if cold == 'drop':
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as drop_caches_file:
+      drop_caches_file.write('3\n')
+  elif cold == 'fadvise':
+    for leaf in tree_leaves(tree):
+      if leaf.counter().files() != 1:
+        continue
+      try:
+        fd = os.open(leaf.path(), os.O_RDONLY)
+      except OSError:  # e. g. no read permissions
+        continue
+      try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+      finally:
+        os.close(fd)
+  elif cold is not None:
+    raise Exception("unknown cold cache method: %r" % cold)
+
+def benchmark_read(tree, chunk_size=CHUNK_SIZE, cold=None, add_report=None):
+  """
+  reads all files of a tree as returned by sizeof_path() and returns a dict
+  (to be written as JSON) with files/sec, MB/sec, and percentiles of the
+  latencies of open, read (all of a file), and close for each class of file
+  sizes (see SIZE_CLASSES); cold (see drop_caches()) is applied first
+  """
+  if add_report is None:  add_report = lambda report: None
+  drop_caches(tree, cold)
+  buffer = bytearray(chunk_size)
+  classes = { name: dict(files=0, bytes=0, seconds=0.0,
+                         latencies=dict(open=[], read=[], close=[]))
+              for name, limit in SIZE_CLASSES }
+  start_time = time.time()
+  for leaf in tree_leaves(tree):
+    if leaf.counter().files() != 1:  # no regular file?
+      continue
+    t0 = time.perf_counter()
+    try:
+      f = open(leaf.path(), 'rb', buffering=0)
+    except OSError as problem:
+      add_report("Could not open %r: %s" % (leaf.path(), problem))
+      continue
+    t1 = time.perf_counter()
+    size = 0
+    try:
+      while True:  # until EOF
+        byte_count = f.readinto(buffer)
+        if not byte_count:
+          break
+        size += byte_count
+    except OSError as problem:
+      add_report("Could not read %r: %s" % (leaf.path(), problem))
+    t2 = time.perf_counter()
+    f.close()
+    t3 = time.perf_counter()
+    for name, limit in SIZE_CLASSES:
+      if limit is None or size < limit:
+        break
+    size_class = classes[name]
+    size_class['files'] += 1
+    size_class['bytes'] += size
+    size_class['seconds'] += t3 - t0
+    size_class['latencies']['open'].append(t1 - t0)
+    size_class['latencies']['read'].append(t2 - t1)
+    size_class['latencies']['close'].append(t3 - t2)
+  duration = time.time() - start_time
+  result = dict(host=os.uname().nodename, paths=tree.path() or
+                [ child.path() for child in tree.contents() or () ],
+                start_time=start_time, duration=duration,
+                chunk_size=chunk_size, cold=cold, classes={})
+  total_files = total_bytes = 0
+  for name, limit in SIZE_CLASSES:
+    size_class = classes[name]
+    seconds = size_class['seconds']
+    result['classes'][name] = dict(
+      files=size_class['files'], bytes=size_class['bytes'], seconds=seconds,
+      files_per_second=size_class['files'] / seconds if seconds else None,
+      mb_per_second=size_class['bytes'] / 1e6 / seconds if seconds else None,
+      latency={ operation: percentiles(latencies)
+                for operation, latencies in size_class['latencies'].items() })
+    total_files += size_class['files']
+    total_bytes += size_class['bytes']
+  result['files'] = total_files
+  result['bytes'] = total_bytes
+  result['files_per_second'] = total_files / duration if duration else None
+  result['mb_per_second'] = total_bytes / 1e6 / duration if duration else None
+  return result
+
+def move_tree(path, target, add_report=None):
+  """
+  moves the given path to target + '/' + path (where copy_tree() would copy
+  it) using os.rename(), so whole subtrees are moved at once; if the
+  destination already is a directory, the contents are moved one by one
+  instead, and existing files are skipped; returns the paths which could not
+  be renamed because they are on a different file system than the target
+  (so they can be copied instead)
+  """
+  if add_report is None:  add_report = lambda report: None
+  stack = [ path ]
+  merged_dirs = []
+  cross_device = []
+  while stack:
+    source = stack.pop()
+    destination = target + '/' + source
+    try:
+      os.makedirs(os.path.dirname(destination))
+    except OSError:  # File exists
+      pass  # ignore
+    if not os.path.lexists(destination):
+      try:
+        os.rename(source, destination)
+      except OSError as problem:
+        if problem.errno == errno.EXDEV:  # e. g. a bind mount
+          cross_device.append(source)
+        else:
+          add_report("Could not move %r to %r: %s" %
+                     (source, destination, problem))
+    elif (os.path.isdir(destination) and not os.path.islink(destination) and
+          os.path.isdir(source) and not os.path.islink(source)):
+      merged_dirs.append(source)
+      stack.extend(source + '/' + name
+                   for name in reversed(sorted_listing(source)))
+    else:
+      add_report("Skipped existing: %s" % source)
+  for source in reversed(merged_dirs):  # children before their fathers
+    try:
+      os.rmdir(source)
+    except OSError as problem:  # not empty (skipped files)?
+      add_report("Could not remove dir %r: %s" % (source, problem))
+  return cross_device
 
 def read_tree(tree):
   message = [ "" ]
@@ -838,35 +1494,1537 @@ def read_tree(tree):
       path, ancestry, f, byte_count = node
       report(path, ancestry, get_message(), cursor_pos)
 
+##########  checksums and duplicates  ##########
+
+def file_digest(path, sample_size=None, chunk_size=CHUNK_SIZE):
+  """
+  returns the md5 hex digest of the contents of the file at the given path;
+  if a sample_size is given, only that many bytes of the head and of the tail
+  of the file are taken into account (plus the size of the file)
+  """
+  digest = hashlib.md5()
+  buffer = bytearray(chunk_size)
+  view = memoryview(buffer)
+  with open(path, 'rb', buffering=0) as f:
+    if sample_size is None:
+      while True:  # until EOF
+        byte_count = f.readinto(buffer)
+        if not byte_count:
+          break
+        digest.update(view[:byte_count])
+    else:
+      size = os.fstat(f.fileno()).st_size
+      for offset in ((0, max(size - sample_size, sample_size))
+                     if size > sample_size else (0,)):
+        f.seek(offset)
+        remaining = sample_size
+        while remaining > 0:
+          byte_count = f.readinto(view[:min(remaining, chunk_size)])
+          if not byte_count:
+            break
+          digest.update(view[:byte_count])
+          remaining -= byte_count
+      digest.update(b'%d' % size)
+  return digest.hexdigest()
+
+def special_digest(path):
+  """
+  returns a digest for anything but a regular file: for a symlink it is
+  derived from its target, for devices, fifos, and sockets from their type;
+  returns None if the path vanished
+  """
+  try:
+    mode = os.lstat(path).st_mode
+    if stat.S_ISLNK(mode):
+      text = 'symlink\0%s' % os.readlink(path)
+    else:
+      text = 'special\0%o' % stat.S_IFMT(mode)
+  except OSError:  # vanished?
+    return None
+  return hashlib.md5(text.encode('utf-8', 'surrogateescape')).hexdigest()
+
+def tree_leaves(tree):
+  "yields all leaves (Path_Size without contents) of a tree, depth first"
+  stack = [ iter([ tree ]) ]
+  while stack:
+    node = next(stack[-1], None)
+    if node is None:
+      stack.pop()
+    elif node.has_contents():
+      stack.append(iter(node.contents()))
+    else:
+      yield node
+
+def tree_digests(tree, leaf_digest):
+  """
+  walks a tree as returned by sizeof_path() and yields tuples of (Path_Size,
+  digest) for each element, children before their directories (Merkle
+  style); leaf_digest(leaf) gives the digest of a leaf, the digest of a
+  directory is derived from the sorted names and digests of its children;
+  if leaf_digest returns None for any child, the digest of all directories
+  above will be None as well
+  """
+  # each frame is [ node, iterator over children, (name, digest) of children ]
+  stack = [ [ tree, iter(tree.contents() or ()), [] ] ]
+  while stack:
+    node, children, digests = stack[-1]
+    child = next(children, None) if node.has_contents() else None
+    if child is not None:
+      stack.append([ child, iter(child.contents() or ()), [] ])
+      continue
+    stack.pop()
+    if not node.has_contents():
+      digest = leaf_digest(node)
+    elif any(child_digest is None for name, child_digest in digests):
+      digest = None
+    else:
+      directory_digest = hashlib.md5()
+      for name, child_digest in sorted(digests):
+        directory_digest.update(('%s\0%s\n' % (name, child_digest))
+                                .encode('utf-8', 'surrogateescape'))
+      digest = directory_digest.hexdigest()
+    if stack:
+      stack[-1][2].append((node.path().split('/')[-1], digest))
+    yield node, digest
+
+def find_duplicates(tree, sample_size=SAMPLE_SIZE, threads=DIGEST_THREADS,
+                    add_report=None):
+  """
+  finds duplicate files and directories in a tree as returned by
+  sizeof_path() and returns a list of (size, digest, paths) tuples, largest
+  first; files are grouped by size first, then by a checksum of their head
+  and tail, and only the remaining candidates are read completely; the
+  paths in each group are sorted, and paths below a duplicate directory
+  which would be reclaimed anyway are left out
+  """
+  if add_report is None:  add_report = lambda report: None
+
+  def regroup(pool, groups, digest_fun):
+    "splits each group of paths into groups of paths with equal digests"
+    futures = { path: pool.submit(digest_fun, path)
+                for group in groups for path in group }
+    result = []
+    for group in groups:
+      by_digest = defaultdict(list)
+      for path in group:
+        try:
+          by_digest[futures[path].result()].append(path)
+        except OSError as problem:
+          add_report("Could not read %r: %s" % (path, problem))
+      result.extend((digest, paths) for digest, paths in by_digest.items()
+                    if len(paths) > 1)
+    return result
+
+  by_size = defaultdict(list)
+  for leaf in tree_leaves(tree):
+    if leaf.counter().files() == 1 and leaf.counter().bytes() > 0:
+      by_size[leaf.counter().bytes()].append(leaf.path())
+  full_digests = {}  # path -> digest, only for files having duplicates
+  with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+    # files not larger than head plus tail are read completely right away:
+    small = [ paths for size, paths in by_size.items()
+              if len(paths) > 1 and size <= 2 * sample_size ]
+    large = [ paths for size, paths in by_size.items()
+              if len(paths) > 1 and size > 2 * sample_size ]
+    large = [ paths for digest, paths in regroup(
+                pool, large, lambda path: file_digest(path, sample_size)) ]
+    for digest, paths in regroup(pool, small + large, file_digest):
+      for path in paths:
+        full_digests[path] = digest
+
+  empty_digest = hashlib.md5(b'').hexdigest()
+
+  def leaf_digest(leaf):
+    if leaf.path() in full_digests:
+      return full_digests[leaf.path()]
+    if leaf.counter().files() == 1:  # unique regular file?
+      return None if leaf.counter().bytes() > 0 else empty_digest
+    return special_digest(leaf.path())
+
+  groups = defaultdict(list)
+  for node, digest in tree_digests(tree, leaf_digest):
+    if (digest is not None and node.path() != '' and
+        node.counter().bytes() > 0):
+      groups[node.counter().bytes(), digest].append(node.path())
+  groups = { key: sorted(paths) for key, paths in groups.items()
+             if len(paths) > 1 }
+  # all but the first path of a group can be reclaimed; drop everything
+  # below those so nothing is counted twice:
+  reclaimed = set()
+  for key, paths in sorted(groups.items(), key=lambda item: -item[0][0]):
+    paths = [ path for path in paths
+              if not any(prefix in reclaimed
+                         for prefix in path_prefixes(path)) ]
+    groups[key] = paths
+    reclaimed.update(paths[1:])
+  return sorted(((size, digest, paths)
+                 for (size, digest), paths in groups.items()
+                 if len(paths) > 1),
+                key=lambda group: (-group[0] * (len(group[2]) - 1), group[2]))
+
+class Checksum_Cache(object):
+  """
+  persistent mapping of (st_dev, st_ino, size, mtime_ns) of files to their
+  digests, so that unchanged files need not be read again; digests of
+  samples and of full contents are kept apart
+  """
+  def __init__(self, path=CHECKSUM_CACHE, sample_size=None):
+    self.kind = 'full' if sample_size is None else 'sample%d' % sample_size
+    if path:
+      directory = os.path.dirname(path)
+      if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+      self.db = dbm.open(path, 'c')
+    else:  # no persistence wanted
+      self.db = {}
+    self.used = set()
+    self.hits = self.misses = 0
+
+  def key(self, file_stat):
+    return ('%s %d %d %d %d' % (self.kind, file_stat.st_dev, file_stat.st_ino,
+                                file_stat.st_size, file_stat.st_mtime_ns)
+           ).encode('ascii')
+
+  def get(self, file_stat):
+    key = self.key(file_stat)
+    try:
+      digest = self.db[key]
+    except KeyError:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.used.add(key)
+    return digest.decode('ascii') if isinstance(digest, bytes) else digest
+
+  def set(self, file_stat, digest):
+    key = self.key(file_stat)
+    self.db[key] = digest
+    self.used.add(key)
+
+  def prune(self):
+    "forgets all entries (of this kind) which have not been used"
+    prefix = (self.kind + ' ').encode('ascii')
+    for key in list(self.db.keys()):
+      if key.startswith(prefix) and key not in self.used:
+        del self.db[key]
+
+  def close(self):
+    if hasattr(self.db, 'close'):
+      self.db.close()
+
+def tree_checksums(tree, sample_size=SAMPLE_SIZE, cache=None,
+                   threads=DIGEST_THREADS, follow_links=None, add_report=None):
+  """
+  yields tuples of (Path_Size, digest) for each element of a tree as returned
+  by sizeof_path(), children before their directories (see tree_digests());
+  files are checksummed by a thread pool (fully if sample_size is None, by
+  head and tail otherwise) unless the given Checksum_Cache knows them; the
+  digest of an unreadable file (and of all directories above it) is None
+  """
+  if follow_links is None:  follow_links = False
+  stat_fun = os.stat if follow_links else os.lstat
+  if add_report is None:  add_report = lambda report: None
+  if cache is None:  cache = Checksum_Cache(None, sample_size)
+  digests = {}
+  pending = deque()  # (path, stat, future), bounded to keep memory low
+
+  def finish(path, file_stat, future):
+    try:
+      digests[path] = future.result()
+    except OSError as problem:
+      add_report("Could not read %r: %s" % (path, problem))
+    else:
+      cache.set(file_stat, digests[path])
+
+  with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+    for leaf in tree_leaves(tree):
+      if leaf.counter().files() != 1:  # no regular file?
+        continue
+      try:
+        file_stat = stat_fun(leaf.path())
+      except OSError as problem:
+        add_report("Could not stat %r: %s" % (leaf.path(), problem))
+        continue
+      digest = cache.get(file_stat)
+      if digest is not None:
+        digests[leaf.path()] = digest
+        continue
+      pending.append((leaf.path(), file_stat,
+                      pool.submit(file_digest, leaf.path(), sample_size)))
+      if len(pending) > 4 * threads:
+        finish(*pending.popleft())
+    while pending:
+      finish(*pending.popleft())
+
+  def leaf_digest(leaf):
+    if leaf.counter().files() == 1:
+      return digests.get(leaf.path())
+    return special_digest(leaf.path())
+
+  return tree_digests(tree, leaf_digest)
+
+def path_prefixes(path):
+  "yields all proper prefixes of the given path ('a/b/c' -> 'a', 'a/b')"
+  elements = path.split('/')
+  for i in range(1, len(elements)):
+    yield '/'.join(elements[:i])
+
+def print_duplicates(groups):
+  reclaimable = 0
+  for size, digest, paths in groups:
+    kind = 'dir ' if os.path.isdir(paths[0]) else 'file'
+    print("%s %s x%d %s" % (kind, kmg(size), len(paths), digest))
+    for path in paths:
+      print("  " + path)
+    reclaimable += size * (len(paths) - 1)
+  print("reclaimable: %d bytes (%s)" % (reclaimable, kmg(reclaimable)))
+
+##########  tree comparison  ##########
+
+def tree_scanner(path, follow_links=None):
+  """
+  yields (components, stat, problem) for the given path and everything
+  below it, in the same sorted depth-first order sizeof_path() uses;
+  components is the tuple of names relative to the given path, so the
+  order of the yielded elements is the order of their components; problem
+  is the OSError of a directory which could not be listed (else None);
+  only the listings of the directories currently being walked are kept in
+  memory
+  """
+  if follow_links is None:  follow_links = False
+  stat_fun = os.stat if follow_links else os.lstat
+
+  def listing(dir_path):
+    try:
+      return iter(sorted(os.listdir(dir_path))), None
+    except OSError as problem:  # permission denied?
+      return iter(()), problem
+
+  try:
+    root_stat = stat_fun(path)
+  except OSError:  # no such file or directory?
+    return
+  if not stat.S_ISDIR(root_stat.st_mode):
+    yield (), root_stat, None
+    return
+  names, problem = listing(path)
+  yield (), root_stat, problem
+  stack = [ (path, (), names) ]
+  while stack:
+    dir_path, components, names = stack[-1]
+    name = next(names, None)
+    if name is None:  # directory finished?
+      stack.pop()
+      continue
+    entry_path = dir_path + '/' + name
+    try:
+      entry_stat = stat_fun(entry_path)
+    except OSError:  # vanished?
+      continue
+    if not stat.S_ISDIR(entry_stat.st_mode):
+      yield components + (name,), entry_stat, None
+      continue
+    names, problem = listing(entry_path)
+    yield components + (name,), entry_stat, problem
+    stack.append((entry_path, components + (name,), names))
+
+def prefetched(iterable, size=1000):
+  """
+  iterates the given iterable in a separate thread and yields its elements;
+  at most size elements are buffered
+  """
+  buffer = queue.Queue(size)
+  end = object()
+
+  def produce():
+    try:
+      for element in iterable:
+        buffer.put((element, None))
+    except Exception as problem:
+      buffer.put((end, problem))
+    else:
+      buffer.put((end, None))
+
+  threading.Thread(target=produce, daemon=True).start()
+  while True:
+    element, problem = buffer.get()
+    if problem is not None:
+      raise problem
+    if element is end:
+      break
+    yield element
+
+def diff_trees(old_path, new_path, follow_links=None, content=False,
+               sample_size=None, threads=DIGEST_THREADS):
+  """
+  compares two trees and yields tuples (kind, path, old, new) for each
+  difference, where kind is one of 'added', 'removed', 'size-changed',
+  'mtime-changed', 'content-changed', 'unreadable', path is relative to
+  both trees, and old and new are the differing values (or the stat of
+  added and removed entries, or the problems reading a directory, whose
+  contents are then not compared, or a symlink); both trees are scanned
+  concurrently and merged while scanning, so memory use depends on the
+  width of the directories, not the size of the trees; if content is
+  True, files of equal size are compared by checksum (see file_digest()
+  for sample_size) and only reported as 'mtime-changed' if their contents
+  are equal
+  """
+  old_entries = prefetched(tree_scanner(old_path, follow_links))
+  new_entries = prefetched(tree_scanner(new_path, follow_links))
+
+  def compare(components, old_stat, new_stat):
+    "returns a list of differences or a callable returning that later"
+    path = '/'.join(components) or '.'
+    old_type = stat.S_IFMT(old_stat.st_mode)
+    if old_type != stat.S_IFMT(new_stat.st_mode):
+      return [ ('removed', path, old_stat, None),
+               ('added',   path, None, new_stat) ]
+    mtime_changed = ([ ('mtime-changed', path,
+                        old_stat.st_mtime_ns, new_stat.st_mtime_ns) ]
+                     if old_stat.st_mtime_ns != new_stat.st_mtime_ns else [])
+    if old_type == stat.S_IFREG:
+      if old_stat.st_size != new_stat.st_size:
+        return [ ('size-changed', path, old_stat.st_size, new_stat.st_size) ]
+      if not content:
+        return mtime_changed
+      futures = [ pool.submit(file_digest, os.path.join(tree_path, *components),
+                              sample_size)
+                  for tree_path in (old_path, new_path) ]
+
+      def result():
+        try:
+          old_digest, new_digest = [ future.result() for future in futures ]
+        except OSError as problem:
+          return [ ('content-changed', path, problem, None) ]
+        if old_digest != new_digest:
+          return [ ('content-changed', path, old_digest, new_digest) ]
+        return mtime_changed
+
+      return result
+    elif old_type == stat.S_IFLNK:
+      links = []
+      for tree_path in (old_path, new_path):
+        try:
+          links.append(os.readlink(os.path.join(tree_path, *components)))
+        except OSError as problem:  # vanished, permission denied?
+          return [ ('unreadable', path, problem, None) if not links else
+                   ('unreadable', path, None, problem) ]
+      old_link, new_link = links
+      if old_link != new_link:
+        return [ ('content-changed', path, old_link, new_link) ]
+      return mtime_changed
+    return []  # directories and specials are not compared further
+
+  def below(entry, components):
+    return (entry is not None and len(entry[0]) > len(components) and
+            entry[0][:len(components)] == components)
+
+  pending = deque()  # lists of differences or callables, in order
+  with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+    old_entry = next(old_entries, None)
+    new_entry = next(new_entries, None)
+    while old_entry is not None or new_entry is not None:
+      if new_entry is None or (old_entry is not None and
+                               old_entry[0] < new_entry[0]):
+        pending.append([ ('removed', '/'.join(old_entry[0]) or '.',
+                          old_entry[1], None) ])
+        if old_entry[2] is not None:
+          pending.append([ ('unreadable', '/'.join(old_entry[0]) or '.',
+                            old_entry[2], None) ])
+        old_entry = next(old_entries, None)
+      elif old_entry is None or new_entry[0] < old_entry[0]:
+        pending.append([ ('added', '/'.join(new_entry[0]) or '.',
+                          None, new_entry[1]) ])
+        if new_entry[2] is not None:
+          pending.append([ ('unreadable', '/'.join(new_entry[0]) or '.',
+                            None, new_entry[2]) ])
+        new_entry = next(new_entries, None)
+      else:  # same path in both trees
+        components, old_problem, new_problem = (old_entry[0], old_entry[2],
+                                                new_entry[2])
+        pending.append(compare(components, old_entry[1], new_entry[1]))
+        old_entry = next(old_entries, None)
+        new_entry = next(new_entries, None)
+        if old_problem is not None or new_problem is not None:
+          pending.append([ ('unreadable', '/'.join(components) or '.',
+                            old_problem, new_problem) ])
+          while below(old_entry, components):  # not comparable
+            old_entry = next(old_entries, None)
+          while below(new_entry, components):
+            new_entry = next(new_entries, None)
+      while pending and (not callable(pending[0]) or
+                         len(pending) > 4 * threads):
+        differences = pending.popleft()
+        for difference in (differences() if callable(differences)
+                           else differences):
+          yield difference
+    while pending:
+      differences = pending.popleft()
+      for difference in (differences() if callable(differences)
+                         else differences):
+        yield difference
+
+def print_difference(kind, path, old, new):
+  if   kind in ('added', 'removed'):
+    entry_stat = old or new
+    print("%-15s %s%s" % (kind, path,
+                          '/' if stat.S_ISDIR(entry_stat.st_mode) else ''))
+  elif kind == 'unreadable':
+    print("%-15s %s (%s)" % (kind, path, old or new))
+  elif kind == 'mtime-changed':
+    print("%-15s %s (%s -> %s)" % (kind, path,
+                                   time_to_string(old / 1e9),
+                                   time_to_string(new / 1e9)))
+  else:
+    print("%-15s %s (%s -> %s)" % (kind, path, old, new))
+
+##########  chunk store  ##########
+
+# a chunk store is a directory containing
+#   objects/ab/cdef...  one file per chunk, named by the sha256 of its data
+#   snapshots/<name>    one JSON line per directory, file, or symlink; files
+#                       list the digests and lengths of their chunks
+#   lock                locked shared while a snapshot is written and
+#                       exclusively while collecting garbage
+
+CHUNK_MARKER = ord('\n')
+# ^^^ chunks end with this byte: ends of lines in text, 1/256 of random data
+
+def chunk_boundaries(data, bits=STORE_CHUNK_BITS, chunking=STORE_CHUNKING):
+  """
+  returns the end offsets of the content-defined chunks in data; a chunk
+  ends with a CHUNK_MARKER byte where the crc32 of the last 64 bytes has
+  its top bits - 8 bits all zero; chunks are at least a quarter and at
+  most four times the average size of 2**bits bytes (for random data);
+  markers are found by bytes.find() and only their windows are hashed, so
+  this runs at about 200 MB/s (50 MB/s for text with short lines); with
+  chunking='fixed' the chunks are 2**bits bytes large instead
+  """
+  if chunking == 'fixed':
+    size = 1 << bits
+    return [ min(end, len(data))
+             for end in range(size, len(data) + size, size) ]
+  min_size = 1 << max(0, bits - 2)
+  max_size = 1 << (bits + 2)
+  check_bits = max(0, bits - 8)  # the marker itself takes 8 bits
+  mask = ((1 << check_bits) - 1) << (32 - check_bits)
+  boundaries = []
+  start = 0
+  end = len(data)
+  while start < end:
+    limit = min(start + max_size, end)
+    cut = limit
+    marker = data.find(CHUNK_MARKER, start + min_size, limit)
+    while marker >= 0:
+      if not zlib.crc32(data[max(0, marker - 63):marker + 1]) & mask:
+        cut = marker + 1
+        break
+      marker = data.find(CHUNK_MARKER, marker + 1, limit)
+    boundaries.append(cut)
+    start = cut
+  return boundaries
+
+def store_segment(objects_path, data, bits=STORE_CHUNK_BITS,
+                  chunking=STORE_CHUNKING):
+  """
+  splits data into content-defined chunks and stores each chunk not yet
+  present in the objects directory; returns a list of (digest, length,
+  is_new) for the chunks; meant to run in a worker process
+  """
+  result = []
+  view = memoryview(data)
+  start = 0
+  for end in chunk_boundaries(data, bits, chunking):
+    chunk = view[start:end]
+    digest = hashlib.sha256(chunk).hexdigest()
+    object_path = os.path.join(objects_path, digest[:2], digest[2:])
+    is_new = not os.path.exists(object_path)
+    if is_new:
+      try:
+        os.makedirs(os.path.dirname(object_path))
+      except OSError:  # File exists
+        pass  # ignore
+      temporary_path = '%s.%d.part' % (object_path, os.getpid())
+      with open(temporary_path, 'wb') as object_file:
+        object_file.write(chunk)
+      os.rename(temporary_path, object_path)  # atomic, so no partial chunks
+    result.append((digest, end - start, is_new))
+    start = end
+  return result
+
+def lock_store(store_path, exclusive=False):
+  """
+  returns the file descriptor of the lock file of a chunk store, locked
+  shared (waiting for a garbage collection to finish) or exclusively
+  (raising an exception if the store is in use); closing it unlocks
+  """
+  lock_fd = os.open(os.path.join(store_path, 'lock'), os.O_RDWR | os.O_CREAT)
+  try:
+    if exclusive:
+      fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+      fcntl.flock(lock_fd, fcntl.LOCK_SH)
+  except BlockingIOError:
+    os.close(lock_fd)
+    raise Exception("chunk store %r is in use" % store_path)
+  except:
+    os.close(lock_fd)
+    raise
+  return lock_fd
+
+class Chunk_Snapshot(object):
+  """
+  a target for copy_tree() which stores files as content-defined chunks in
+  a chunk store and records them in a snapshot index; chunking and hashing
+  is done by a process pool, the index is written in tree order as soon as
+  the chunks of each entry are stored
+  """
+  def __init__(self, store_path, name, processes=STORE_PROCESSES,
+               chunking=STORE_CHUNKING):
+    if chunking not in ('content', 'fixed'):
+      raise Exception("unknown chunking: %r" % chunking)
+    self.store_path = store_path
+    self.chunking = chunking
+    self.objects_path = os.path.join(store_path, 'objects')
+    self.index_path = os.path.join(store_path, 'snapshots', name)
+    for path in (self.objects_path, os.path.dirname(self.index_path)):
+      try:
+        os.makedirs(path)
+      except OSError:  # File exists
+        pass  # ignore
+    self.lock_fd = lock_store(store_path)  # until close() or abort()
+    if os.path.exists(self.index_path):
+      os.close(self.lock_fd)
+      raise Exception("snapshot exists already: %r" % self.index_path)
+    self.index = open(self.index_path + '.part', 'w')
+    self.pool = concurrent.futures.ProcessPoolExecutor(processes)
+    self.max_pending = 2 * processes
+    self.pending = deque()  # (entry, futures) in tree order
+    self.pending_futures = 0
+    self.files = self.chunks = Counter((0, 0))
+    self.new_chunks = Counter((0, 0))
+
+  @staticmethod
+  def entry(kind, path, file_stat):
+    return dict(type=kind, path=path, mode=file_stat.st_mode,
+                uid=file_stat.st_uid, gid=file_stat.st_gid,
+                atime_ns=file_stat.st_atime_ns,
+                mtime_ns=file_stat.st_mtime_ns)
+
+  def add(self, entry, futures=()):
+    self.pending.append((entry, futures))
+    self.pending_futures += len(futures)
+    self.write_index(self.max_pending)
+
+  def submit(self, data, futures=()):
+    """
+    passes a segment of a file to the pool; futures are those of the
+    earlier segments of the file; waits while too many segments (each a
+    copy of its data) are in flight
+    """
+    running = [ future for future in futures if not future.done() ]
+    self.write_index(max(0, self.max_pending - 1 - len(running)))
+    while len(running) >= self.max_pending:
+      done, running = concurrent.futures.wait(
+        running, return_when=concurrent.futures.FIRST_COMPLETED)
+    return self.pool.submit(store_segment, self.objects_path, data,
+                            STORE_CHUNK_BITS, self.chunking)
+
+  def write_index(self, max_pending=0):
+    "writes finished entries; waits while too many segments are pending"
+    while self.pending and (self.pending_futures > max_pending or
+                            all(future.done()
+                                for future in self.pending[0][1])):
+      entry, futures = self.pending.popleft()
+      self.pending_futures -= len(futures)
+      if futures:
+        entry['chunks'] = []
+        for future in futures:
+          for digest, length, is_new in future.result():
+            entry['chunks'].append((digest, length))
+            self.chunks += Counter((1, length))
+            if is_new:
+              self.new_chunks += Counter((1, length))
+      self.index.write(json.dumps(entry) + '\n')
+
+  def add_directory(self, path, file_stat):
+    self.add(self.entry('dir', path, file_stat))
+
+  def add_symlink(self, path, file_stat):
+    entry = self.entry('symlink', path, file_stat)
+    entry['target'] = os.readlink(path)
+    self.add(entry)
+
+  def open_file(self, path, file_stat):
+    return Chunk_File(self, self.entry('file', path, file_stat))
+
+  def close(self):
+    "finishes the snapshot; returns a message about what was stored"
+    self.write_index()
+    self.pool.shutdown()
+    self.index.close()
+    os.rename(self.index_path + '.part', self.index_path)
+    os.close(self.lock_fd)
+    return ("Stored %d files (%d bytes) in %d chunks, %d new chunks"
+            " (%d bytes)" % (self.files.files(), self.files.bytes(),
+                             self.chunks.files(), self.new_chunks.files(),
+                             self.new_chunks.bytes()))
+
+  def abort(self):
+    "drops the unfinished snapshot (chunks stay until collect_garbage())"
+    self.pool.shutdown(cancel_futures=True)
+    self.index.close()
+    os.unlink(self.index_path + '.part')
+    os.close(self.lock_fd)
+
+class Chunk_File(object):
+  "file-like object collecting the data of one file for a Chunk_Snapshot"
+  def __init__(self, snapshot, entry):
+    self.snapshot = snapshot
+    self.entry = entry
+    self.buffer = bytearray()
+    self.futures = []
+    self.size = 0
+
+  def write(self, data):
+    self.buffer += data
+    self.size += len(data)
+    while len(self.buffer) >= STORE_SEGMENT_SIZE:
+      self.futures.append(
+        self.snapshot.submit(bytes(self.buffer[:STORE_SEGMENT_SIZE]),
+                             self.futures))
+      del self.buffer[:STORE_SEGMENT_SIZE]
+
+  def close(self):
+    if self.buffer:
+      self.futures.append(self.snapshot.submit(bytes(self.buffer),
+                                               self.futures))
+      self.buffer = bytearray()
+    self.entry['size'] = self.size
+    self.snapshot.files += Counter((1, self.size))
+    self.snapshot.add(self.entry, self.futures)
+
+  def abort(self):
+    "drops the file (e. g. after a read error); its chunks become garbage"
+    self.buffer = bytearray()
+
+def read_snapshot(store_path, name):
+  "yields the entries of a snapshot index"
+  with open(os.path.join(store_path, 'snapshots', name)) as index:
+    for line in index:
+      yield json.loads(line)
+
+def restore_snapshot(store_path, name, target, add_report=None):
+  """
+  restores a snapshot from a chunk store into the target directory (each
+  path below target like copy_tree() would do it); chunks are verified
+  against their digests while restoring; existing files are skipped
+  """
+  if add_report is None:  add_report = lambda report: None
+  objects_path = os.path.join(store_path, 'objects')
+
+  def preserve_stats(entry, path):
+    try:
+      os.lchown(path, entry['uid'], entry['gid'])
+    except OSError:  # Operation not permitted
+      add_report("Could not chown %r to %d.%d" %
+                 (path, entry['uid'], entry['gid']))
+    if entry['type'] == 'symlink':
+      return  # no mode or times for symlinks
+    try:
+      os.chmod(path, entry['mode'])
+    except OSError:  # Operation not permitted
+      add_report("Could not chmod %r to %o" % (path, entry['mode']))
+    try:
+      os.utime(path, ns=(entry['atime_ns'], entry['mtime_ns']))
+    except OSError:  # Operation not permitted
+      add_report("Could not utime %r" % path)
+
+  stats_to_update_later = []
+  for entry in read_snapshot(store_path, name):
+    path = target + '/' + entry['path']
+    if entry['type'] == 'dir':
+      try:
+        os.makedirs(path)
+      except OSError:  # file exists?
+        pass  # ignore
+      stats_to_update_later.append((entry, path))
+      continue
+    if os.path.lexists(path):
+      add_report("Skipped existing: %s" % path)
+      continue
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError:  # File exists
+      pass  # ignore
+    if entry['type'] == 'symlink':
+      os.symlink(entry['target'], path)
+    else:
+      problem = None
+      try:
+        with open(path + '.part', 'wb') as out_file:
+          for digest, length in entry['chunks']:
+            with open(os.path.join(objects_path, digest[:2], digest[2:]),
+                      'rb') as object_file:
+              chunk = object_file.read()
+            if (len(chunk) != length or
+                hashlib.sha256(chunk).hexdigest() != digest):
+              problem = "corrupt chunk %s" % digest
+              break
+            out_file.write(chunk)
+      except OSError as error:  # missing chunk?
+        problem = error
+      if problem is not None:
+        add_report("Could not restore %r: %s" % (path, problem))
+        try:
+          os.unlink(path + '.part')
+        except OSError:  # not created
+          pass  # ignore
+        continue
+      os.rename(path + '.part', path)
+    preserve_stats(entry, path)
+  for entry, path in reversed(stats_to_update_later):
+    preserve_stats(entry, path)
+
+def collect_garbage(store_path, add_report=None):
+  """
+  removes all chunks from a chunk store which are not referenced by any
+  snapshot; returns the Counter of removed chunks; refuses to work while a
+  snapshot is being written (its chunks are not referenced yet), which is
+  known from the lock of the store
+  """
+  if add_report is None:  add_report = lambda report: None
+  lock_fd = lock_store(store_path, exclusive=True)
+  try:
+    return collect_unreferenced(store_path, add_report)
+  finally:
+    os.close(lock_fd)
+
+def collect_unreferenced(store_path, add_report):
+  "collect_garbage() with the store locked"
+  snapshots_path = os.path.join(store_path, 'snapshots')
+  names = []
+  for name in sorted_listing(snapshots_path):
+    if name.endswith('.part'):  # left by an interrupted snapshot
+      add_report("Ignored unfinished snapshot %r" % name)
+    else:
+      names.append(name)
+  referenced = set()
+  for name in names:
+    for entry in read_snapshot(store_path, name):
+      for digest, length in entry.get('chunks', ()):
+        referenced.add(digest)
+  removed = Counter((0, 0))
+  objects_path = os.path.join(store_path, 'objects')
+  for prefix in sorted_listing(objects_path):
+    for rest in sorted_listing(os.path.join(objects_path, prefix)):
+      if prefix + rest in referenced:
+        continue
+      object_path = os.path.join(objects_path, prefix, rest)
+      try:
+        size = os.lstat(object_path).st_size
+        os.unlink(object_path)
+      except OSError as problem:
+        add_report("Could not remove %r: %s" % (object_path, problem))
+      else:
+        removed += Counter((1, size))
+  return removed
+
+##########  streams  ##########
+
+# a stream is the magic STREAM_MAGIC followed by frames; each frame is a
+# STREAM_FRAME header (kind, lengths of path, metadata, and data) followed by
+# the path, the metadata (STREAM_META for directories, files, and symlinks),
+# and the data (file contents for 'd', the link target for 'L'):
+#   'D' directory, 'F' start of file, 'd' data of file, 'E' end of file,
+#   'A' aborted file (read error), 'L' symlink, 'Z' end of stream
+
+STREAM_MAGIC = b'DIRSTRM1'
+STREAM_FRAME = struct.Struct('!cIII')
+STREAM_META = struct.Struct('!IIIqq')  # mode, uid, gid, atime_ns, mtime_ns
+
+def write_all(fd, buffers):
+  "writes all buffers using writev() without copying them"
+  buffers = [ memoryview(buffer).cast('B') for buffer in buffers
+              if len(buffer) ]
+  while buffers:
+    written = os.writev(fd, buffers)
+    while buffers and written >= len(buffers[0]):
+      written -= len(buffers[0])
+      del buffers[0]
+    if buffers:
+      buffers[0] = buffers[0][written:]
+
+def read_exactly(stream, view):
+  "fills the given memoryview from the stream; returns False at EOF"
+  position = 0
+  while position < len(view):
+    byte_count = stream.readinto(view[position:])
+    if not byte_count:
+      if position:
+        raise Exception("truncated stream")
+      return False
+    position += byte_count
+  return True
+
+class Stream_Writer(object):
+  """
+  a sink for copy_tree() which serializes the tree into a stream of frames
+  written to the given file descriptor (see unpack_stream())
+  """
+  def __init__(self, fd):
+    self.fd = fd
+    self.files = Counter((0, 0))
+    write_all(self.fd, [ STREAM_MAGIC ])
+
+  def write_frame(self, kind, path=b'', meta=b'', data=b''):
+    write_all(self.fd, [ STREAM_FRAME.pack(kind, len(path), len(meta),
+                                           len(data)),
+                         path, meta, data ])
+
+  @staticmethod
+  def meta(file_stat):
+    return STREAM_META.pack(file_stat.st_mode, file_stat.st_uid,
+                            file_stat.st_gid, file_stat.st_atime_ns,
+                            file_stat.st_mtime_ns)
+
+  def add_directory(self, path, file_stat):
+    self.write_frame(b'D', os.fsencode(path), self.meta(file_stat))
+
+  def add_symlink(self, path, file_stat):
+    self.write_frame(b'L', os.fsencode(path), self.meta(file_stat),
+                     os.fsencode(os.readlink(path)))
+
+  def open_file(self, path, file_stat):
+    self.write_frame(b'F', os.fsencode(path), self.meta(file_stat))
+    return Stream_File(self)
+
+  def close(self):
+    self.write_frame(b'Z')
+    return "Streamed %d files (%d bytes)" % (self.files.files(),
+                                             self.files.bytes())
+
+  def abort(self):
+    pass  # the missing end frame tells the reader
+
+class Stream_File(object):
+  "file-like object writing the data of one file as frames of a stream"
+  def __init__(self, writer):
+    self.writer = writer
+    self.size = 0
+
+  def write(self, data):
+    self.writer.write_frame(b'd', data=data)
+    self.size += len(data)
+
+  def close(self):
+    self.writer.write_frame(b'E')
+    self.writer.files += Counter((1, self.size))
+
+  def abort(self):
+    self.writer.write_frame(b'A')
+
+def unpack_stream(stream, target, add_report=None):
+  """
+  restores a tree from a stream written by a Stream_Writer into the target
+  directory (each path below target like copy_tree() would do it); existing
+  files are skipped; returns the Counter of unpacked files
+  """
+  if add_report is None:  add_report = lambda report: None
+  header = bytearray(STREAM_FRAME.size)
+  buffer = bytearray(CHUNK_SIZE)
+  magic = bytearray(len(STREAM_MAGIC))
+  if not read_exactly(stream, memoryview(magic)) or magic != STREAM_MAGIC:
+    raise Exception("not a directories stream")
+
+  def preserve_stats(meta, path, is_link=False):
+    mode, uid, gid, atime_ns, mtime_ns = meta
+    try:
+      os.lchown(path, uid, gid)
+    except OSError:  # Operation not permitted
+      add_report("Could not chown %r to %d.%d" % (path, uid, gid))
+    if is_link:
+      return  # no mode or times for symlinks
+    try:
+      os.chmod(path, mode)
+    except OSError:  # Operation not permitted
+      add_report("Could not chmod %r to %o" % (path, mode))
+    try:
+      os.utime(path, ns=(atime_ns, mtime_ns))
+    except OSError:  # Operation not permitted
+      add_report("Could not utime %r" % path)
+
+  def make_father(path):
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError:  # File exists
+      pass  # ignore
+
+  unpacked = Counter((0, 0))
+  out_file = None  # None, 'skip', or the open file
+  stats_to_update_later = []
+  created_links = set()  # paths (below target) of the unpacked symlinks
+
+  def target_path(stream_path, is_dir=False):
+    """
+    returns the path below target for a path of the stream (empty and '.'
+    components are dropped), None if it has '..' components or is (or lies
+    within) a symlink unpacked before (which could point anywhere)
+    """
+    parts = [ part for part in stream_path.split('/')
+              if part not in ('', '.') ]
+    if '..' in parts or not parts and not is_dir:
+      return None
+    for i in range(1, len(parts) + 1):
+      if '/'.join(parts[:i]) in created_links:
+        return None
+    return '/'.join([ target ] + parts)
+
+  try:
+    while True:  # until the end frame
+      if not read_exactly(stream, memoryview(header)):
+        add_report("Stream ended without end frame (aborted?)")
+        break
+      kind, path_length, meta_length, data_length = STREAM_FRAME.unpack(header)
+      length = path_length + meta_length + data_length
+      if len(buffer) < length:
+        buffer = bytearray(length)
+      view = memoryview(buffer)[:length]
+      if not read_exactly(stream, view):
+        add_report("Stream ended within a frame (aborted?)")
+        break
+      stream_path = os.fsdecode(bytes(view[:path_length]))
+      if kind in (b'F', b'D', b'L'):
+        path = target_path(stream_path, is_dir=kind == b'D')
+        if path is None:
+          add_report("Refused unsafe path in stream: %r" % stream_path)
+      meta = (STREAM_META.unpack(view[path_length:path_length + meta_length])
+              if meta_length else None)
+      data = view[path_length + meta_length:]
+      if   kind == b'd':  # data of the current file
+        if out_file is None:
+          raise Exception("data without file in stream")
+        if out_file != 'skip':
+          out_file.write(data)
+          file_size += len(data)
+      elif kind in (b'E', b'A'):  # end of the current file
+        if out_file is None:
+          raise Exception("end of file without file in stream")
+        if out_file != 'skip':
+          out_file.close()
+          if kind == b'E':
+            os.rename(file_name + '.part', file_name)
+            preserve_stats(file_meta, file_name)
+            unpacked += Counter((1, file_size))
+          else:  # file could not be read completely
+            add_report("Aborted in stream: %r" % file_name)
+            os.unlink(file_name + '.part')
+        out_file = None
+      elif out_file is not None:
+        raise Exception("unexpected frame %r within file in stream" % kind)
+      elif kind == b'F' and path is None:  # refused, skip its data
+        out_file = 'skip'
+      elif kind in (b'D', b'L') and path is None:  # refused
+        pass
+      elif kind == b'F':  # start of a file
+        file_name, file_meta, file_size = path, meta, 0
+        make_father(file_name)
+        if os.path.lexists(file_name):
+          add_report("Skipped existing: %s" % file_name)
+          out_file = 'skip'
+        else:
+          try:
+            out_file = open(file_name + '.part', 'wb')
+          except IOError:  # cannot create file?
+            add_report("Could not create file %r" % (file_name + '.part'))
+            out_file = 'skip'
+      elif kind == b'D':  # directory
+        try:
+          os.makedirs(path)
+        except OSError:  # file exists?
+          pass  # ignore
+        stats_to_update_later.append((meta, path))
+      elif kind == b'L':  # symlink
+        make_father(path)
+        try:
+          os.symlink(os.fsdecode(bytes(data)), path)
+        except OSError:  # File exists?
+          add_report("Could not create symlink at %r" % path)
+        else:
+          created_links.add(path[len(target) + 1:])
+          preserve_stats(meta, path, is_link=True)
+      elif kind == b'Z':  # end of stream
+        break
+      else:
+        raise Exception("unknown frame %r in stream" % kind)
+  finally:
+    if out_file not in (None, 'skip'):  # stream ended within a file?
+      out_file.close()
+      add_report("Stream ended within file: %r" % file_name)
+      os.unlink(file_name + '.part')
+  for meta, path in reversed(stats_to_update_later):
+    preserve_stats(meta, path)
+  return unpacked
+
+##########  scrubbing  ##########
+
+MANIFEST_HEADER = '# directories.py manifest: full md5'
+# ^^^ first line of a manifest; digests of samples cannot be verified
+
+def read_manifest(path):
+  """
+  yields (digest, size, mtime_ns, path) for each line of a manifest as
+  written by 'directories.py checksum -m'; raises an exception if the
+  manifest does not declare full md5 digests or a digest is no md5 digest
+  """
+  with open(path, encoding='utf-8', errors='surrogateescape') as manifest:
+    if manifest.readline().rstrip('\n') != MANIFEST_HEADER:
+      raise Exception("%s is no manifest of full md5 digests (write one"
+                      " using 'directories.py checksum -m')" % path)
+    for line in manifest:
+      digest, size, mtime_ns, file_path = line.rstrip('\n').split(' ', 3)
+      if len(digest) != 32 or digest.strip('0123456789abcdef'):
+        raise Exception("cannot verify digest %r of %r" % (digest, file_path))
+      yield digest, int(size), int(mtime_ns), file_path
+
+class Rate_Limiter(object):
+  "paces several threads to a common number of bytes per second"
+  def __init__(self, rate):
+    self.rate = rate
+    self.lock = threading.Lock()
+    self.next_time = time.monotonic()
+
+  def wait(self, byte_count):
+    with self.lock:
+      now = time.monotonic()
+      start = max(self.next_time, now)  # no catching up after idle times
+      self.next_time = start + byte_count / self.rate
+    if start > now:
+      time.sleep(start - now)
+
+class Scrubber(object):
+  """
+  re-reads the files listed in a manifest and compares them to their
+  recorded md5 digests; files whose size or mtime differ from the manifest
+  are reported as changed instead of being read; the manifest is split
+  into one slice per thread, each read by a tree_reader(); the position in
+  the manifest is kept in a checkpoint file, so a scrub can be continued
+  in a later run (and starts over after it is complete)
+  """
+  def __init__(self, manifest_path, checkpoint_path=None, threads=1,
+               rate=None, chunk_size=CHUNK_SIZE):
+    self.entries = list(read_manifest(manifest_path))
+    self.checkpoint_path = (checkpoint_path if checkpoint_path is not None
+                            else manifest_path + '.checkpoint')
+    self.threads = threads
+    self.limiter = Rate_Limiter(rate) if rate else None
+    self.chunk_size = chunk_size
+    self.lock = threading.Lock()
+    self.stop = threading.Event()
+    self.done = self.load_checkpoint()  # list of [ start, end ] index ranges
+    self.progress = {}  # slice start -> index of next entry in that slice
+    self.ancestries = {}  # slice start -> ancestry of the current file
+    self.verified = Counter((0, 0))
+    self.mismatches = []
+    self.missing = []
+    self.changed = []
+    self.start_time = None
+
+  def load_checkpoint(self):
+    try:
+      with open(self.checkpoint_path) as checkpoint:
+        state = json.load(checkpoint)
+    except (OSError, ValueError):  # no (usable) checkpoint?
+      return []
+    if state['entries'] != len(self.entries):  # other manifest?
+      return []
+    return state['done']
+
+  def done_ranges(self):
+    "returns the merged list of done index ranges including the progress"
+    ranges = sorted(self.done +
+                    [ [ start, end ] for start, end in self.progress.items()
+                      if end > start ])
+    merged = []
+    for start, end in ranges:
+      if merged and start <= merged[-1][1]:
+        merged[-1][1] = max(merged[-1][1], end)
+      else:
+        merged.append([ start, end ])
+    return merged
+
+  def save_checkpoint(self):
+    with self.lock:
+      done = self.done_ranges()
+    if done == [ [ 0, len(self.entries) ] ]:  # complete?  start over next time
+      try:
+        os.unlink(self.checkpoint_path)
+      except OSError:  # no checkpoint?
+        pass  # ignore
+      return
+    temporary_path = self.checkpoint_path + '.part'
+    with open(temporary_path, 'w') as checkpoint:
+      json.dump(dict(entries=len(self.entries), done=done), checkpoint)
+    os.rename(temporary_path, self.checkpoint_path)
+
+  def slices(self):
+    "returns the (start, end) index ranges to scrub, one per thread"
+    todo = []
+    position = 0
+    for start, end in self.done + [ [ len(self.entries) ] * 2 ]:
+      todo.extend(range(position, start))
+      position = max(position, end)
+    result = []
+    for i in range(self.threads):  # contiguous pieces of what is to do
+      piece = todo[len(todo) * i // self.threads:
+                   len(todo) * (i + 1) // self.threads]
+      while piece:  # split further where done ranges interrupt it
+        end = 0
+        while end < len(piece) and piece[end] == piece[0] + end:
+          end += 1
+        result.append((piece[0], piece[0] + end))
+        piece = piece[end:]
+    return result
+
+  def scrub_slice(self, start, end):
+    entries = self.entries[start:end]
+    indices = { path: start + i
+                for i, (digest, size, mtime_ns, path) in enumerate(entries) }
+    tree = Path_Size((
+      Counter((len(entries), sum(size for digest, size, mtime_ns, path
+                                 in entries))), '',
+      [ Path_Size((Counter((1, size)), path, None))
+        for digest, size, mtime_ns, path in entries ]))
+    buffer = bytearray(self.chunk_size)
+    view = memoryview(buffer)
+    next_index = [ start ]  # everything before was handled
+
+    def reached(path):
+      "notes that the entry of path was reached, earlier ones are missing"
+      index = indices[path]
+      with self.lock:
+        self.missing.extend(self.entries[i][3]
+                            for i in range(next_index[0], index))
+      next_index[0] = index
+
+    def finished(path):
+      next_index[0] = indices[path] + 1
+      with self.lock:
+        self.progress[start] = next_index[0]
+
+    def modified(path, file_stat):
+      digest, size, mtime_ns, manifest_path = self.entries[indices[path]]
+      return (file_stat.st_size != size or
+              file_stat.st_mtime_ns != mtime_ns)
+
+    digest = None
+    for node in tree_reader(tree, follow_links=True, unchanged=modified,
+                            buffer=buffer):
+      if self.stop.is_set():  # time is up?
+        if digest is not None:
+          f.close()
+        break
+      if   isinstance(node, File_Open):
+        path, ancestry, f = node
+        reached(path)
+        digest = hashlib.md5()
+        self.ancestries[start] = ancestry
+      elif isinstance(node, Data):
+        path, ancestry, f, byte_count = node
+        digest.update(view[:byte_count])
+        self.ancestries[start] = ancestry
+        with self.lock:
+          self.verified += Counter((0, byte_count))
+        if self.limiter is not None:
+          self.limiter.wait(byte_count)
+      elif isinstance(node, EOF):
+        path, ancestry, f = node
+        if digest.hexdigest() != self.entries[indices[path]][0]:
+          with self.lock:
+            self.mismatches.append((path, digest.hexdigest()))
+        with self.lock:
+          self.verified += Counter((1, 0))
+        digest = None
+        finished(path)
+      elif isinstance(node, Bad_Leaf):
+        path, ancestry, problem, f = node
+        reached(path)
+        with self.lock:
+          self.mismatches.append((path, problem))
+        digest = None
+        finished(path)
+      elif isinstance(node, (Unchanged, Special)):  # modified or no file
+        path = node[0]
+        reached(path)
+        with self.lock:
+          self.changed.append(path)
+        finished(path)
+    else:  # all done; entries after the last one reached are missing
+      with self.lock:
+        self.missing.extend(self.entries[i][3]
+                            for i in range(next_index[0], end))
+        self.progress[start] = end
+
+  def run(self, duration=None, display=None, interval=0.5):
+    """
+    scrubs for at most duration seconds (or until done), calling display()
+    regularly; saves the checkpoint when finished
+    """
+    self.start_time = time.monotonic()
+    workers = [ threading.Thread(target=self.scrub_slice, args=piece,
+                                 daemon=True)
+                for piece in self.slices() ]
+    for worker in workers:
+      worker.start()
+    last_checkpoint_time = time.monotonic()
+    try:
+      while any(worker.is_alive() for worker in workers):
+        if (duration is not None and
+            time.monotonic() - self.start_time > duration):
+          self.stop.set()
+        if display is not None:
+          display(self)
+        if time.monotonic() - last_checkpoint_time > 60.0:
+          self.save_checkpoint()
+          last_checkpoint_time = time.monotonic()
+        time.sleep(interval)
+    finally:
+      self.stop.set()
+      for worker in workers:
+        worker.join()
+      self.save_checkpoint()
+
+  def throughput(self):
+    elapsed = time.monotonic() - self.start_time
+    return self.verified.bytes() / elapsed if elapsed > 0 else 0.0
+
+  def summary(self):
+    with self.lock:
+      done = sum(end - start for start, end in self.done_ranges())
+    return ("%d/%d files done, verified %d files (%s) at %s/s,"
+            " %d mismatches, %d missing, %d changed" % (
+              done, len(self.entries), self.verified.files(),
+              kmg(self.verified.bytes()), kmg(int(self.throughput())),
+              len(self.mismatches), len(self.missing), len(self.changed)))
+
+def display_scrub(scrubber):
+  "paints the summary and the Ancestry of each thread of a Scrubber"
+  try:
+    height, width = get_window_size()
+    lines = [ scrubber.summary()[:width] ]
+    for start, ancestry in sorted(scrubber.ancestries.items()):
+      lines.append(str(ancestry))
+    print(TTY.home + (TTY.clearEOL + '\n').join(lines) + TTY.clearEOS,
+          end='', flush=True)
+  except Exception as problem:
+    print("Problem while reporting:", problem)
+
+def benchmark_traversal(depth=200, files_per_level=5, file_size=100):
+  """
+  builds a synthetic tree of the given depth (and a flat tree with the same
+  number of files) in a temporary directory and prints the time per yielded
+  item for scanning, traversing, and reading both trees
+  """
+  import tempfile
+  base = tempfile.mkdtemp(prefix='directories-bench-')
+  try:
+    deep = flat = None
+    for name, levels in (('flat', 1), ('deep', depth)):
+      path = base + '/' + name
+      count = files_per_level * depth // levels
+      for level in range(levels):
+        os.makedirs(path)
+        for i in range(count):
+          with open('%s/f%d' % (path, i), 'wb') as f:
+            f.write(b'x' * file_size)
+        path += '/d'
+    for name in ('flat', 'deep'):
+      path = base + '/' + name
+      start = time.time()
+      tree = sizeof_path(path)
+      scan_duration = time.time() - start
+      results = [ (tree.counter().files(), scan_duration) ]
+      for walk in (tree_traverser, tree_reader):
+        start = time.time()
+        items = 0
+        for node in walk(tree):
+          items += 1
+        results.append((items, time.time() - start))
+      print("%-5s %s" % (name, "  ".join(
+        "%-8s %7d items %8.2fus/item" % (kind, items, duration * 1e6 / items)
+        for kind, (items, duration) in zip(('scan', 'traverse', 'read'),
+                                           results))))
+  finally:
+    shutil.rmtree(base)
+
 def main():
   if   sys.argv[1] == 'cp':
     del sys.argv[1]
     follow_links = False
-    if sys.argv[1] == '-f':  # follow links?
-      follow_links = True
-      del sys.argv[1]
+    link_dest = None
+    store = None
+    stream = False
+    export_metrics = None
+    export_interval = 15.0
+    while sys.argv[1].startswith('-'):
+      if   sys.argv[1] == '-f':  # follow links?
+        follow_links = True
+        del sys.argv[1]
+      elif sys.argv[1] == '--link-dest':  # hardlink unchanged files
+        link_dest = sys.argv[2]
+        del sys.argv[1:3]
+      elif sys.argv[1] == '--store':  # target is a snapshot in a chunk store
+        store = sys.argv[2]
+        del sys.argv[1:3]
+      elif sys.argv[1] == '--stream':  # no target, write a stream to stdout
+        stream = True
+        del sys.argv[1]
+      elif sys.argv[1] == '--metrics':  # Prometheus textfile or .jsonl
+        export_metrics = sys.argv[2]
+        del sys.argv[1:3]
+      elif sys.argv[1] == '--metrics-interval':  # seconds between exports
+        export_interval = float(sys.argv[2])
+        del sys.argv[1:3]
+      else:
+        print("bad option:", sys.argv[1])
+        sys.exit(1)
+    if link_dest is not None and (stream or store is not None):
+      print("--link-dest needs a target directory (not --store or --stream)")
+      sys.exit(1)
     reports = []
 
     def add_report(report):
       reports.append(report)
 
-    tree = sizeof_path(sys.argv[1:-1], report_scan, follow_links,
-                       target=sys.argv[-1], add_report=add_report)
+    if stream:  # the display goes to the terminal instead of stdout
+      target = Stream_Writer(os.dup(sys.stdout.fileno()))
+      try:
+        sys.stdout = open('/dev/tty', 'w')
+      except OSError:  # no terminal?
+        sys.stdout = sys.stderr
+      tree = sizeof_path(sys.argv[1:], report_scan, follow_links)
+    elif store is None:
+      target = sys.argv[-1]
+      tree = sizeof_path(sys.argv[1:-1], report_scan, follow_links,
+                         target=target, add_report=add_report)
+    else:
+      target = Chunk_Snapshot(store, sys.argv[-1])
+      tree = sizeof_path(sys.argv[1:-1], report_scan, follow_links)
     sys.stdout.write(
         TTY.cr + TTY.clearEOL + TTY.save + TTY.buffer1 + TTY.clear)
     sys.stdout.flush()
     try:
       copy_tree(tree,
-                target=sys.argv[-1],
+                target=target,
                 follow_links=follow_links,
-                add_report=add_report)
+                add_report=add_report,
+                link_dest=link_dest,
+                export_metrics=export_metrics,
+                export_interval=export_interval)
     finally:
       sys.stdout.write(TTY.clear + TTY.buffer0 + TTY.restore)
       sys.stdout.flush()
     for report in reports:
       print(report)
+  elif sys.argv[1] == 'mv':
+    del sys.argv[1]
+    reports = []
+
+    def add_report(report):
+      reports.append(report)
+
+    target = sys.argv[-1]
+    try:
+      os.makedirs(target)
+    except OSError:  # File exists
+      pass  # ignore
+    target_device = os.stat(target).st_dev
+    to_copy = []
+    for path in sys.argv[1:-1]:
+      try:
+        device = os.lstat(path).st_dev
+      except OSError as problem:
+        add_report("Could not move %r: %s" % (path, problem))
+        continue
+      if device == target_device:  # same file system?  just rename
+        to_copy.extend(move_tree(path, target, add_report=add_report))
+      else:
+        to_copy.append(path)
+    if to_copy:  # copy and remove progressively
+      tree = sizeof_path(to_copy, report_scan,
+                         target=target, add_report=add_report)
+      sys.stdout.write(
+          TTY.cr + TTY.clearEOL + TTY.save + TTY.buffer1 + TTY.clear)
+      sys.stdout.flush()
+      try:
+        copy_tree(tree,
+                  target=target,
+                  add_report=add_report,
+                  remove_source=True)
+      finally:
+        sys.stdout.write(TTY.clear + TTY.buffer0 + TTY.restore)
+        sys.stdout.flush()
+    for report in reports:
+      print(report)
+  elif sys.argv[1] == 'unpack':
+    del sys.argv[1]
+    reports = []
+    unpacked = unpack_stream(sys.stdin.buffer.raw, sys.argv[1],
+                             add_report=reports.append)
+    for report in reports:
+      print(report)
+    print("unpacked %d files (%d bytes)" % (unpacked.files(),
+                                            unpacked.bytes()))
+  elif sys.argv[1] == 'restore':
+    del sys.argv[1]
+    reports = []
+    store, name, target = sys.argv[1:4]
+    restore_snapshot(store, name, target, add_report=reports.append)
+    for report in reports:
+      print(report)
+  elif sys.argv[1] == 'gc':
+    del sys.argv[1]
+    reports = []
+    removed = collect_garbage(sys.argv[1], add_report=reports.append)
+    for report in reports:
+      print(report)
+    print("removed %d chunks (%d bytes)" % (removed.files(), removed.bytes()))
   elif sys.argv[1] == 'read':
     del sys.argv[1]
+    benchmark = False
+    cold = None
+    output_path = None
+    chunk_size = CHUNK_SIZE
+    while sys.argv[1].startswith('-'):
+      if   sys.argv[1] == '--bench':  # measure instead of displaying
+        benchmark = True
+        del sys.argv[1]
+      elif sys.argv[1] == '--cold':  # 'drop' or 'fadvise' caches first
+        cold = sys.argv[2]
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-o':  # write JSON results to that file
+        output_path = sys.argv[2]
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-s':  # size of each read
+        chunk_size = kmg(sys.argv[2]).get_value()
+        del sys.argv[1:3]
+      else:
+        print("bad option:", sys.argv[1])
+        sys.exit(1)
+    if benchmark:
+      reports = []
+      tree = sizeof_path(sys.argv[1:])
+      result = benchmark_read(tree, chunk_size, cold,
+                              add_report=reports.append)
+      for report in reports:
+        print(report, file=sys.stderr)
+      if output_path is None:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+      else:
+        with open(output_path, 'w') as output:
+          json.dump(result, output, indent=2)
+      return
     tree = sizeof_path(sys.argv[1:], report_scan)
     sys.stdout.write(
         TTY.cr + TTY.clearEOL + TTY.save + TTY.buffer1 + TTY.clear)
@@ -876,6 +3034,171 @@ def main():
     finally:
       sys.stdout.write(TTY.clear + TTY.buffer0 + TTY.restore)
       sys.stdout.flush()
+  elif sys.argv[1] == 'dupes':
+    del sys.argv[1]
+    follow_links = False
+    sample_size = SAMPLE_SIZE
+    threads = DIGEST_THREADS
+    while sys.argv[1].startswith('-'):
+      if   sys.argv[1] == '-f':  # follow links?
+        follow_links = True
+        del sys.argv[1]
+      elif sys.argv[1] == '-s':  # sample size for head and tail
+        sample_size = kmg(sys.argv[2]).get_value()
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-t':  # number of threads
+        threads = int(sys.argv[2])
+        del sys.argv[1:3]
+      else:
+        print("bad option:", sys.argv[1])
+        sys.exit(1)
+    reports = []
+    tree = sizeof_path(sys.argv[1:],
+                       report_scan if os.isatty(sys.stdout.fileno()) else None,
+                       follow_links)
+    if os.isatty(sys.stdout.fileno()):
+      sys.stdout.write(TTY.cr + TTY.clearEOL)
+    print_duplicates(find_duplicates(tree, sample_size, threads,
+                                     add_report=reports.append))
+    for report in reports:
+      print(report, file=sys.stderr)
+  elif sys.argv[1] == 'checksum':
+    del sys.argv[1]
+    follow_links = False
+    sample_size = SAMPLE_SIZE
+    threads = DIGEST_THREADS
+    cache_path = CHECKSUM_CACHE
+    prune = False
+    manifest = False
+    while sys.argv[1].startswith('-'):
+      if   sys.argv[1] == '-f':  # follow links?
+        follow_links = True
+        del sys.argv[1]
+      elif sys.argv[1] == '-F':  # checksum full contents?
+        sample_size = None
+        del sys.argv[1]
+      elif sys.argv[1] == '-s':  # sample size for head and tail
+        sample_size = kmg(sys.argv[2]).get_value()
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-t':  # number of threads
+        threads = int(sys.argv[2])
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-c':  # cache file ('' for none)
+        cache_path = sys.argv[2]
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-p':  # prune unused cache entries
+        prune = True
+        del sys.argv[1]
+      elif sys.argv[1] == '-m':  # write a manifest (for scrub)
+        manifest = True
+        del sys.argv[1]
+      else:
+        print("bad option:", sys.argv[1])
+        sys.exit(1)
+    if manifest:  # scrub verifies full digests only
+      sample_size = None
+      print(MANIFEST_HEADER)
+    reports = []
+    cache = Checksum_Cache(cache_path, sample_size)
+    try:
+      for path in sys.argv[1:]:
+        tree = sizeof_path(path, follow_links=follow_links)
+        for node, digest in tree_checksums(tree, sample_size, cache, threads,
+                                           follow_links, reports.append):
+          if not manifest:
+            print(digest or '?' * 32, node.path())
+          elif (digest is not None and not node.has_contents() and
+                node.counter().files() == 1):  # regular file?
+            try:
+              file_stat = (os.stat if follow_links else os.lstat)(node.path())
+            except OSError as problem:  # vanished?
+              reports.append("Could not stat %r: %s" % (node.path(), problem))
+              continue
+            print(digest, file_stat.st_size, file_stat.st_mtime_ns,
+                  node.path())
+      if prune:
+        cache.prune()
+    finally:
+      cache.close()
+    for report in reports:
+      print(report, file=sys.stderr)
+    print("cache: %d hits, %d misses" % (cache.hits, cache.misses),
+          file=sys.stderr)
+  elif sys.argv[1] == 'diff':
+    del sys.argv[1]
+    follow_links = False
+    content = False
+    sample_size = None
+    threads = DIGEST_THREADS
+    while sys.argv[1].startswith('-'):
+      if   sys.argv[1] == '-f':  # follow links?
+        follow_links = True
+        del sys.argv[1]
+      elif sys.argv[1] == '-c':  # compare contents of equally sized files?
+        content = True
+        del sys.argv[1]
+      elif sys.argv[1] == '-s':  # only compare head and tail of that size
+        content = True
+        sample_size = kmg(sys.argv[2]).get_value()
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-t':  # number of threads
+        threads = int(sys.argv[2])
+        del sys.argv[1:3]
+      else:
+        print("bad option:", sys.argv[1])
+        sys.exit(1)
+    differences = 0
+    for difference in diff_trees(sys.argv[1], sys.argv[2], follow_links,
+                                 content, sample_size, threads):
+      print_difference(*difference)
+      differences += 1
+    if differences:
+      sys.exit(1)
+  elif sys.argv[1] == 'scrub':
+    del sys.argv[1]
+    checkpoint_path = None
+    threads = 1
+    rate = None
+    duration = None
+    while sys.argv[1].startswith('-'):
+      if   sys.argv[1] == '-c':  # checkpoint file
+        checkpoint_path = sys.argv[2]
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-t':  # number of threads
+        threads = int(sys.argv[2])
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-r':  # bytes per second
+        rate = kmg(sys.argv[2]).get_value()
+        del sys.argv[1:3]
+      elif sys.argv[1] == '-T':  # seconds to run at most
+        duration = float(sys.argv[2])
+        del sys.argv[1:3]
+      else:
+        print("bad option:", sys.argv[1])
+        sys.exit(1)
+    scrubber = Scrubber(sys.argv[1], checkpoint_path, threads, rate)
+    if os.isatty(sys.stdout.fileno()):
+      sys.stdout.write(TTY.save + TTY.buffer1 + TTY.clear)
+      sys.stdout.flush()
+      try:
+        scrubber.run(duration, display_scrub)
+      finally:
+        sys.stdout.write(TTY.clear + TTY.buffer0 + TTY.restore)
+        sys.stdout.flush()
+    else:
+      scrubber.run(duration)
+    for path, problem in scrubber.mismatches:
+      print("mismatch:", path, problem)
+    for path in scrubber.missing:
+      print("missing:", path)
+    for path in scrubber.changed:
+      print("changed:", path)
+    print(scrubber.summary())
+    if scrubber.mismatches or scrubber.missing:
+      sys.exit(1)
+  elif sys.argv[1] == 'bench':
+    del sys.argv[1]
+    benchmark_traversal(*[ int(arg) for arg in sys.argv[1:] ])
   else:
     print("bad command:", sys.argv[1])
     sys.exit(1)
@@ -884,6 +3207,9 @@ def prepare_tty():
   global stdin_fd
   stdin_fd = sys.stdin.fileno()  # will most likely be 0
   global old_stdin_config
+  old_stdin_config = None
+  if not os.isatty(stdin_fd):  # e. g. in a pipe, nothing to prepare
+    return
   old_stdin_config = termios.tcgetattr(stdin_fd)
   [ iflag, oflag, cflag,
     lflag, ispeed, ospeed, cc ] = termios.tcgetattr(stdin_fd)
@@ -909,6 +3235,8 @@ def prepare_tty():
                     [ iflag, oflag, cflag, lflag, ispeed, ospeed, cc ])
 
 def cleanup_tty():
+  if old_stdin_config is None:  # nothing was prepared?
+    return
   termios.tcsetattr(stdin_fd, termios.TCSADRAIN, old_stdin_config)
 
 if __name__ == '__main__':
@@ -13,6 +13,21 @@ def process_line(line):
 
   return re.sub(r'\d{5,}', group_thousands, line)
 
+def parse(text):
+  """
+  parses a number with an optional suffix (k, M, G, T as powers of 1000,
+  Ki, Mi, Gi, Ti as powers of 1024, an optional trailing B is ignored)
+  """
+  match = re.match(r'^\s*(\d+(?:\.\d*)?|\.\d+)\s*([kKMGT]?)(i?)B?\s*$', text)
+  if not match:
+    raise ValueError("bad number: %r" % text)
+  number, prefix, binary = match.groups()
+  exponent = ' kMGT'.index(prefix) if prefix != 'K' else 1
+  if binary and not prefix:
+    raise ValueError("bad number: %r" % text)
+  value = float(number) * (1024 if binary else 1000) ** exponent
+  return int(value) if value == int(value) else value
+
 def process(stream):
   for line in stream:
     yield process_line(line)
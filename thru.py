@@ -10,6 +10,21 @@
 #     to a fifo.
 #     thru reads commands to set new current limits from another fifo.
 #
+#     thru also listens on a unix socket; each connected client can send
+#     requests (JSON lists, one per line) and gets one response line per
+#     request (["ok", ...] or ["error", <text>]).  the request
+#     ["subscribe"] makes thru send each report (the same JSON list as in
+#     the report fifo) to that client, so any number of watchers can
+#     subscribe; other requests are ["report"] and the commands also
+#     accepted on the control fifo (["delay", <delay>] etc.).
+#
+#     thru publishes its counters in a shared memory file ("stats", see
+#     StatsSegment), which watchers of many thrus read without involving
+#     the thru processes at all.
+#
+#     thru --daemon handles many pipes in one process (see Daemon);
+#     thru --attach hands its stdin and stdout over to it and exits.
+#
 
 usage = """
 Usage: %s [options] [commands or name]
@@ -27,6 +42,15 @@ Usage: %s [options] [commands or name]
   is chosen as name.
 
   Options include:
+    --daemon
+        run a daemon which handles the pipes of all attaching processes
+        (see --attach) in this one process
+    --attach
+        pass stdin and stdout (with the given name and options) to the
+        running daemon and exit instead of passing the data through this
+        process; the pipe can be watched and controlled like others
+        (not possible with --group, --spill, --records, --compress and
+        --hash)
     -q    be quiet about problems
     -u    use human readable display for sizes
     -v    be verbose about what is happening
@@ -35,18 +59,106 @@ Usage: %s [options] [commands or name]
         (defaults to 0)
     -b <bufferSize>
         use given buffer size (defaults to 64k)
+    --tune
+        enlarge stdin and stdout (if they are pipes) up to
+        /proc/sys/fs/pipe-max-size and adapt the buffer size while
+        running to get the most throughput (not while the rate limit or
+        a delay (-d) is what limits the throughput)
+    -c    always copy through a buffer in user space (by default, data
+        is moved using splice(2) if stdin or stdout is a pipe and using
+        sendfile(2) if stdin is a regular file, so it never gets copied
+        into this process)
     -g <granularity>
         use given granularity (in seconds) for reporting (defaults to 1)
+    -r <rate>
+        limit the throughput to the given number of bytes per second
+        (suffixes like k, M, G, Ki, Mi, Gi are allowed; defaults to 0,
+        which means no limit)
+    --group <group>
+        share a rate limit with all other processes of the given group:
+        -r (if given) sets the limit of the whole group, each process
+        gets a share according to its weight, and bandwidth a process
+        does not need is split among the others
+    --weight <weight>
+        use the given weight for sharing the rate limit of a group
+        (defaults to 1)
+    --spill <directory>
+        if the consumer stalls, keep reading input into a (deleted,
+        memory mapped) spill file in the given directory, and write it
+        out first when the consumer recovers; this sets stdout to
+        non-blocking mode
+    --spill-limit <size>
+        use at most this many bytes for the spill file (defaults to 1G)
+    --records <format>
+        pass whole records only, never a part of one before a delay:
+        "lines" (ending with a newline) or records with a big endian
+        binary length prefix "u8", "u16", "u32", "u64" (or little endian
+        "u16le", "u32le", "u64le"); implies -c, a record larger than the
+        buffer enlarges it, an incomplete record at the end is passed
+        as is (not possible with --spill)
+    --record-rate <rate>
+        with --records, limit the throughput to the given number of
+        records per second as well (defaults to 0, no limit)
+    --compress <codec>
+        compress the data using "zlib" (the output is gzip format),
+        "bz2" or "lzma" (xz format); blocks are compressed independently
+        by a pool of threads, so the output consists of several members
+        which the usual tools (gzip -d etc.) decompress as one; implies
+        -c, the rate limit (-r) applies to the compressed output (not
+        possible with --spill and --records)
+    --decompress <codec>
+        decompress the data (of one or more members) using "zlib" (zlib
+        or gzip format), "bz2" or "lzma"; this happens in one thread, but
+        in parallel to the reading and writing; the rate limit (-r)
+        applies to the compressed input
+    --threads <count>
+        use this many threads for --compress (defaults to the number of
+        CPUs)
+    --block-size <size>
+        compress (or decompress) blocks of this size (defaults to 1M)
+    --hash <algorithms>
+        compute digests (comma separated hashlib names like sha256,md5)
+        of the output in a background thread; at EOF they are written to
+        the --hash-file (if given) and sent as part of a last report;
+        implies -c (not possible with --spill)
+    --hash-file <path>
+        write the digests to this file at EOF (one "SHA256 (<label>) =
+        <digest>" line per algorithm, as written by sha256sum --tag)
+    --hash-label <label>
+        name the data in the --hash-file like this, e. g. the file the
+        output is written to (defaults to "-", so sha256sum -c checks
+        its stdin)
+    -f <framesPerSecond>
+        repaint -W output this often (defaults to 2)
+    -s <order>
+        sort -W output by "name" (default), "rate" or "bytes"
+    -t <burst>
+        allow bursts of up to the given number of bytes after a pause
+        when limiting the rate (defaults to the buffer size); output is
+        written in pieces of at most this size
 
   Commands include:
     -h    print this help
     -l    list names of all running processes
     -w <name>
-        watch given process; output is "name delay buffer amount rate"
-        where <rate> is bytes per second in the period since the last
-        report
+        watch given process; output is "name delay buffer amount rate
+        in out delay bottleneck" where <rate> is bytes per second in the
+        period since the last report (followed by "/<target>" if the
+        rate is limited), <in>, <out> and <delay> are the shares of that
+        period spent waiting for input, for output and delaying, and
+        <bottleneck> is "input" (the producer is slow), "output" (the
+        consumer is slow), "delay" (the limits) or "thru" (copying);
+        with -v the histograms of read and write sizes and latencies of
+        the last full second are shown as well; with --spill, "spill
+        <used>/<limit>" is appended, with --compress or --decompress
+        "ratio <ratio>" (output bytes per input byte), with --hash the
+        digests (after EOF)
     -W [<names>]
-        watch the given processes (or all if none is given)
+        watch the given processes (or all if none is given, then
+        processes are added and removed as they come and go); shows a
+        line with totals and one line per process (like -w, plus the
+        seconds spent blocked on reading and on writing), repainted with
+        a fixed frame rate (see -f and -s)
     -D <name> <delay>
         set the delay of the process with the given name remotely
         (see -d for details)
@@ -56,20 +168,750 @@ Usage: %s [options] [commands or name]
     -G <name> <granularity>
         set the granularity of the process with the given name remotely
         (see -g for details)
+    -R <name> <rate> [<burst>]
+        set the rate limit of the process with the given name remotely
+        (see -r and -t for details; for a process in a group, this sets
+        the limit of the group)
+    -L <group> <rate>
+        set the rate limit of the given group (which need not have any
+        processes yet); the file of a group (<group>.group in
+        /run/shm/thru) is removed when it has no rate limit (0) and no
+        processes left
+    --benchmark [<size>]
+        pass size bytes (defaults to 1G) through cat, through thru with
+        several options (buffer sizes of 4k, 64k and 1M with and without
+        -c, --tune, --hash) and through tee with sha256sum, best of three
+        runs each, and print the throughputs (relative to cat)
 
   Examples:
     cat very_large_file | thru | uploader_script
+    cat very_large_file | thru -r 40M | uploader_script
+    cat file1 | thru --group uploads -r 200M | uploader_script &
+    cat file2 | thru --group uploads --weight 2 | uploader_script &
     od < /dev/urandom | thru -b 1 -d 0.04
 """
 
-import sys, select, os, array, random, atexit, time, json, re
+import sys, select, os, random, atexit, time, json, re, stat, errno, socket
+import collections, zlib, hashlib, threading, queue, subprocess
+import mmap, struct, ctypes, fcntl, contextlib, tempfile, asyncio, signal
+import importlib, concurrent.futures
 
 import kmg
 
+class TokenBucket(object):
+  """
+  limits a rate (bytes per second) using time.monotonic(); tokens are
+  refilled continuously up to burst; taking more tokens than available is
+  allowed, but the debt has to be paid off before taking again
+  """
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.lastTime = time.monotonic()
+
+  def refill(self):
+    now = time.monotonic()
+    self.tokens = min(self.burst,
+                      self.tokens + (now - self.lastTime) * self.rate)
+    self.lastTime = now
+    return now
+
+  def take(self, count):
+    self.refill()
+    self.tokens -= count
+
+  def readyTime(self, count=0):
+    """
+    returns the (monotonic) time at which tokens can be taken again (or
+    at which count tokens are available, at most burst)
+    """
+    now = self.refill()
+    count = min(count, self.burst)
+    if self.tokens >= count:
+      return now
+    return now + (count - self.tokens) / self.rate
+
+class Histogram(object):
+  """
+  counts values in power-of-two buckets: bucket i counts the values v
+  with v.bit_length() == i, i.e. 2**(i-1) <= v < 2**i
+  """
+  def __init__(self):
+    self.counts = [ 0 ] * 64
+
+  def add(self, value):
+    self.counts[min(int(value).bit_length(), 63)] += 1
+
+  def summary(self):
+    "returns the non-empty buckets as a dict (lower bound -> count)"
+    return { 1 << i >> 1: count
+             for i, count in enumerate(self.counts) if count }
+
+def formatHistogram(summary):
+  "returns a histogram summary (as parsed from JSON) as a short text"
+  return ' '.join('%s:%d' % (bound, count) for bound, count in
+                  sorted(summary.items(), key=lambda item: int(item[0])))
+
+class StatsSegment(object):
+  """
+  the counters of a Copier in a fixed-layout shared memory file; the
+  copier publishes, any number of readers read without locking: the
+  sequence number is odd during an update, so readers retry if it is odd
+  or has changed while reading (a seqlock)
+  """
+  version = 3
+  sequenceLayout = struct.Struct('=Q')
+  layout = struct.Struct('=IIdQQdddddddQQd')
+  fields = ('version', 'pid', 'startTime', 'writtenBytes', 'bufferSize',
+            'delay', 'rate', 'achievedRate', 'readWait', 'writeWait',
+            'delayWait', 'updateTime', 'spillUsed', 'spillLimit', 'ratio')
+  size = sequenceLayout.size + layout.size
+
+  def __init__(self, path, create=False):
+    if create:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+      os.ftruncate(fd, self.size)
+    else:
+      fd = os.open(path, os.O_RDONLY)
+    try:
+      self.map = mmap.mmap(fd, self.size, mmap.MAP_SHARED,
+          mmap.PROT_READ | mmap.PROT_WRITE if create else mmap.PROT_READ)
+    finally:
+      os.close(fd)
+    self.sequence = 0
+
+  def publish(self, **values):
+    "updates the segment (only one process may do this)"
+    self.sequence += 1  # odd: update in progress
+    self.sequenceLayout.pack_into(self.map, 0, self.sequence)
+    values.update(version=self.version, pid=os.getpid(),
+                  updateTime=time.monotonic())
+    self.layout.pack_into(self.map, self.sequenceLayout.size,
+                          *(values.get(field, 0) for field in self.fields))
+    self.sequence += 1
+    self.sequenceLayout.pack_into(self.map, 0, self.sequence)
+
+  def read(self, attempts=1000):
+    """
+    returns a consistent snapshot of the values as a dict (None if none
+    could be read)
+    """
+    for attempt in range(attempts):
+      before, = self.sequenceLayout.unpack_from(self.map, 0)
+      if before & 1 or before == 0:  # update in progress or none yet?
+        continue
+      values = self.layout.unpack_from(self.map, self.sequenceLayout.size)
+      after, = self.sequenceLayout.unpack_from(self.map, 0)
+      if before == after and values[0] == self.version:
+        return dict(zip(self.fields, values))
+    return None
+
+  def close(self):
+    self.map.close()
+
+def fairShares(rate, members):
+  """
+  splits rate among members (key -> (weight, demand)) by weighted max-min
+  fairness: members demanding less than their weighted share get their
+  demand, the rest is split among the others (demand None: unlimited);
+  returns a dict key -> share
+  """
+  shares = {}
+  unsatisfied = dict(members)
+  while unsatisfied:
+    totalWeight = sum(weight for weight, demand in unsatisfied.values())
+    satisfied = { key: demand
+                  for key, (weight, demand) in unsatisfied.items()
+                  if demand is not None and
+                     demand <= rate * weight / totalWeight }
+    if not satisfied:
+      for key, (weight, demand) in unsatisfied.items():
+        shares[key] = rate * weight / totalWeight
+      break
+    for key, demand in satisfied.items():
+      shares[key] = demand
+      rate -= demand
+      del unsatisfied[key]
+  return shares
+
+class BandwidthGroup(object):
+  """
+  a group of thrus sharing a rate limit via a file in shared memory
+  (<homeDir>/<name>.group, locked using flock while used); each member
+  has a slot with its weight, its current demand (measured rate plus some
+  room, plus a lot if it often has to wait for its share), whether it was
+  throttled, and the time of its last update; each
+  member computes its own share of the group rate from all slots using
+  fairShares(); slots not updated for staleAfter seconds are ignored and
+  can be taken over, so idle or dead members do not take bandwidth (a
+  member whose slot was taken over claims a new one); the last member
+  leaving a group without a rate limit removes its file
+  """
+  version = 1
+  maxMembers = 1024
+  staleAfter = 1.0
+  headerLayout = struct.Struct('=IId')  # version, unused, rate
+  slotLayout = struct.Struct('=IIddd')
+  # ^^^ pid, throttled, weight, demand, updateTime
+  size = headerLayout.size + maxMembers * slotLayout.size
+
+  def __init__(self, name, weight=1.0, rate=None):
+    self.weight = weight
+    self.path = os.path.join(homeDir, name + '.group')
+    self.fd = self.openLocked(self.path)
+    try:
+      if os.fstat(self.fd).st_size < self.size:
+        os.ftruncate(self.fd, self.size)
+      self.map = mmap.mmap(self.fd, self.size)
+      version, unused, groupRate = self.headerLayout.unpack_from(self.map, 0)
+      if version != self.version:  # new group
+        self.headerLayout.pack_into(self.map, 0, self.version, 0, 0.0)
+      if rate is not None:
+        self.writeRate(rate)
+      self.slot = self.claimSlot()
+    finally:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  @staticmethod
+  def openLocked(path):
+    "opens and locks a group file (which its last member may remove)"
+    while True:
+      fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      try:
+        if os.stat(path).st_ino == os.fstat(fd).st_ino:
+          return fd
+      except FileNotFoundError:  # removed before we got the lock
+        pass
+      os.close(fd)  # try again with the current file
+
+  @contextlib.contextmanager
+  def locked(self):
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    try:
+      yield
+    finally:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  def slotOffset(self, slot):
+    return self.headerLayout.size + slot * self.slotLayout.size
+
+  def readSlots(self):
+    "yields slot, (pid, throttled, weight, demand, updateTime) of all slots"
+    for slot in range(self.maxMembers):
+      yield slot, self.slotLayout.unpack_from(self.map, self.slotOffset(slot))
+
+  def claimSlot(self):
+    now = time.monotonic()
+    for slot, (pid, throttled, weight, demand, updateTime) in \
+        self.readSlots():
+      if pid == 0 or now - updateTime > self.staleAfter:
+        self.slotLayout.pack_into(self.map, self.slotOffset(slot),
+                                  os.getpid(), 1, self.weight, 0.0, now)
+        return slot
+    raise Exception("too many members in bandwidth group")
+
+  def ownsSlot(self):
+    "returns whether our slot is still ours (call while locked)"
+    pid = self.slotLayout.unpack_from(self.map, self.slotOffset(self.slot))[0]
+    return pid == os.getpid()
+
+  def writeRate(self, rate):
+    self.headerLayout.pack_into(self.map, 0, self.version, 0, float(rate))
+
+  def setRate(self, rate):
+    with self.locked():
+      self.writeRate(rate)
+
+  def share(self, demand, throttled):
+    """
+    publishes the demand (bytes per second) of this member and returns
+    its share of the group rate (0 if the group is not limited)
+    """
+    now = time.monotonic()
+    with self.locked():
+      if not self.ownsSlot():  # taken over while we were blocked
+        self.slot = self.claimSlot()
+      self.slotLayout.pack_into(self.map, self.slotOffset(self.slot),
+          os.getpid(), throttled, self.weight, demand, now)
+      version, unused, rate = self.headerLayout.unpack_from(self.map, 0)
+      members = { slot: (weight, demand)
+                  for slot, (pid, throttled, weight, demand, updateTime)
+                  in self.readSlots()
+                  if pid != 0 and now - updateTime <= self.staleAfter }
+    if not rate:
+      return 0
+    return fairShares(rate, members)[self.slot]
+
+  @classmethod
+  def setGroupRate(cls, name, rate):
+    "sets the rate limit of the given group (maybe new) without joining it"
+    os.makedirs(homeDir, exist_ok=True)
+    fd = cls.openLocked(os.path.join(homeDir, name + '.group'))
+    try:
+      if os.fstat(fd).st_size < cls.size:
+        os.ftruncate(fd, cls.size)
+      with mmap.mmap(fd, cls.size) as map:
+        cls.headerLayout.pack_into(map, 0, cls.version, 0, float(rate))
+        if not rate and not cls.hasMembers(map):
+          os.unlink(os.path.join(homeDir, name + '.group'))
+    finally:
+      os.close(fd)  # also unlocks
+
+  @classmethod
+  def hasMembers(cls, map):
+    "returns whether a slot of the mapped group file has a running owner"
+    for slot in range(cls.maxMembers):
+      pid = cls.slotLayout.unpack_from(
+        map, cls.headerLayout.size + slot * cls.slotLayout.size)[0]
+      if pid != 0 and isRunning(pid):
+        return True
+    return False
+
+  def leave(self):
+    with self.locked():
+      if self.ownsSlot():
+        self.slotLayout.pack_into(self.map, self.slotOffset(self.slot),
+                                  0, 0, 0.0, 0.0, 0.0)
+      version, unused, rate = self.headerLayout.unpack_from(self.map, 0)
+      if not rate and not self.hasMembers(self.map):
+        os.unlink(self.path)  # nothing left to share
+    self.map.close()
+    os.close(self.fd)
+
+class SpillBuffer(object):
+  """
+  a ring buffer in a memory mapped file (deleted on creation) which can
+  hold up to limit bytes; data is read into it from an fd (fill) and
+  written from it to an fd (drain) in FIFO order
+  """
+  def __init__(self, directory, limit):
+    self.file = tempfile.TemporaryFile(dir=directory, prefix='thru-spill.')
+    os.ftruncate(self.file.fileno(), limit)  # sparse
+    self.map = mmap.mmap(self.file.fileno(), limit)
+    self.view = memoryview(self.map)
+    self.limit = limit
+    self.head = 0  # position of the oldest byte
+    self.used = 0
+
+  def room(self):
+    return self.limit - self.used
+
+  def fill(self, fd):
+    "reads as much as possible from fd, returns the count (0 at EOF)"
+    tail = (self.head + self.used) % self.limit
+    if tail >= self.head and self.used < self.limit:  # free part wraps
+      pieces = [ self.view[tail:self.limit], self.view[0:self.head] ]
+    else:
+      pieces = [ self.view[tail:self.head] ]
+    count = os.readv(fd, [ piece for piece in pieces if len(piece) ])
+    self.used += count
+    return count
+
+  def drain(self, fd, maxCount):
+    "writes up to maxCount bytes to fd, returns the count"
+    end = min(self.limit, self.head + self.used, self.head + maxCount)
+    count = os.write(fd, self.view[self.head:end])
+    self.used -= count
+    self.head = (self.head + count) % self.limit if self.used else 0
+    return count
+
+  def close(self):
+    self.view.release()
+    self.map.close()
+    self.file.close()
+
+class RecordFormat(object):
+  """
+  finds the boundaries of records in a buffer: lines (ending with a
+  newline) or records whose length is given by a binary prefix
+  """
+  prefixFormats = { 'u8': '>B', 'u16': '>H', 'u32': '>I', 'u64': '>Q',
+                    'u16le': '<H', 'u32le': '<I', 'u64le': '<Q' }
+
+  def __init__(self, name):
+    if name == 'lines':
+      self.prefix = None
+    elif name in self.prefixFormats:
+      self.prefix = struct.Struct(self.prefixFormats[name])
+    else:
+      raise CommandFailed("unknown record format: %r" % name)
+
+  def length(self, buffer, start, end):
+    "returns the length of the record at start, None if not yet known"
+    if self.prefix is None:
+      newline = buffer.find(b'\n', start, end)
+      return None if newline < 0 else newline + 1 - start
+    if end - start < self.prefix.size:
+      return None
+    return self.prefix.size + self.prefix.unpack_from(buffer, start)[0]
+
+  def complete(self, buffer, scanned, end):
+    """
+    returns whether the record at the beginning of the buffer is complete
+    (only bytes after scanned have to be scanned for a newline)
+    """
+    if self.prefix is None:
+      return buffer.find(b'\n', scanned, end) >= 0
+    length = self.length(buffer, 0, end)
+    return length is not None and length <= end
+
+  def split(self, buffer, end, maxBytes, maxRecords=None):
+    """
+    returns the end of the whole records at the beginning of the buffer
+    and their number, at most maxRecords (None: no limit) in at most
+    maxBytes; but a complete first record is returned in any case as
+    records are never split
+    """
+    if self.prefix is None:  # scan and count lines in C, not per record
+      last = buffer.rfind(b'\n', 0, min(end, maxBytes))
+      if last >= 0:
+        count = buffer.count(b'\n', 0, last + 1)
+        if maxRecords is None or count <= maxRecords:
+          return last + 1, count
+        position = 0
+        for i in range(maxRecords):
+          position = buffer.find(b'\n', position, last + 1) + 1
+        return position, maxRecords
+    position = count = 0
+    while maxRecords is None or count < maxRecords:
+      length = self.length(buffer, position, end)
+      if (length is None or position + length > end or
+          count and position + length > maxBytes):
+        break
+      position += length
+      count += 1
+    return position, count
+
+class CompressionStage(object):
+  """
+  compresses (or decompresses) blocks of input in a pool of threads (the
+  codecs release the GIL) and returns the results in input order; the
+  completion of a block is signalled on a pipe (wakeFd) for select();
+  decompression yields at most blockSize bytes per result, the rest of
+  the expansion follows in further results
+  """
+  codecs = ('zlib', 'bz2', 'lzma')
+
+  def __init__(self, codec, decompress, threads, blockSize):
+    if codec not in self.codecs:
+      raise CommandFailed("unknown codec: %r" % codec)
+    try:
+      self.module = importlib.import_module(codec)
+    except ImportError as problem:
+      raise CommandFailed("codec %s not available: %s" % (codec, problem))
+    self.codec = codec
+    self.decompress = decompress
+    self.decompressor = None
+    self.input = b''  # not yet decompressed (the output limit was reached)
+    self.more = False  # whether decompressing self.input may yield more
+    self.problem = None  # raised after the output decompressed before it
+    self.errors = (zlib.error, OSError, EOFError) + (
+      (self.module.LZMAError,) if codec == 'lzma' else ())
+    if decompress:
+      threads = 1  # one stream, no known block boundaries
+    self.pool = concurrent.futures.ThreadPoolExecutor(threads)
+    self.maxPending = 2 * threads
+    self.pending = collections.deque()  # futures of (result, input size)
+    self.blockSize = blockSize
+    self.newBlock()
+    self.inputBytes = self.outputBytes = 0  # of the finished blocks
+    self.wakeFd, self.wakeWriteFd = os.pipe()
+    os.set_blocking(self.wakeFd, False)
+    os.set_blocking(self.wakeWriteFd, False)
+
+  def newBlock(self):
+    self.block = bytearray(self.blockSize)
+    self.blockView = memoryview(self.block)
+    self.filled = 0
+
+  def room(self):
+    "returns whether another block can be filled now"
+    return len(self.pending) < self.maxPending and not self.more
+    # ^^^ no further input while decompressed output is held back
+
+  def space(self):
+    "returns the unfilled part of the current block to read into"
+    return self.blockView[self.filled:]
+
+  def commit(self, count):
+    "takes count bytes read into space(); passes the block on when full"
+    self.filled += count
+    if self.filled == self.blockSize:
+      self.submit(self.block)
+      self.newBlock()
+
+  def finish(self):
+    "passes on the last (partial) block at EOF"
+    if self.filled:
+      self.submit(self.blockView[:self.filled].tobytes())
+      self.newBlock()
+
+  def submit(self, block):
+    future = self.pool.submit(
+      self.decompressBlock if self.decompress else self.compressBlock, block)
+    future.add_done_callback(self.wakeUp)
+    self.pending.append(future)
+
+  def wakeUp(self, future):
+    try:
+      os.write(self.wakeWriteFd, b'.')
+    except BlockingIOError:  # enough wake-ups pending already
+      pass
+
+  def clearWakeUps(self):
+    try:
+      os.read(self.wakeFd, 1 << 12)
+    except BlockingIOError:
+      pass
+
+  def compressBlock(self, block):
+    if self.codec == 'zlib':  # gzip format, so gzip -d can read it
+      compressor = zlib.compressobj(wbits=31)
+      result = compressor.compress(block) + compressor.flush()
+    else:
+      result = self.module.compress(block)
+    return result, len(block)
+
+  def decompressBlock(self, block):
+    """
+    decompresses the next part of the stream (of one or more members), up
+    to blockSize bytes; input left over is kept in self.input
+    """
+    if self.problem is not None:
+      raise self.problem
+    results = []
+    room = self.blockSize
+    data = self.input + block if self.input else block
+    more = self.more
+    while data or more:
+      if self.decompressor is None or self.decompressor.eof:
+        if not data:
+          break
+        self.decompressor = (zlib.decompressobj(wbits=47)  # zlib or gzip
+          if self.codec == 'zlib' else
+          self.module.BZ2Decompressor() if self.codec == 'bz2' else
+          self.module.LZMADecompressor())
+      try:
+        result = self.decompressor.decompress(data, room)
+      except self.errors as problem:
+        if not results:
+          raise
+        self.problem = problem  # raised by the next call
+        data, more = b'', False
+        break
+      results.append(result)
+      room -= len(result)
+      if self.decompressor.eof:
+        data = self.decompressor.unused_data
+      elif self.codec == 'zlib':
+        data = self.decompressor.unconsumed_tail
+      else:
+        data = b''  # kept by the decompressor
+      more = not room  # output may be pending in the decompressor
+      if more:
+        break
+    self.input = data
+    self.more = more
+    return b''.join(results), len(block)
+
+  def ready(self):
+    "returns whether the result of the oldest pending block is available"
+    return bool(self.pending) and self.pending[0].done()
+
+  def pop(self):
+    "returns the result of the oldest block and the size of its input"
+    try:
+      result, inputSize = self.pending.popleft().result()
+    except self.errors as problem:
+      raise self.failure(problem)
+    if self.decompress and self.more and not self.pending:
+      self.submit(b'')  # for the rest of the expansion
+    self.inputBytes += inputSize
+    self.outputBytes += len(result)
+    return result, inputSize
+
+  def failure(self, problem):
+    return CommandFailed("cannot %s %s data: %s" % (
+      'decompress' if self.decompress else 'compress', self.codec, problem))
+
+  def checkComplete(self):
+    "fails (at EOF) if the input ends within a compressed stream"
+    if self.problem is not None:
+      raise self.failure(self.problem)
+    if (self.decompress and self.decompressor is not None and
+        not self.decompressor.eof):
+      raise CommandFailed("%s input ends within a compressed stream" %
+                          self.codec)
+
+  def ratio(self):
+    "returns the output bytes per input byte so far"
+    return self.outputBytes / self.inputBytes if self.inputBytes else 0.0
+
+  def close(self):
+    self.pool.shutdown(cancel_futures=True)
+    os.close(self.wakeFd)
+    os.close(self.wakeWriteFd)
+
+class Hasher(object):
+  """
+  computes digests of data in a background thread (hashlib releases the
+  GIL for larger data); the data passed to add() must stay unchanged
+  until finished() returns true for the returned ticket
+  """
+  maxPending = 16  # views queued, then add() blocks
+  tags = { 'md5': 'MD5', 'sha1': 'SHA1', 'sha224': 'SHA224',
+           'sha256': 'SHA256', 'sha384': 'SHA384', 'sha512': 'SHA512',
+           'sha3_224': 'SHA3-224', 'sha3_256': 'SHA3-256',
+           'sha3_384': 'SHA3-384', 'sha3_512': 'SHA3-512',
+           'blake2b': 'BLAKE2b', 'sm3': 'SM3' }
+  # ^^^ the tags coreutils (sha256sum --tag etc.) use for hashlib names
+
+  def __init__(self, algorithms):
+    try:
+      self.hashes = [ hashlib.new(algorithm) for algorithm in algorithms ]
+    except ValueError as problem:
+      raise CommandFailed(str(problem))
+    self.queue = queue.Queue(self.maxPending)
+    self.added = 0  # tickets handed out
+    self.done = 0  # tickets hashed
+    self.condition = threading.Condition()
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      view = self.queue.get()
+      if view is None:
+        return
+      for hash in self.hashes:
+        hash.update(view)
+      with self.condition:
+        self.done += 1
+        self.condition.notify_all()
+
+  def add(self, view):
+    "queues the view for hashing and returns its ticket"
+    self.queue.put(view)
+    self.added += 1
+    return self.added
+
+  def finished(self, ticket):
+    return self.done >= ticket
+
+  def waitFor(self, ticket):
+    with self.condition:
+      self.condition.wait_for(lambda: self.done >= ticket)
+
+  def finish(self):
+    "waits for all queued data and returns the digests (name -> hex)"
+    self.queue.put(None)
+    self.thread.join()
+    return { hash.name: hash.hexdigest() for hash in self.hashes }
+
+class ControlConnection(object):
+  """
+  a client connected to the control socket of a Copier; the socket is
+  non-blocking, output is queued and flushed when the socket is writable,
+  so a slow client never stalls the copier (messages to a client which
+  does not read are dropped)
+  """
+  maxPending = 1 << 16
+
+  def __init__(self, clientSocket):
+    self.socket = clientSocket
+    self.socket.setblocking(False)
+    self.received = b''
+    self.pending = bytearray()
+    self.subscribed = False
+    self.closed = False
+
+  def fileno(self):
+    return self.socket.fileno()
+
+  def receive(self):
+    "returns the complete lines received so far"
+    try:
+      data = self.socket.recv(1 << 12)
+    except BlockingIOError:
+      return []
+    except OSError:
+      data = b''
+    if not data:
+      self.closed = True
+      return []
+    lines = (self.received + data).split(b'\n')
+    self.received = lines.pop()
+    return lines
+
+  def send(self, message):
+    if len(self.pending) > self.maxPending:  # client does not read?
+      return
+    self.pending += (json.dumps(message) + '\n').encode('utf-8')
+    self.flush()
+
+  def flush(self):
+    try:
+      sent = self.socket.send(self.pending)
+    except BlockingIOError:
+      return
+    except OSError:
+      self.closed = True
+      return
+    del self.pending[:sent]
+
+  def close(self):
+    self.closed = True
+    self.socket.close()
+
+def enlargePipe(fd):
+  """
+  raises the capacity of the given fd (if it is a pipe) as far as allowed
+  (up to /proc/sys/fs/pipe-max-size); returns the new capacity (None if
+  the fd is no pipe)
+  """
+  if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+    return None
+  setPipeSize = getattr(fcntl, 'F_SETPIPE_SZ', 1031)  # Linux only
+  getPipeSize = getattr(fcntl, 'F_GETPIPE_SZ', 1032)
+  current = fcntl.fcntl(fd, getPipeSize)
+  try:
+    with open('/proc/sys/fs/pipe-max-size') as maxSizeFile:
+      size = int(maxSizeFile.read())
+  except OSError:
+    size = 1 << 20  # the usual default
+  while size > current:
+    try:
+      return fcntl.fcntl(fd, setPipeSize, size)
+    except PermissionError:  # over the limit for this user
+      size //= 2
+  return current
+
+def chooseTransfer(inputFd, outputFd):
+  """
+  returns how data can be moved from inputFd to outputFd: 'splice' if one
+  of them is a pipe (and the other a pipe or a regular file), 'sendfile'
+  if the input is a regular file, else 'buffer' (read into and write from
+  a buffer in user space)
+  """
+  inputMode = os.fstat(inputFd).st_mode
+  outputMode = os.fstat(outputFd).st_mode
+  if hasattr(os, 'splice') and (
+      stat.S_ISFIFO(inputMode) and (stat.S_ISFIFO(outputMode) or
+                                    stat.S_ISREG(outputMode)) or
+      stat.S_ISFIFO(outputMode) and stat.S_ISREG(inputMode)):
+    return 'splice'
+  if hasattr(os, 'sendfile') and stat.S_ISREG(inputMode):
+    return 'sendfile'
+  return 'buffer'
+
 class Copier(object):
 
   class Drained(Exception): pass
 
+  blockedLatency = 0.001  # copying even 1M takes less
+
   def __init__(self, fifoPath, options):
     self.startTime = time.time()
     self.fifoPath = fifoPath
@@ -77,19 +919,236 @@ class Copier(object):
     self.bufferSize = options.bufferSize
     self.granularity = options.granularity
     self.delay = options.delay
+    self.bucket = None
+    self.group = None
+    self.setRate(options.rate, options.burst)
     self.verbose = options.verbose
     self.quiet = options.quiet
     # initialization
+    self.inputFd = sys.stdin.fileno()
+    self.outputFd = sys.stdout.fileno()
+    self.transfer = (chooseTransfer(self.inputFd, self.outputFd)
+                     if options.zeroCopy else 'buffer')
+    if self.verbose:
+      print("# transfer:", self.transfer, file=sys.stderr)
+    self.inputReady = False  # for zero-copy: data waiting in stdin?
+    self.inputDone = False  # EOF seen while spilling?
+    self.spill = None
+    self.outputBlockedSince = None
+    if options.spill is not None:
+      self.spill = SpillBuffer(options.spill, options.spillLimit)
+      if os.get_blocking(self.outputFd):  # shared with other processes
+        os.set_blocking(self.outputFd, False)
+        atexit.register(self.restoreBlocking)
+    self.records = None
+    self.recordBucket = None
+    if options.records is not None:
+      self.records = RecordFormat(options.records)
+      self.transfer = 'buffer'
+      self.recordReady = False  # first record in the buffer complete?
+      if options.recordRate:
+        self.recordBucket = TokenBucket(options.recordRate,
+                                        max(1.0, options.recordRate / 10.0))
+        # ^^^ a tenth of a second's worth of records in one go
+        self.recordBatch = self.recordBucket.burst / 2
+        # ^^^ records to wait for once the burst is spent (not one by one)
+    self.stage = None
+    if options.compress is not None:
+      codec, decompress = options.compress
+      self.stage = CompressionStage(codec, decompress,
+                                    options.threads or os.cpu_count() or 1,
+                                    options.blockSize)
+      self.transfer = 'buffer'
+      self.stageOutput = memoryview(b'')  # result being written
+      self.stageCharge = 1.0  # rate limit tokens per byte written
+    self.hasher = None
+    self.hashTicket = 0  # of the last view of the buffer queued for hashing
+    self.digests = {}
+    self.hashFile = options.hashFile
+    self.hashLabel = options.hashLabel
+    if options.hash is not None:
+      self.hasher = Hasher(options.hash)
+      self.transfer = 'buffer'
+    self.delayedUntil = 0.0  # time of the last output plus the delay
     self.newBufferSize = None  # used for re-init during runtime
     self.writtenBytes = 0
     self.initBuffer()
     self.initFifos()
+    self.initSocket()
     self.nextOutputTime = 0.0
+    self.nextGroupTime = float('inf')  # no group
+    self.tuning = None
+    if options.tune:
+      pipeSizes = [ enlargePipe(fd) for fd in (self.inputFd, self.outputFd) ]
+      if self.verbose:
+        print("# pipe sizes:", pipeSizes, file=sys.stderr)
+      self.maxTunedSize = max([ size for size in pipeSizes if size ] or
+                              [ 1 << 20 ])
+      self.tuning = (time.monotonic(), 0, 0.0, 0.0, 2)
+      # ^^^ time and bytes written at the start of the period, delayWait
+      #     then, throughput of the period before, factor of the last step
+      self.nextTuneTime = time.monotonic() + self.tuneInterval
+    self.readWait = self.writeWait = self.delayWait = 0.0
+    self.histogramStart = time.monotonic()
+    self.histograms = self.newHistograms()
+    self.lastHistograms = self.newHistograms()
+    self.achievedRate = 0.0
+    self.lastReport = (time.monotonic(), 0)
+    if options.group is not None:
+      self.burst = options.burst
+      self.group = BandwidthGroup(options.group, options.weight,
+                                  options.rate or None)
+      atexit.register(self.group.leave)
+      self.groupStatus = (time.monotonic(), 0, 0.0, 0.0)
+      # ^^^ time of the last share update, bytes written and delayWait
+      #     then, usage (bytes/s)
+      self.updateShare()
+    self.stats = StatsSegment(os.path.join(self.fifoPath, 'stats'),
+                              create=True)
+    self.publishStats()
 
   def initBuffer(self):
-    self.buffer = array.array('b')
-    self.buffer.frombytes(b'-' * self.bufferSize)
+    if self.transfer == 'buffer':
+      self.buffer = bytearray(self.bufferSize)
+      self.bufferView = memoryview(self.buffer)
     self.bufferByteCount = 0
+    self.bufferStart = 0  # bytes of the buffer already written
+
+  def resizeBuffer(self, size):
+    "replaces the buffer by one of the given size, keeping its content"
+    buffer = bytearray(size)
+    buffer[:self.bufferByteCount] = self.bufferView[:self.bufferByteCount]
+    self.buffer = buffer
+    self.bufferView = memoryview(buffer)
+
+  def setRate(self, rate, burst=None):
+    if not rate:
+      self.bucket = None
+    else:
+      self.bucket = TokenBucket(rate, burst or self.bufferSize)
+
+  groupInterval = 0.1  # seconds between updates of the share of a group
+
+  def updateShare(self):
+    """
+    publishes the current demand in the bandwidth group and adopts the
+    resulting share as rate
+    """
+    now = time.monotonic()
+    lastTime, lastBytes, lastDelayWait, usage = self.groupStatus
+    duration = max(now - lastTime, 1e-3)
+    usage = 0.7 * usage + 0.3 * (self.writtenBytes - lastBytes) / duration
+    # ^^^ smoothed, so pauses between bursts do not count as idling
+    throttled = (self.bucket is not None and
+                 (self.delayWait - lastDelayWait) / duration >= 0.25)
+    # ^^^ often waited for its share, so it probably needs more
+    share = self.group.share(
+      usage * (2.0 if throttled else 1.25) + (1 << 16), throttled)
+    # ^^^ leave room to grow, a throttled member asks for a lot more
+    self.groupStatus = (now, self.writtenBytes, self.delayWait, usage)
+    self.nextGroupTime = now + self.groupInterval
+    if not share:
+      self.bucket = None
+    elif self.bucket is None:
+      self.setRate(share, self.burst)
+    else:
+      self.bucket.refill()
+      self.bucket.rate = share
+      self.nextOutputTime = max(self.delayedUntil, self.bucket.readyTime())
+
+  tuneInterval = 0.5  # seconds to measure one buffer size
+  minTunedSize = 1 << 12  # 4k
+
+  def tuneBufferSize(self):
+    """
+    compares the throughput of the last period with the one before and
+    changes the buffer size (by a factor of 2) in the same direction as
+    before if it got better, else in the other direction (hill climbing);
+    keeps the size while the delay or the rate limit is the bottleneck
+    """
+    now = time.monotonic()
+    lastTime, lastBytes, lastDelayWait, lastRate, factor = self.tuning
+    duration = now - lastTime
+    rate = (self.writtenBytes - lastBytes) / duration
+    delayed = (self.delay > 0 or
+               (self.delayWait - lastDelayWait) / duration >= 0.25)
+    if not delayed and rate > 0 and self.newBufferSize is None:
+      if rate < lastRate:  # got worse, turn around
+        factor = 1 / factor
+      size = int(min(self.maxTunedSize,
+                     max(self.minTunedSize, self.bufferSize * factor)))
+      if size != self.bufferSize:
+        self.newBufferSize = size
+        if self.verbose:
+          print("# tuned buffer size: %d (%.0f B/s)" % (size, rate),
+                file=sys.stderr)
+      else:  # at a limit, try the other way next time
+        factor = 1 / factor
+    self.tuning = (now, self.writtenBytes, self.delayWait, rate, factor)
+    self.nextTuneTime = now + self.tuneInterval
+
+  def transferSize(self):
+    "returns the maximum number of bytes to pass in one write"
+    if self.bucket is None:
+      return self.bufferSize
+    return max(1, min(self.bufferSize, int(self.bucket.burst)))
+
+  def newHistograms(self):
+    return { kind: Histogram() for kind in
+             ('readSize', 'readLatency', 'writeSize', 'writeLatency') }
+
+  def recordCall(self, kind, size, latency):
+    """
+    counts a read or write call (kind) of size bytes which took latency
+    seconds in the histograms of the current second; a call taking more
+    than blockedLatency seconds has been blocked, so it counts as waiting
+    """
+    if latency > self.blockedLatency:
+      if kind == 'read':
+        self.readWait += latency
+      else:
+        self.writeWait += latency
+    now = time.monotonic()
+    if now >= self.histogramStart + 1.0:  # next second begins
+      self.lastHistograms = (self.histograms
+        if now < self.histogramStart + 2.0 else self.newHistograms())
+      self.histograms = self.newHistograms()
+      self.histogramStart = now
+    self.histograms[kind + 'Size'].add(size)
+    self.histograms[kind + 'Latency'].add(latency * 1e6)  # microseconds
+
+  def canRead(self):
+    if self.inputDone or self.spill is not None and self.spill.used:
+      return False  # input goes into the spill buffer until it is empty
+    if self.stage is not None:
+      return self.stage.room()
+    if self.records is not None:  # buffer not yet full?
+      return self.bufferByteCount < len(self.buffer)
+    if self.transfer == 'buffer':
+      # buffer not yet full?
+      return self.bufferByteCount < self.transferSize()
+    return not self.inputReady
+
+  def canWrite(self):
+    if self.spill is not None and self.spill.used:
+      return True
+    if self.records is not None:  # incomplete records only at the end
+      return self.recordReady or self.inputDone and self.bufferByteCount > 0
+    if self.stage is not None:
+      return bool(self.stageOutput) or self.stage.ready()
+    if self.transfer == 'buffer':
+      return self.bufferByteCount > self.bufferStart
+    return self.inputReady
+
+  spillAfter = 0.1  # seconds the output has to be blocked before spilling
+
+  def canSpill(self):
+    "returns whether input shall be read into the spill buffer now"
+    if self.spill is None or self.inputDone or not self.spill.room():
+      return False
+    return bool(self.spill.used) or (
+      self.outputBlockedSince is not None and
+      time.monotonic() >= self.outputBlockedSince + self.spillAfter)
 
   def initFifos(self):
     reportPath = os.path.join(self.fifoPath, 'report')
@@ -101,76 +1160,202 @@ class Copier(object):
     self.controlFifo = os.open(controlPath, os.O_RDONLY | os.O_NONBLOCK)
     self.nextReportTime = 0.0
 
+  def initSocket(self):
+    self.controlSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.controlSocket.bind(os.path.join(self.fifoPath, 'socket'))
+    self.controlSocket.listen(16)
+    self.controlSocket.setblocking(False)
+    self.connections = {}  # client socket -> ControlConnection
+
   def copy(self):
     while True:  # until Drained
       channels = self.selectChannels()
+      if self.group is not None and time.monotonic() >= self.nextGroupTime:
+        self.updateShare()
+      if self.tuning is not None and time.monotonic() >= self.nextTuneTime:
+        self.tuneBufferSize()
       if self.controlFifo in channels:
         self.handleCommand(self.readCommand())
+      if self.stage is not None and self.stage.wakeFd in channels:
+        self.stage.clearWakeUps()
+      self.handleConnections(channels)
       if self.reportFifo in channels:
         self.report()
-      if self.bufferByteCount > 0:
+      if self.canWrite():
         if (sys.stdout in channels and
-          time.time() >= self.nextOutputTime):
-          self.nextOutputTime = time.time() + self.delay
-          self.writeBuffer()
-      if self.bufferByteCount < self.bufferSize:
+          time.monotonic() >= self.nextOutputTime):
+          self.nextOutputTime = time.monotonic() + self.delay
+          self.delayedUntil = self.nextOutputTime
+          try:
+            self.writeBuffer()
+          except self.Drained:
+            break
+          if self.bucket is not None:
+            self.nextOutputTime = max(self.nextOutputTime,
+                                      self.bucket.readyTime())
+          if self.recordBucket is not None:
+            self.nextOutputTime = max(
+              self.nextOutputTime,
+              self.recordBucket.readyTime(self.recordBatch))
+      if self.canRead():
         if sys.stdin in channels:
           try:
             self.readBuffer()
           except self.Drained:
             break
-      waitDuration = (min(self.nextOutputTime, self.nextReportTime) -
-          time.time())
+      elif self.canSpill() and sys.stdin in channels:
+        self.spillInput()
+      if (self.inputDone and not self.canWrite() and
+          (self.stage is None or not self.stage.pending)):
+        break
+      waitDuration = (min(self.nextOutputTime, self.nextReportTime,
+                          self.nextGroupTime) - time.monotonic())
       if waitDuration > 0:
         time.sleep(waitDuration)
+        self.delayWait += waitDuration
+    if self.stage is not None:
+      self.stage.close()
+    if self.hasher is not None:
+      self.finishHashing()
+    if self.stage is not None:
+      self.stage.checkComplete()
+
+  def finishHashing(self):
+    """
+    writes the digests to the hash file (if given) and sends them in a
+    last report
+    """
+    self.digests = self.hasher.finish()
+    if self.hashFile is not None:
+      with open(self.hashFile, 'w') as hashFile:
+        for algorithm, digest in self.digests.items():
+          hashFile.write("%s (%s) = %s\n" % (
+            Hasher.tags.get(algorithm, algorithm), self.hashLabel, digest))
+    os.set_blocking(self.reportFifo, False)  # nobody might be reading
+    self.report()
+    for connection in self.connections.values():
+      connection.socket.settimeout(1.0)  # send the last report completely
+      connection.flush()
 
   def selectChannels(self):
-    r = [ self.controlFifo ]
-    if self.bufferByteCount < self.bufferSize:  # buffer not yet full?
+    r = [ self.controlFifo, self.controlSocket ]
+    r.extend(self.connections)
+    if self.stage is not None and self.stage.pending:
+      r.append(self.stage.wakeFd)
+    if self.canRead() or self.canSpill():
       r.append(sys.stdin)
-    outputDelayed = self.nextOutputTime > time.time()
-    reportDelayed = self.nextReportTime > time.time()
+    outputDelayed = self.nextOutputTime > time.monotonic()
+    reportDelayed = self.nextReportTime > time.monotonic()
     w = []
-    if not outputDelayed and self.bufferByteCount > 0:
+    if not outputDelayed and self.canWrite():
       w.append(sys.stdout)
     if not reportDelayed:
       w.append(self.reportFifo)
+    w.extend(connection for connection in self.connections.values()
+             if connection.pending)
     times = []
     if outputDelayed: times.append(self.nextOutputTime)
     if reportDelayed: times.append(self.nextReportTime)
+    if self.group is not None: times.append(self.nextGroupTime)
+    if (self.spill is not None and self.outputBlockedSince is not None and
+        time.monotonic() < self.outputBlockedSince + self.spillAfter):
+      times.append(self.outputBlockedSince + self.spillAfter)
     try:
-      waitDuration = max(min(times) - time.time(), 0)
+      waitDuration = max(min(times) - time.monotonic(), 0)
     except ValueError:  # no times?
       waitDuration = None  # never time out
     if self.verbose:
       print("# select:", r, w, waitDuration, "...", end=' ',
             file=sys.stderr, flush=True)
+    waitingForOutput = sys.stdout in w
+    waitingForInput = sys.stdin in r and not self.canWrite()
+    waitingForStage = (self.stage is not None and self.stage.wakeFd in r and
+                       not outputDelayed)
+    start = time.monotonic()
     try:
       r, w, e = select.select(r, w, [], waitDuration)
     except Exception as e:
       print("# problem with select:", r, w, waitDuration,
             file=sys.stderr)
       raise
+    waited = time.monotonic() - start
+    if sys.stdout in w:
+      self.outputBlockedSince = None
+    elif waitingForOutput and self.outputBlockedSince is None:
+      self.outputBlockedSince = start
+    if waitingForOutput:  # consumer is slow
+      self.writeWait += waited
+    elif waitingForInput:  # producer is slow
+      self.readWait += waited
+    elif waitingForStage:  # (de)compressing is slow, counts as busy
+      pass
+    else:  # delayed output
+      self.delayWait += waited
     if self.verbose:
       print(r, w, e, file=sys.stderr)
     return r + w
 
+  def handleConnections(self, channels):
+    """
+    accepts new clients of the control socket, answers their requests and
+    flushes their pending output
+    """
+    if self.controlSocket in channels:
+      try:
+        clientSocket, address = self.controlSocket.accept()
+      except BlockingIOError:
+        pass
+      else:
+        self.connections[clientSocket] = ControlConnection(clientSocket)
+    for channel in channels:
+      if isinstance(channel, ControlConnection):
+        channel.flush()
+      elif channel in self.connections:
+        connection = self.connections[channel]
+        for line in connection.receive():
+          if line.strip():
+            connection.send(self.handleRequest(connection, line))
+    for clientSocket, connection in list(self.connections.items()):
+      if connection.closed:
+        connection.close()
+        del self.connections[clientSocket]
+
+  def handleRequest(self, connection, request):
+    "returns the response to the given request line of a control client"
+    try:
+      request = json.loads(request)
+      if request[0] == 'subscribe':
+        connection.subscribed = True
+        return [ 'ok' ]
+      elif request[0] == 'report':
+        return [ 'ok', self.reportValues() ]
+      self.executeCommand(request)
+      return [ 'ok' ]
+    except Exception as problem:
+      return [ 'error', str(problem) ]
+
+  def executeCommand(self, command):
+    if command[0] == 'delay':
+      self.delay = command[1]
+      self.nextOutputTime = time.monotonic() + self.delay
+    elif command[0] == 'bufferSize':
+      self.newBufferSize = command[1]
+    elif command[0] == 'granularity':
+      self.granularity = command[1]
+    elif command[0] == 'rate' and self.group is not None:
+      self.group.setRate(command[1])
+      self.updateShare()
+    elif command[0] == 'rate':
+      self.setRate(*command[1:3])
+      self.nextOutputTime = time.monotonic()
+    else:
+      raise ValueError("unimplemented command: %r" % command)
+
   def handleCommand(self, command):
     if not command:  # ignore empty strings
       return
     try:
-      command = json.loads(command)
-      if command[0] == 'delay':
-        self.delay = command[1]
-        self.nextOutputTime = time.time() + self.delay
-      elif command[0] == 'bufferSize':
-        self.newBufferSize = command[1]
-      elif command[0] == 'granularity':
-        self.granularity = command[1]
-      else:
-        if not self.quiet:
-          print("unimplemented command: %r" % command,
-                file=sys.stderr)
+      self.executeCommand(json.loads(command))
     except Exception as problem:
       if not self.quiet:
         print("handleCommand:", problem, repr(command),
@@ -184,61 +1369,288 @@ class Copier(object):
     return result
 
   def writeBuffer(self):
-    written = 0
-    while written < self.bufferByteCount:
-      if self.bufferByteCount != self.bufferSize or written > 0:
-        written += os.write(sys.stdout.fileno(),
-          self.buffer.tobytes()[written:self.bufferByteCount])
+    try:
+      if self.records is not None:
+        self.writeRecords()
+      elif self.stage is not None:
+        self.writeStageOutput()
+      elif self.transfer == 'buffer' and self.bufferByteCount:
+        while self.bufferStart < self.bufferByteCount:
+          self.writeFrom(self.bufferView[self.bufferStart:
+                                         self.bufferByteCount])
+        self.bufferByteCount = self.bufferStart = 0
+        if self.hasher is not None and not self.hasher.finished(
+            self.hashTicket):
+          self.initBuffer()  # read into a new one while this is hashed
+      elif self.spill is not None and self.spill.used:
+        self.writeFrom(None)
       else:
-        self.buffer.tofile(sys.stdout.buffer)
-        written += len(self.buffer)
-    sys.stdout.flush()
-    self.writtenBytes += self.bufferByteCount
-    self.bufferByteCount = 0
-    if self.newBufferSize is not None:
+        self.moveData()
+    except BlockingIOError:  # stdout is full (only non-blocking if spilling)
+      if self.outputBlockedSince is None:
+        self.outputBlockedSince = time.monotonic()
+    self.publishStats()
+    if self.newBufferSize is not None and self.bufferByteCount == 0:
       self.bufferSize = self.newBufferSize
       self.newBufferSize = None
       self.initBuffer()
+    elif (self.newBufferSize is not None and self.records is not None and
+          self.newBufferSize >= self.bufferByteCount):
+      self.bufferSize = self.newBufferSize
+      self.newBufferSize = None
+      self.resizeBuffer(self.bufferSize)  # keeps the incomplete record
+
+  def writeStageOutput(self):
+    """
+    writes (a piece of) the oldest (de)compressed block; the rate limit
+    is charged for the compressed bytes
+    """
+    while not self.stageOutput:
+      if not self.stage.ready():
+        return
+      result, inputSize = self.stage.pop()
+      self.stageOutput = memoryview(result)
+      self.stageCharge = (inputSize / len(result)
+                          if self.stage.decompress and result else 1.0)
+    start = time.monotonic()
+    count = os.write(self.outputFd, self.stageOutput[:self.transferSize()])
+    self.recordCall('write', count, time.monotonic() - start)
+    if self.hasher is not None:  # results are not reused, no ticket needed
+      self.hasher.add(self.stageOutput[:count])
+    self.stageOutput = self.stageOutput[count:]
+    self.writtenBytes += count
+    if self.bucket is not None:
+      self.bucket.take(count * self.stageCharge)
+
+  def writeRecords(self):
+    """
+    writes as many whole records as the limits allow (at least one), then
+    moves the rest (an incomplete record) to the beginning of the buffer
+    """
+    maxRecords = None
+    if self.recordBucket is not None:
+      self.recordBucket.refill()
+      maxRecords = max(1, int(self.recordBucket.tokens))
+    end, count = self.records.split(self.buffer, self.bufferByteCount,
+                                    self.transferSize(), maxRecords)
+    if count == 0:  # EOF, pass the incomplete rest
+      end = self.bufferByteCount
+    while self.bufferStart < end:
+      self.writeFrom(self.bufferView[self.bufferStart:end])
+    if self.recordBucket is not None:
+      self.recordBucket.take(count)
+    rest = self.bufferByteCount - end
+    if self.hasher is not None:  # the rest is moved over hashed data
+      self.hasher.waitFor(self.hashTicket)
+    self.buffer[:rest] = self.bufferView[end:self.bufferByteCount].tobytes()
+    # ^^^ copied first as both overlap
+    self.bufferByteCount = rest
+    self.bufferStart = 0
+    self.recordReady = self.records.complete(self.buffer, 0, rest)
+
+  def writeFrom(self, view):
+    "writes (part of) the given view (or of the spill buffer) to stdout"
+    start = time.monotonic()
+    if view is None:
+      count = self.spill.drain(self.outputFd, self.transferSize())
+    else:
+      count = os.write(self.outputFd, view)
+      self.bufferStart += count
+      if self.hasher is not None:
+        self.hashTicket = self.hasher.add(view[:count])
+    self.recordCall('write', count, time.monotonic() - start)
+    self.writtenBytes += count
+    if self.bucket is not None:
+      self.bucket.take(count)
+
+  def restoreBlocking(self):
+    "undoes the non-blocking mode of the output (shared with others)"
+    try:
+      os.set_blocking(self.outputFd, True)
+    except OSError:  # closed already
+      pass
+
+  def spillInput(self):
+    start = time.monotonic()
+    count = self.spill.fill(self.inputFd)
+    if count == 0:
+      self.inputDone = True
+    else:
+      self.recordCall('read', count, time.monotonic() - start)
+
+  def publishStats(self):
+    self.stats.publish(
+      startTime=self.startTime, writtenBytes=self.writtenBytes,
+      bufferSize=self.bufferSize, delay=self.delay,
+      rate=self.bucket.rate if self.bucket is not None else 0,
+      achievedRate=self.achievedRate, readWait=self.readWait,
+      writeWait=self.writeWait, delayWait=self.delayWait,
+      spillUsed=self.spill.used if self.spill is not None else 0,
+      spillLimit=self.spill.limit if self.spill is not None else 0,
+      ratio=self.stage.ratio() if self.stage is not None else 0.0)
+
+  def reportValues(self):
+    return [
+      self.startTime, self.writtenBytes, self.bufferSize, self.delay,
+      self.bucket.rate if self.bucket is not None else 0,
+      self.readWait, self.writeWait, self.delayWait,
+      { kind: histogram.summary()
+        for kind, histogram in self.lastHistograms.items() },
+      self.spill.used if self.spill is not None else 0,
+      self.spill.limit if self.spill is not None else 0,
+      self.stage.ratio() if self.stage is not None else 0.0,
+      self.digests ]
 
   def buildReport(self):
-    return json.dumps([
-      self.startTime, self.writtenBytes, self.bufferSize, self.delay ])
+    return json.dumps(self.reportValues())
 
   def report(self):
-    self.nextReportTime = time.time() + self.granularity
+    now = time.monotonic()
+    self.nextReportTime = now + self.granularity
+    lastTime, lastBytes = self.lastReport
+    if now > lastTime:
+      self.achievedRate = (self.writtenBytes - lastBytes) / (now - lastTime)
+    self.lastReport = (now, self.writtenBytes)
+    self.publishStats()
+    values = self.reportValues()
     try:
-      os.write(self.reportFifo, (self.buildReport() + '\n').encode('utf-8'))
+      os.write(self.reportFifo, (json.dumps(values) + '\n').encode('utf-8'))
     except OSError as problem:
       pass
       #if problem.errno != os.errno.EPIPE:
       #  raise
+    for connection in self.connections.values():
+      if connection.subscribed:
+        connection.send(values)
+
+  def moveData(self):
+    """
+    moves up to bufferSize bytes from stdin to stdout without copying them
+    into this process; falls back to using a buffer if the kernel refuses
+    """
+    self.inputReady = False
+    start = time.monotonic()
+    try:
+      if self.transfer == 'splice':
+        moved = os.splice(self.inputFd, self.outputFd, self.transferSize(),
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+      else:
+        moved = os.sendfile(self.outputFd, self.inputFd, None,
+                            self.transferSize())
+    except BlockingIOError:  # stdout is full, try again later
+      self.inputReady = True
+      return
+    except OSError as problem:
+      if problem.errno not in (errno.EINVAL, errno.ENOSYS):
+        raise
+      if self.verbose:
+        print("# %s failed (%s), using a buffer" % (self.transfer, problem),
+              file=sys.stderr)
+      self.transfer = 'buffer'
+      self.initBuffer()
+      return
+    if moved == 0:
+      raise self.Drained()
+    latency = time.monotonic() - start
+    self.recordCall('write', moved, latency)  # one call does both
+    self.histograms['readSize'].add(moved)
+    self.histograms['readLatency'].add(latency * 1e6)
+    self.writtenBytes += moved
+    if self.bucket is not None:
+      self.bucket.take(moved)
 
   def readBuffer(self):
-    chunk = os.read(
-      sys.stdin.fileno(), self.bufferSize - self.bufferByteCount)
-    self.buffer[self.bufferByteCount:self.bufferByteCount + len(chunk)] = \
-      array.array('b', chunk)
-    self.bufferByteCount += len(chunk)
+    if self.transfer != 'buffer':  # data stays in the kernel until moved
+      self.inputReady = True
+      return
+    if self.stage is not None:
+      self.readIntoStage()
+      return
+    start = time.monotonic()
+    limit = (len(self.buffer) if self.records is not None
+             else self.transferSize())
+    count = os.readv(self.inputFd,
+      [ self.bufferView[self.bufferByteCount:limit] ])
+    if count:
+      self.recordCall('read', count, time.monotonic() - start)
+    self.bufferByteCount += count
+    if self.records is not None and not self.recordReady:
+      self.recordReady = self.records.complete(
+        self.buffer, self.bufferByteCount - count, self.bufferByteCount)
+      if not self.recordReady and self.bufferByteCount == len(self.buffer):
+        self.resizeBuffer(2 * len(self.buffer))  # record larger than buffer
     if self.bufferByteCount == 0:
       raise self.Drained()
+    if count == 0:  # EOF, but the rest of the buffer is not written yet
+      self.inputDone = True
+
+  def readIntoStage(self):
+    "reads into the current block of the compression stage"
+    start = time.monotonic()
+    count = os.readv(self.inputFd, [ self.stage.space()[:self.bufferSize] ])
+    if count == 0:  # EOF, results may still be pending
+      self.stage.finish()
+      self.inputDone = True
+      return
+    self.recordCall('read', count, time.monotonic() - start)
+    self.stage.commit(count)
 
 homeDir = '/run/shm/thru'
 
-def getFifoPath(name):
+def claimInstanceDir(name):
+  "creates and returns the directory of a new instance (if name is unused)"
   fifoPath = os.path.join(homeDir, name)
   try:
     os.makedirs(fifoPath)
   except OSError as problem:
-    if problem.errno == os.errno.EEXIST:
+    if problem.errno == errno.EEXIST:
       raise NameInUse(name)
     else:
       raise
+  return fifoPath
+
+def removeInstanceDir(fifoPath):
+  "removes the directory of a daemon stream with the files in it"
+  for fileName in ('socket', 'stats'):
+    try:
+      os.unlink(os.path.join(fifoPath, fileName))
+    except FileNotFoundError:  # stream never started
+      pass
+  os.rmdir(fifoPath)
+
+def claimName(name, claim):
+  """
+  calls claim (which raises NameInUse if a name is taken) with name, then
+  with up to 20 ".x" suffixes, then with random names, until it succeeds;
+  returns its result
+  """
+  if name:
+    for i in range(20):
+      try:
+        return claim(name + '.x' * i)
+      except NameInUse:
+        pass
+  # find a random name
+  while True:  # until unused name found
+    name = str(random.randint(1000, 9999))
+    try:
+      return claim(name)
+    except NameInUse:
+      pass
+
+def getFifoPath(name):
+  fifoPath = claimInstanceDir(name)
   os.mkfifo(os.path.join(fifoPath, 'report'))
   os.mkfifo(os.path.join(fifoPath, 'control'))
 
   def cleanup(fifoPath=fifoPath):
     os.unlink(os.path.join(fifoPath, 'report'))
     os.unlink(os.path.join(fifoPath, 'control'))
+    for fileName in ('socket', 'stats'):
+      try:
+        os.unlink(os.path.join(fifoPath, fileName))
+      except FileNotFoundError:  # copier never started
+        pass
     os.rmdir(fifoPath)
 
   atexit.register(cleanup)
@@ -246,6 +1658,48 @@ def getFifoPath(name):
 
 class NameInUse(Exception): pass
 
+class CommandFailed(Exception): pass
+
+def connectControl(name):
+  """
+  returns a socket connected to the control socket of the given thru, or
+  None if it has none (e.g. an older version of thru is running)
+  """
+  controlSocket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    controlSocket.connect(os.path.join(homeDir, name, 'socket'))
+  except (FileNotFoundError, ConnectionRefusedError):
+    controlSocket.close()
+    return None
+  return controlSocket
+
+def request(controlSocket, message):
+  "sends a request and returns the (successful) response"
+  controlSocket.sendall((json.dumps(message) + '\n').encode('utf-8'))
+  with controlSocket.makefile('r') as responses:
+    response = json.loads(responses.readline() or '["error", "no response"]')
+  if response[0] != 'ok':
+    raise CommandFailed(response[1])
+  return response
+
+def openReports(name):
+  """
+  returns a file from which the reports of the given thru can be read
+  line by line; subscribes via the control socket if possible, else the
+  report fifo is used (which only supports one reader)
+  """
+  controlSocket = connectControl(name)
+  if controlSocket is None:
+    return open(os.path.join(homeDir, name, 'report'))
+  with controlSocket:
+    reports = controlSocket.makefile('r')
+    controlSocket.sendall(b'["subscribe"]\n')
+    response = json.loads(reports.readline() or '["error", "no response"]')
+  if response[0] != 'ok':
+    reports.close()
+    raise CommandFailed(response[1])
+  return reports
+
 def lineByLine(openFile):
   while True:
     line = openFile.readline()
@@ -254,71 +1708,237 @@ def lineByLine(openFile):
     yield line
 
 def reportOn(name):
-  with open(os.path.join(homeDir, name, 'report')) as reportFile:
+  with openReports(name) as reportFile:
     lastReportTime = None
     lastPos = None
+    lastWaits = None
     for line in lineByLine(reportFile):
-      thruStartTime, pos, bufferSize, delay = json.loads(line)
+      values = json.loads(line)
+      thruStartTime, pos, bufferSize, delay, rate = values[:5]
+      waits = values[5:8] or None  # not reported by older thrus
+      histograms = values[8] if len(values) > 8 else {}
+      spill = values[9:11] or [ 0, 0 ]
+      ratio = values[11] if len(values) > 11 else 0.0
+      digests = values[12] if len(values) > 12 else {}
       durationSinceLast = (None if lastReportTime is None
-          else time.time() - lastReportTime)
+          else time.monotonic() - lastReportTime)
       progressSinceLast = (None if lastPos is None
           else pos - lastPos)
-      lastReportTime = time.time()
+      waitsSinceLast = (None if lastWaits is None or waits is None
+          else [ wait - lastWait for wait, lastWait in zip(waits, lastWaits) ])
+      lastReportTime = time.monotonic()
       lastPos = pos
+      lastWaits = waits
       yield (thruStartTime, durationSinceLast, progressSinceLast,
-          pos, bufferSize, delay)
+          pos, bufferSize, delay, rate, waitsSinceLast, histograms, spill,
+          ratio, digests)
 
-def reportOnMany(names):
-  if names:
-    reportFiles = { name: open(os.path.join(homeDir, name, 'report'))
-                    for name in names }
-  else:
-    reportFiles = { name: open(os.path.join(homeDir, name, 'report'))
-                    for name in os.listdir(homeDir) }
-  file2name = { f: name for name, f in reportFiles.items() }
+def bottleneck(waits, duration):
+  """
+  returns the shares of the duration spent waiting for input, for output
+  and delaying (given as waits), and what limits the throughput: 'input',
+  'output', 'delay', or 'thru' if it mostly did not wait at all
+  """
+  shares = [ min(1.0, wait / duration) for wait in waits ]
+  largest = max(shares)
+  if largest < 1.0 - sum(shares):  # mostly busy copying
+    return shares, 'thru'
+  return shares, ('input', 'output', 'delay')[shares.index(largest)]
+
+class InstanceWatcher(object):
+  """
+  tells which thru instances (directories in homeDir) appeared and which
+  disappeared; uses inotify (via ctypes) if available, else compares
+  listings of homeDir every pollInterval seconds
+  """
+  IN_MOVED_FROM = 0x40
+  IN_MOVED_TO = 0x80
+  IN_CREATE = 0x100
+  IN_DELETE = 0x200
+  IN_Q_OVERFLOW = 0x4000
+  IN_ONLYDIR = 0x1000000
+  IN_ISDIR = 0x40000000
+  IN_CLOEXEC = 0o2000000
+  IN_NONBLOCK = 0o4000
+  eventLayout = struct.Struct('=iIII')  # wd, mask, cookie, len
+
+  def __init__(self, path, pollInterval=1.0):
+    self.path = path
+    self.pollInterval = pollInterval
+    self.inotifyFd = self.initInotify()
+    self.names = None  # not listed yet
+    self.nextPollTime = 0.0
+
+  def initInotify(self):
+    "returns an inotify fd watching path or None if not possible"
+    try:
+      libc = ctypes.CDLL(None, use_errno=True)
+      fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+    except (OSError, AttributeError):  # no inotify
+      return None
+    if fd < 0:
+      return None
+    if libc.inotify_add_watch(fd, os.fsencode(self.path),
+        self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM |
+        self.IN_MOVED_TO | self.IN_ONLYDIR) < 0:
+      os.close(fd)
+      return None
+    return fd
+
+  def listing(self):
+    try:
+      return { name for name in os.listdir(self.path)
+               if os.path.isdir(os.path.join(self.path, name)) }
+    except FileNotFoundError:
+      return set()
+
+  def readEvents(self):
+    "returns the sets of created and deleted names, None on an overflow"
+    created, deleted = set(), set()
+    while True:
+      try:
+        data = os.read(self.inotifyFd, 1 << 16)
+      except BlockingIOError:
+        return created, deleted
+      offset = 0
+      while offset < len(data):
+        wd, mask, cookie, length = self.eventLayout.unpack_from(data, offset)
+        offset += self.eventLayout.size
+        name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+        offset += length
+        if mask & self.IN_Q_OVERFLOW:
+          return None
+        if not mask & self.IN_ISDIR:
+          continue
+        if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+          created.add(name)
+          deleted.discard(name)
+        elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+          deleted.add(name)
+          created.discard(name)
+
+  def changes(self):
+    "returns the sets of names added and removed since the last call"
+    events = None
+    if self.inotifyFd is not None and self.names is not None:
+      events = self.readEvents()
+    if events is None:  # first call, inotify overflow, or polling
+      if self.inotifyFd is None and time.monotonic() < self.nextPollTime:
+        return set(), set()
+      self.nextPollTime = time.monotonic() + self.pollInterval
+      names = self.listing()
+      old = self.names or set()
+      added, removed = names - old, old - names
+    else:
+      added, removed = events
+      added -= self.names
+      removed &= self.names
+    self.names = (self.names or set()) - removed | added
+    return added, removed
+
+  def close(self):
+    if self.inotifyFd is not None:
+      os.close(self.inotifyFd)
+      self.inotifyFd = None
+
+def isRunning(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:  # exists, but belongs to someone else
+    pass
+  return True
+
+def reportOnMany(names, interval=1.0):
+  """
+  yields a dict (name -> stats) of the given thrus (of all if none are
+  given) and the set of the names of the running ones every interval
+  seconds; reads their shared memory stats segments
+  """
+  segments = {}
+  watcher = None if names else InstanceWatcher(homeDir)
+  unmapped = set(names)  # names without a segment (yet)
+  nextTime = time.monotonic()
   try:
-    lastReportTimes = {}
-    lastPoses = {}
-    thruStartTimes = {}
-    poses = {}
-    bufferSizes = {}
-    delays = {}
-    durationSinceLasts = {}
-    progressSinceLasts = {}
-    while not names or reportFiles:
-      r, w, e = select.select(reportFiles.values(), [], [], 1.0)
-      for f in r:
-        name = file2name[f]
-        line = f.readline()
-        if not line:
-          del file2name[f]
-          del reportFiles[name]
-          f.close()
+    while True:
+      if watcher is not None:
+        added, removed = watcher.changes()
+        unmapped |= added
+        for name in removed:
+          unmapped.discard(name)
+          if name in segments:
+            segments.pop(name).close()
+      for name in list(unmapped):
+        try:
+          segments[name] = StatsSegment(os.path.join(homeDir, name, 'stats'))
+        except (FileNotFoundError, ValueError):  # not (yet) publishing
+          pass
         else:
-          thruStartTimes[name], poses[name], bufferSizes[name], \
-              delays[name] = json.loads(line)
-          durationSinceLasts[name] = (None if name not in lastReportTimes
-              else time.time() - lastReportTimes[name])
-          progressSinceLasts[name] = (None if name not in lastPoses
-              else poses[name] - lastPoses[name])
-          lastReportTimes[name] = time.time()
-          lastPoses[name] = poses[name]
-        yield (thruStartTimes, durationSinceLasts,
-            progressSinceLasts, poses, bufferSizes,
-            delays, reportFiles.keys(), name)
-      for name in os.listdir(homeDir):
-        if name not in reportFiles:
-          f = open(os.path.join(homeDir, name, 'report'))
-          reportFiles[name] = f
-          file2name[f] = name
+          unmapped.discard(name)
+      stats = {}
+      for name, segment in segments.items():
+        values = segment.read()
+        if values is not None:
+          stats[name] = values
+      yield stats, { name for name, values in stats.items()
+                     if isRunning(values['pid']) }
+      nextTime += interval
+      time.sleep(max(0, nextTime - time.monotonic()))
   finally:
-    for f in reportFiles.values():
-      f.close()
+    for segment in segments.values():
+      segment.close()
+    if watcher is not None:
+      watcher.close()
+
+def formatDashboard(stats, running, names, order, size, height=None):
+  """
+  returns the lines showing the given stats (name -> values), the totals
+  first, then the given names (or all) sorted by order ('name', 'rate' or
+  'bytes'); at most height lines are returned (if given and sensible)
+  """
+  names = names or stats.keys()
+  if order == 'rate':
+    names = sorted(names, key=lambda name:
+                   -stats[name]['achievedRate'] if name in stats else 0)
+  elif order == 'bytes':
+    names = sorted(names, key=lambda name:
+                   -stats[name]['writtenBytes'] if name in stats else 0)
+  else:
+    names = sorted(names)
+  lines = [ "%d running, %d finished: %s bytes, %s bytes/s" % (
+    len(running), len(stats) - len(running),
+    size(sum(values['writtenBytes'] for values in stats.values())),
+    size(int(sum(stats[name]['achievedRate'] for name in running)))) ]
+  for name in names:
+    if name not in stats:
+      lines.append('? %-8s' % name)
+      continue
+    values = stats[name]
+    lines.append('%s %-8s:\t%s %10s %16s %12s%s r%.1fs w%.1fs' % (
+      ' ' if name in running else 'X',
+      name,
+      values['delay'],
+      size(values['bufferSize']),
+      size(values['writtenBytes']),
+      size(int(values['achievedRate'])),
+      "/%s" % size(int(values['rate'])) if values['rate'] else "",
+      values['readWait'],
+      values['writeWait']))
+  if height is not None and 1 < height < len(lines):
+    hidden = len(lines) - height + 1
+    lines[height - 1:] = [ "... (%d more)" % hidden ]
+  return lines
 
 def sendCommand(name, command):
-  with open(os.path.join(homeDir, name, 'control'), 'wa') as control:
-    data = json.dumps(command)
-    control.write(data)
+  controlSocket = connectControl(name)
+  if controlSocket is None:  # no acknowledgements via the control fifo
+    with open(os.path.join(homeDir, name, 'control'), 'w') as control:
+      data = json.dumps(command)
+      control.write(data)
+    return
+  with controlSocket:
+    request(controlSocket, command)
 
 def setDelay(name, delay):
   sendCommand(name, [ 'delay', delay ])
@@ -329,13 +1949,419 @@ def setBufferSize(name, bufferSize):
 def setGranularity(name, granularity):
   sendCommand(name, [ 'granularity', granularity ])
 
+def setRate(name, rate, burst=None):
+  sendCommand(name, [ 'rate', rate, burst ])
+
+benchmarkVariants = [
+  ('cat', [ 'cat' ]),
+  ('thru', []),
+  ('thru -b 4k', [ '-b', '4096' ]),
+  ('thru -b 1M', [ '-b', '1048576' ]),
+  ('thru --tune', [ '--tune' ]),
+  ('thru -c', [ '-c' ]),
+  ('thru -c -b 4k', [ '-c', '-b', '4096' ]),
+  ('thru -c -b 1M', [ '-c', '-b', '1048576' ]),
+  ('thru -c --tune', [ '-c', '--tune' ]),
+  ('thru --hash sha256', [ '--hash', 'sha256' ]),
+  ('thru --hash sha256,md5', [ '--hash', 'sha256,md5' ]),
+  ('tee >(sha256sum)', [ 'bash', '-c', 'tee >(sha256sum > /dev/null)' ]) ]
+# ^^^ label and command (or thru options)
+
+def benchmarkPipe(command, size):
+  """
+  returns the seconds it takes to pass size bytes (zeros) written by this
+  process through command into cat (writing to /dev/null)
+  """
+  chunk = memoryview(bytes(1 << 20))
+  start = time.monotonic()
+  stage = subprocess.Popen(command, stdin=subprocess.PIPE,
+                           stdout=subprocess.PIPE)
+  consumer = subprocess.Popen([ 'cat' ], stdin=stage.stdout,
+                              stdout=subprocess.DEVNULL)
+  stage.stdout.close()
+  remaining = size
+  while remaining > 0:
+    remaining -= stage.stdin.write(chunk[:remaining])
+  stage.stdin.close()
+  stage.wait()
+  consumer.wait()
+  return time.monotonic() - start
+
+def benchmark(variants, size, repeat=3):
+  """
+  yields label, seconds (best of repeat runs) and bytes per second for
+  each variant (label and command, or thru options)
+  """
+  for label, command in variants:
+    if not command or command[0].startswith('-'):  # thru options
+      command = [ sys.executable, os.path.abspath(sys.argv[0]), '-q' ] + (
+        command + [ 'benchmark' ])
+    seconds = min(benchmarkPipe(command, size) for run in range(repeat))
+    yield label, seconds, size / seconds
+
+daemonPath = os.path.join(homeDir, '.daemon.socket')
+
+class DaemonStream(object):
+  """
+  one named pipe pair (an input and an output fd) handled by the daemon;
+  behaves like a Copier (delay, buffer size, rate limit, reports, stats
+  segment, control socket), but as asyncio tasks within the daemon
+  """
+  def __init__(self, fifoPath, inputFd, outputFd, options, verbose=False):
+    self.startTime = time.time()
+    self.fifoPath = fifoPath
+    self.verbose = verbose
+    self.inputFd = inputFd
+    self.outputFd = outputFd
+    self.bufferSize = options.get('bufferSize', Options.bufferSize)
+    self.granularity = options.get('granularity', Options.granularity)
+    self.delay = options.get('delay', Options.delay)
+    self.bucket = None
+    self.group = None  # not supported by the daemon
+    self.setRate(options.get('rate'), options.get('burst'))
+    self.transfer = chooseTransfer(inputFd, outputFd)
+    if self.transfer == 'sendfile' or not options.get('zeroCopy', True):
+      self.transfer = 'buffer'
+    self.buffer = bytearray(self.bufferSize)
+    self.newBufferSize = None
+    self.writtenBytes = 0
+    self.readWait = self.writeWait = self.delayWait = 0.0
+    self.achievedRate = 0.0
+    self.lastReport = (time.monotonic(), 0)
+    self.nextOutputTime = 0.0
+    self.changed = asyncio.Event()  # set by commands changing limits
+    self.subscribers = set()
+    self.blocking = [ os.get_blocking(fd) for fd in (inputFd, outputFd) ]
+    # ^^^ restored when done, the client shares the file descriptions
+    for fd in (inputFd, outputFd):
+      os.set_blocking(fd, False)
+    self.stats = StatsSegment(os.path.join(fifoPath, 'stats'), create=True)
+    self.publishStats()
+
+  setRate = Copier.setRate
+  transferSize = Copier.transferSize
+
+  async def ready(self, fd, writing=False):
+    "waits until the given fd is readable (or writable)"
+    if stat.S_ISREG(os.fstat(fd).st_mode):  # always ready, epoll refuses
+      return
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    def wakeUp():
+      if not future.done():
+        future.set_result(None)
+    if writing:
+      loop.add_writer(fd, wakeUp)
+    else:
+      loop.add_reader(fd, wakeUp)
+    try:
+      await future
+    finally:
+      if writing:
+        loop.remove_writer(fd)
+      else:
+        loop.remove_reader(fd)
+
+  async def waitFor(self, fd, writing=False):
+    "waits for ready() and accounts the time as read or write wait"
+    start = time.monotonic()
+    await self.ready(fd, writing)
+    if writing:
+      self.writeWait += time.monotonic() - start
+    else:
+      self.readWait += time.monotonic() - start
+
+  async def waitForOutputTime(self):
+    "sleeps until nextOutputTime (which commands may change meanwhile)"
+    while True:
+      remaining = self.nextOutputTime - time.monotonic()
+      if remaining <= 0:
+        return
+      self.changed.clear()
+      start = time.monotonic()
+      try:
+        await asyncio.wait_for(self.changed.wait(), remaining)
+      except asyncio.TimeoutError:
+        pass
+      self.delayWait += time.monotonic() - start
+
+  async def pump(self):
+    """
+    passes all input to the output (a broken pipe or another error of an
+    fd ends it like EOF)
+    """
+    try:
+      await self.passData()
+    except OSError as problem:
+      if self.verbose:
+        print("# %s: %s" % (os.path.basename(self.fifoPath), problem),
+              file=sys.stderr)
+
+  async def passData(self):
+    """
+    tries to pass data first and waits for readiness only when an fd
+    would block (saves the epoll calls in the fast case)
+    """
+    view = memoryview(self.buffer)
+    while True:
+      await self.waitForOutputTime()
+      if self.transfer == 'splice':
+        try:
+          count = os.splice(self.inputFd, self.outputFd, self.transferSize(),
+                            flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:  # either side might be the reason
+          await self.waitFor(self.inputFd)
+          await self.waitFor(self.outputFd, writing=True)
+          continue
+      else:
+        try:
+          count = os.readv(self.inputFd, [ view[:self.transferSize()] ])
+        except BlockingIOError:
+          await self.waitFor(self.inputFd)
+          continue
+        written = 0
+        while written < count:
+          try:
+            written += os.write(self.outputFd, view[written:count])
+          except BlockingIOError:
+            await self.waitFor(self.outputFd, writing=True)
+      if count == 0:  # EOF
+        return
+      self.writtenBytes += count
+      self.nextOutputTime = time.monotonic() + self.delay
+      if self.bucket is not None:
+        self.bucket.take(count)
+        self.nextOutputTime = max(self.nextOutputTime,
+                                  self.bucket.readyTime())
+      if self.newBufferSize is not None:
+        self.bufferSize = self.newBufferSize
+        self.newBufferSize = None
+        self.buffer = bytearray(self.bufferSize)
+        view = memoryview(self.buffer)
+      self.publishStats()
+
+  def publishStats(self):
+    self.stats.publish(
+      startTime=self.startTime, writtenBytes=self.writtenBytes,
+      bufferSize=self.bufferSize, delay=self.delay,
+      rate=self.bucket.rate if self.bucket is not None else 0,
+      achievedRate=self.achievedRate, readWait=self.readWait,
+      writeWait=self.writeWait, delayWait=self.delayWait)
+
+  def reportValues(self):
+    return [
+      self.startTime, self.writtenBytes, self.bufferSize, self.delay,
+      self.bucket.rate if self.bucket is not None else 0,
+      self.readWait, self.writeWait, self.delayWait, {}, 0, 0, 0.0 ]
+
+  async def reportRegularly(self):
+    while True:
+      await asyncio.sleep(self.granularity)
+      now = time.monotonic()
+      lastTime, lastBytes = self.lastReport
+      self.achievedRate = (self.writtenBytes - lastBytes) / (now - lastTime)
+      self.lastReport = (now, self.writtenBytes)
+      self.publishStats()
+      line = (json.dumps(self.reportValues()) + '\n').encode('utf-8')
+      for writer in self.subscribers:
+        if writer.transport.get_write_buffer_size() < 1 << 16:
+          writer.write(line)  # else the subscriber does not read
+
+  def executeCommand(self, command):
+    Copier.executeCommand(self, command)
+    self.changed.set()  # wake up a waiting pump
+
+  async def handleClient(self, reader, writer):
+    "answers the requests of a client of the control socket"
+    try:
+      async for line in reader:
+        if not line.strip():
+          continue
+        try:
+          request = json.loads(line)
+          if request[0] == 'subscribe':
+            self.subscribers.add(writer)
+            response = [ 'ok' ]
+          elif request[0] == 'report':
+            response = [ 'ok', self.reportValues() ]
+          else:
+            self.executeCommand(request)
+            response = [ 'ok' ]
+        except Exception as problem:
+          response = [ 'error', str(problem) ]
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+    except ConnectionError:
+      pass
+    finally:
+      self.subscribers.discard(writer)
+      writer.close()
+
+  async def run(self):
+    "passes everything, then cleans up"
+    socketPath = os.path.join(self.fifoPath, 'socket')
+    server = await asyncio.start_unix_server(self.handleClient, socketPath)
+    reporter = asyncio.create_task(self.reportRegularly())
+    try:
+      await self.pump()
+    finally:
+      reporter.cancel()
+      server.close()
+      for writer in self.subscribers:
+        writer.close()
+      for fd, blocking in zip((self.inputFd, self.outputFd), self.blocking):
+        try:
+          os.set_blocking(fd, blocking)
+        except OSError:
+          pass
+        try:
+          os.close(fd)
+        except OSError:  # e. g. EIO, the fd is closed anyway
+          pass
+      self.stats.close()
+      try:
+        removeInstanceDir(self.fifoPath)
+      except OSError as problem:
+        print("thru: could not remove %s: %s" % (self.fifoPath, problem),
+              file=sys.stderr)
+
+class Daemon(object):
+  """
+  handles many named pipe pairs in one process; clients (thru --attach)
+  pass their stdin and stdout over a unix socket (SCM_RIGHTS) along with
+  a JSON object {"name": <name or null>, "options": {...}}, and get a
+  response line (["ok", <name>] or ["error", <text>])
+  """
+  def __init__(self, verbose=False):
+    self.verbose = verbose
+    self.streams = set()
+
+  async def serve(self):
+    os.makedirs(homeDir, exist_ok=True)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with probe:
+      try:
+        probe.connect(daemonPath)
+      except (FileNotFoundError, ConnectionRefusedError):
+        pass
+      else:
+        raise CommandFailed("a daemon is running already")
+    try:
+      os.unlink(daemonPath)  # left over by a crashed daemon
+    except FileNotFoundError:
+      pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(daemonPath)
+    listener.listen(64)
+    listener.setblocking(False)
+    loop = asyncio.get_running_loop()
+    for signalNumber in (signal.SIGINT, signal.SIGTERM):  # clean up on both
+      loop.add_signal_handler(signalNumber, asyncio.current_task().cancel)
+    try:
+      while True:
+        connection, address = await loop.sock_accept(listener)
+        asyncio.create_task(self.attach(connection))
+    finally:
+      listener.close()
+      os.unlink(daemonPath)
+
+  async def attach(self, connection):
+    "takes over the fds passed by a client and starts a stream"
+    fds = []
+    fifoPath = None
+    with connection:
+      try:
+        message, fds, flags, address = await asyncio.wait_for(
+          self.receive(connection), 10.0)
+        if len(fds) != 2:
+          raise ValueError("expected 2 fds, got %d" % len(fds))
+        request = json.loads(message)
+        fifoPath = claimName(request.get('name'), claimInstanceDir)
+        stream = DaemonStream(fifoPath, fds[0], fds[1],
+                              request.get('options', {}), self.verbose)
+      except Exception as problem:
+        for fd in fds:
+          os.close(fd)
+        if fifoPath is not None:  # claimed, but the stream failed
+          removeInstanceDir(fifoPath)
+        response = [ 'error', str(problem) ]
+      else:
+        name = os.path.basename(fifoPath)
+        response = [ 'ok', name ]
+        task = asyncio.create_task(stream.run())
+        self.streams.add(task)
+        task.add_done_callback(self.streams.discard)
+        if self.verbose:
+          print("# attached", name, file=sys.stderr)
+      connection.setblocking(True)
+      connection.sendall((json.dumps(response) + '\n').encode('utf-8'))
+
+  maxFds = 16  # more than expected, so surplus fds can be closed
+
+  async def receive(self, connection):
+    "returns the message, fds, flags and address received (recv_fds())"
+    loop = asyncio.get_running_loop()
+    readable = loop.create_future()
+    loop.add_reader(connection, readable.set_result, None)
+    try:
+      await readable
+    finally:
+      loop.remove_reader(connection)
+    return socket.recv_fds(connection, 1 << 16, self.maxFds)
+
+def attachToDaemon(name, options):
+  """
+  passes stdin and stdout to the daemon which then handles them under
+  the given name (or a found one); returns the name used
+  """
+  if (options.group is not None or options.spill is not None or
+      options.records is not None or options.compress is not None or
+      options.hash is not None):
+    raise CommandFailed("--group, --spill, --records, --(de)compress and"
+                        " --hash are not supported by --attach")
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(daemonPath)
+  except (FileNotFoundError, ConnectionRefusedError):
+    raise CommandFailed("no daemon running (start one using --daemon)")
+  with client:
+    request = { 'name': name, 'options': {
+      'delay': options.delay, 'bufferSize': options.bufferSize,
+      'granularity': options.granularity, 'rate': options.rate,
+      'burst': options.burst, 'zeroCopy': options.zeroCopy } }
+    socket.send_fds(client, [ json.dumps(request).encode('utf-8') ],
+                    [ sys.stdin.fileno(), sys.stdout.fileno() ])
+    with client.makefile('r') as responses:
+      response = json.loads(responses.readline() or '["error", "no response"]')
+  if response[0] != 'ok':
+    raise CommandFailed(response[1])
+  return response[1]
+
 class Options(object):
   quiet = False
   verbose = False
   granularity = 1.0
   delay = 0.0
   bufferSize = 1<<16  # 64k
+  framesPerSecond = 2.0
+  order = 'name'
+  rate = 0  # no limit
+  burst = None  # one buffer
+  group = None
+  weight = 1.0
+  spill = None
+  spillLimit = 1 << 30  # 1G
+  records = None  # bytes, not records
+  recordRate = 0  # no limit
+  compress = None  # or (codec, decompress)
+  hash = None  # or list of hashlib algorithms
+  tune = False
+  hashFile = None
+  hashLabel = '-'  # the data was read from stdin
+  threads = None  # one per CPU
+  blockSize = 1 << 20  # 1M
+  attach = False
   humanReadable = False
+  zeroCopy = True
 
 def int2kmgt(i):
   return ''.join(''.join(x)
@@ -364,9 +2390,83 @@ def parseArgv(argv):
     elif argv[1] == '-b':  # set delay
       options.bufferSize = int(argv[2])
       del argv[1:3]
+    elif argv[1] == '-r':  # limit the rate
+      options.rate = kmg.parse(argv[2])
+      del argv[1:3]
+    elif argv[1] == '--group':  # share a rate limit
+      options.group = argv[2]
+      del argv[1:3]
+    elif argv[1] == '--weight':  # set weight in the group
+      options.weight = float(argv[2])
+      del argv[1:3]
+    elif argv[1] == '--daemon':  # handle the pipes of attaching processes
+      try:
+        asyncio.run(Daemon(options.verbose).serve())
+      except asyncio.CancelledError:  # terminated by a signal
+        pass
+      return None
+    elif argv[1] == '--attach':  # let the daemon do the work
+      options.attach = True
+      del argv[1]
+    elif argv[1] == '--spill':  # spill into a file if the consumer stalls
+      options.spill = argv[2]
+      del argv[1:3]
+    elif argv[1] == '--spill-limit':  # set maximum size of the spill file
+      options.spillLimit = int(kmg.parse(argv[2]))
+      del argv[1:3]
+    elif argv[1] == '--records':  # pass whole records only
+      options.records = argv[2]
+      del argv[1:3]
+    elif argv[1] == '--record-rate':  # limit the records per second
+      options.recordRate = kmg.parse(argv[2])
+      del argv[1:3]
+    elif argv[1] == '--compress':  # compress in a pool of threads
+      options.compress = (argv[2], False)
+      del argv[1:3]
+    elif argv[1] == '--decompress':  # decompress in another thread
+      options.compress = (argv[2], True)
+      del argv[1:3]
+    elif argv[1] == '--threads':  # set number of compressing threads
+      options.threads = int(argv[2])
+      del argv[1:3]
+    elif argv[1] == '--block-size':  # set size of compressed blocks
+      options.blockSize = int(kmg.parse(argv[2]))
+      del argv[1:3]
+    elif argv[1] == '--tune':  # enlarge pipes, adapt the buffer size
+      options.tune = True
+      del argv[1]
+    elif argv[1] == '--hash':  # compute digests of the output
+      options.hash = argv[2].split(',')
+      del argv[1:3]
+    elif argv[1] == '--hash-file':  # write the digests into a file
+      options.hashFile = argv[2]
+      del argv[1:3]
+    elif argv[1] == '--hash-label':  # name of the data in the hash file
+      options.hashLabel = argv[2]
+      del argv[1:3]
+    elif argv[1] == '-f':  # set frame rate of -W
+      options.framesPerSecond = float(argv[2])
+      del argv[1:3]
+    elif argv[1] == '-s':  # set order of -W
+      options.order = argv[2]
+      del argv[1:3]
+    elif argv[1] == '-t':  # set burst size
+      options.burst = kmg.parse(argv[2])
+      del argv[1:3]
+    elif argv[1] == '-c':  # copy through user space
+      options.zeroCopy = False
+      del argv[1]
     elif argv[1] == '-g':  # set granularity
       options.granularity = float(argv[2])
       del argv[1:3]
+    elif argv[1] == '--benchmark':  # measure the throughput
+      size = int(kmg.parse(argv[2])) if len(argv) > 2 else 1 << 30
+      reference = None
+      for label, seconds, rate in benchmark(benchmarkVariants, size):
+        reference = reference or rate
+        print("%-28s %8.3fs %10.1f MB/s %6.1f%%" % (
+          label, seconds, rate / 1e6, rate * 100.0 / reference), flush=True)
+      return None
     elif argv[1] == '-l':  # list all running thrus
       for name in os.listdir(homeDir):
         if os.path.isdir(os.path.join(homeDir, name)):
@@ -375,41 +2475,48 @@ def parseArgv(argv):
     elif argv[1] == '-w':  # watch info about given running thru
       size = int2kmgt if options.humanReadable else int
       name = argv[2]
-      suffix = '\r' if os.isatty(1) else '\n'
+      suffix = '\r' if os.isatty(1) and not options.verbose else '\n'
       # ^^^ we want all output in one line if this is a tty
       for (thruStartTime, durationSinceLast, progressSinceLast,
-        pos, bufferSize, delay) in reportOn(name):
+        pos, bufferSize, delay, rate, waitsSinceLast,
+        histograms, (spillUsed, spillLimit), ratio,
+        digests) in reportOn(name):
+        if waitsSinceLast and durationSinceLast:
+          shares, limit = bottleneck(waitsSinceLast, durationSinceLast)
+          waitInfo = "in %d%% out %d%% delay %d%% %s" % (
+            tuple(share * 100 for share in shares) + (limit,))
+        else:
+          waitInfo = "./."
         print(name, delay, size(bufferSize), size(pos),
-              (size(int(progressSinceLast/durationSinceLast))
-               if durationSinceLast else "./."), suffix, end=' ',
-              flush=True)
+              "%s%s" % (size(int(progressSinceLast/durationSinceLast))
+                        if durationSinceLast else "./.",
+                        "/%s" % size(int(rate)) if rate else ""),
+              waitInfo, ("spill %s/%s" % (size(spillUsed), size(spillLimit))
+                         if spillLimit else ""),
+              "ratio %.3f" % ratio if ratio else "",
+              ' '.join("%s %s" % item for item in sorted(digests.items())),
+              suffix, end=' ', flush=True)
+        if options.verbose:
+          for kind in ('readSize', 'readLatency',
+                       'writeSize', 'writeLatency'):
+            print("  %-12s %s" % (kind + ':',
+                                  formatHistogram(histograms.get(kind, {}))))
       return None
     elif argv[1] == '-W':  # watch info about several given running thrus
       size = int2kmgt if options.humanReadable else int
       names = argv[2:]
-      init = '\x1b[H\x1b[2J' if os.isatty(1) else '----\n'
-      # ^^^ we want to clear the screen for each chunk if this is a tty
-      collected = []
-      for (thruStartTimes, durationSinceLasts, progressSinceLasts, poses,
-          bufferSizes, delays, actives, name) in reportOnMany(names):
-        for active in actives:
-          if active not in collected:
-            collected.append(active)
-        def argsForOutput(name):
-          try:
-            return (
-                ' ' if name in actives else 'X',
-                name,
-                delays[name],
-                size(bufferSizes[name]),
-                size(poses[name]),
-                size(int(progressSinceLasts[name]/durationSinceLasts[name]))
-                    if durationSinceLasts[name] else "./.")
-          except KeyError:
-            return ('?', name, '', '', '', '')
-        print(init + kmg.process_line(
-            '\n'.join('%s %-8s:\t%s %10s %16s %12s' % argsForOutput(name)
-                      for name in (names or collected))))
+      isTty = os.isatty(1)
+      for stats, running in reportOnMany(names,
+                                         1.0 / options.framesPerSecond):
+        if isTty:  # repaint in place, clear rest of lines and of screen
+          lines = formatDashboard(stats, running, names, options.order,
+                                  size, os.get_terminal_size(1).lines - 1)
+          frame = '\x1b[H' + '\x1b[K\n'.join(lines) + '\x1b[K\n\x1b[J'
+        else:
+          lines = formatDashboard(stats, running, names, options.order, size)
+          frame = '----\n' + '\n'.join(lines) + '\n'
+        sys.stdout.write(kmg.process_line(frame))
+        sys.stdout.flush()
       return None
     elif argv[1] == '-D':  # set a delay remotely
       name = argv[2]
@@ -426,26 +2533,55 @@ def parseArgv(argv):
       granularity = float(argv[3])
       setGranularity(name, granularity)
       return None
+    elif argv[1] == '-L':  # set rate limit of a group
+      BandwidthGroup.setGroupRate(argv[2], kmg.parse(argv[3]))
+      return None
+    elif argv[1] == '-R':  # set rate limit remotely
+      name = argv[2]
+      rate = kmg.parse(argv[3])
+      burst = kmg.parse(argv[4]) if len(argv) > 4 else None
+      setRate(name, rate, burst)
+      return None
     else:
       break
-  if len(argv) > 1:
-    name = argv[1]
-    for i in range(20):
-      try:
-        return getFifoPath(name + '.x' * i), options
-      except NameInUse:
-        pass
-  # find a random name
-  while True:  # until unused name found
-    name = str(random.randint(1000, 9999))
-    try:
-      return getFifoPath(name), options
-    except NameInUse:
-      pass
+  name = argv[1] if len(argv) > 1 else None
+  if not options.weight > 0:  # also NaN
+    raise CommandFailed("--weight must be positive")
+  if options.records is not None and options.spill is not None:
+    raise CommandFailed("--records cannot be combined with --spill")
+  if options.records is not None:
+    RecordFormat(options.records)  # complain before claiming a name
+  if options.hash is not None and options.spill is not None:
+    raise CommandFailed("--hash cannot be combined with --spill")
+  if options.hash is not None:
+    for algorithm in options.hash:  # complain before claiming a name
+      if algorithm not in hashlib.algorithms_available:
+        raise CommandFailed("unknown hash algorithm: %r" % algorithm)
+  if options.compress is not None and options.compress[0] not in (
+      CompressionStage.codecs):
+    raise CommandFailed("unknown codec: %r" % options.compress[0])
+  if options.compress is not None and (options.spill is not None or
+                                       options.records is not None):
+    raise CommandFailed(
+      "--(de)compress cannot be combined with --spill or --records")
+  if options.attach:
+    name = attachToDaemon(name, options)
+    if options.verbose:
+      print("# attached as", name, file=sys.stderr)
+    return None
+  return claimName(name, getFifoPath), options
 
 if __name__ == '__main__':
-  action = parseArgv(sys.argv)
+  try:
+    action = parseArgv(sys.argv)
+  except CommandFailed as problem:
+    print("thru:", problem, file=sys.stderr)
+    sys.exit(1)
   if action:
     fifoPath, options = action
     copier = Copier(fifoPath, options)
-    copier.copy()
+    try:
+      copier.copy()
+    except CommandFailed as problem:
+      print("thru:", problem, file=sys.stderr)
+      sys.exit(1)